@@ -0,0 +1,40 @@
+"""Cashier membership per bot, in memory.
+
+is_cashier used to run `SELECT 1 FROM cashiers ...` on every main menu, /start and every
+step of a cashier flow. CashierIndex loads a bot's cashier ids once into a frozenset, so a
+role check is a set lookup. add_cashier / delete_cashier publish a "cashiers" event on the
+invalidation bus (manager.invalidate_cashiers), which drops the set here and in every other
+process; the next check reloads it.
+"""
+
+from repo import db_get_cashier_ids
+
+
+class CashierIndex:
+    def __init__(self, conn):
+        self.conn = conn
+        self._sets: dict[int, frozenset] = {}
+        self.loads = 0
+
+    def members(self, bot_id: int) -> frozenset:
+        ids = self._sets.get(bot_id)
+        if ids is None:
+            ids = self._sets[bot_id] = frozenset(db_get_cashier_ids(self.conn, bot_id))
+            self.loads += 1
+        return ids
+
+    def is_cashier(self, bot_id: int, user_id: int) -> bool:
+        return int(user_id) in self.members(bot_id)
+
+    def invalidate(self, bot_id: int | None = None):
+        if bot_id is None:
+            self._sets.clear()
+        else:
+            self._sets.pop(bot_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "bots": len(self._sets),
+            "cashiers": sum(len(s) for s in self._sets.values()),
+            "loads": self.loads,
+        }
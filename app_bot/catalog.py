@@ -0,0 +1,115 @@
+"""Shared per-bot catalog index.
+
+category_selected / subcategory_selected used to copy `prods: [(id, name), ...]` into every
+user's state, and add_product_from_keyboard resolved the tapped button with a linear scan.
+Thousands of browsing users meant thousands of copies of the same menu.
+
+Now the product list of a leaf node lives once per bot in CatalogIndex, and a session only
+keeps a reference: `catalog_version`, `node` ("c:<cat_id>" — products directly in a category,
+"s:<subcat_id>" — products of a (sub)subcategory) and `page`.
+
+- ProductList keeps ids and names as tuples plus a name -> id dict (O(1) button resolution;
+  for duplicate names the first product wins, as with the old `next(...)` scan);
+- nodes are loaded lazily and shared by every user of the bot;
+- bots.catalog_version is bumped by DB triggers on categories / subcategories / products /
+  menu_photos; the index re-reads it at most every CATALOG_CHECK_INTERVAL seconds (or right
+  away after invalidate()) and drops its nodes when it changed;
+- the same query also reads bots.settings_version (bumped by a trigger on any bots change),
+  so caches built from bot settings (keyboards) can rely on this one periodic check.
+"""
+
+import os
+import time
+
+from repo import db_get_bot_versions, db_get_node_products
+
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "5"))
+
+
+def category_node(cat_id: int) -> str:
+    return f"c:{int(cat_id)}"
+
+
+def subcategory_node(subcat_id: int) -> str:
+    return f"s:{int(subcat_id)}"
+
+
+class ProductList:
+    __slots__ = ("node", "ids", "names", "by_name")
+
+    def __init__(self, node: str, rows):
+        self.node = node
+        self.ids = tuple(int(r[0]) for r in rows)
+        self.names = tuple(r[1] for r in rows)
+        by_name: dict[str, int] = {}
+        for pid, name in zip(self.ids, self.names):
+            by_name.setdefault(name, pid)
+        self.by_name = by_name
+
+    def __len__(self):
+        return len(self.ids)
+
+    def resolve(self, name: str) -> int | None:
+        return self.by_name.get(name)
+
+    def page_names(self, page: int, per_page: int) -> tuple:
+        start = page * per_page
+        return self.names[start:start + per_page]
+
+
+class CatalogIndex:
+    def __init__(self, bot_id: int, conn, check_interval: float = CATALOG_CHECK_INTERVAL):
+        self.bot_id = bot_id
+        self.conn = conn
+        self.check_interval = check_interval
+        self.version: int | None = None
+        self.settings_version: int | None = None
+        self._nodes: dict[str, ProductList] = {}
+        self._checked_at = 0.0
+        self.loads = 0
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self.version is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        version, self.settings_version = db_get_bot_versions(self.conn, self.bot_id)
+        if version != self.version:
+            self.version = version
+            self._nodes.clear()
+
+    def current_version(self) -> int:
+        self._refresh()
+        return self.version
+
+    def versions(self) -> tuple[int, int]:
+        """(catalog_version, settings_version) as of the last check."""
+        self._refresh()
+        return self.version, self.settings_version
+
+    def products(self, node: str) -> ProductList:
+        self._refresh()
+        plist = self._nodes.get(node)
+        if plist is None:
+            kind, _, raw_id = node.partition(":")
+            if kind == "s":
+                rows = db_get_node_products(self.conn, self.bot_id, subcat_id=int(raw_id))
+            else:
+                rows = db_get_node_products(self.conn, self.bot_id, cat_id=int(raw_id))
+            plist = self._nodes[node] = ProductList(node, rows)
+            self.loads += 1
+        return plist
+
+    def invalidate(self):
+        """Re-check the version on next access (the dashboard changed the menu)."""
+        self._checked_at = 0.0
+        self.version = None
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "settings_version": self.settings_version,
+            "nodes": len(self._nodes),
+            "products": sum(len(p) for p in self._nodes.values()),
+            "loads": self.loads,
+        }
@@ -0,0 +1,92 @@
+"""Per-chat ordered, cross-chat parallel update processing.
+
+aiogram polling handles every update in its own task (handle_as_tasks=True), so two quick
+taps from one user ("+1" twice, "Добавить" then "Корзина") run concurrently and race on the
+shared user_state dict and on the cart rows.
+
+ChatDispatcher serializes updates per (bot_id, chat_id): every key has a FIFO queue of
+pending updates (asyncio.Lock hands itself over to waiters strictly in arrival order), only
+one update per key is processed at a time, different keys run in parallel. A key's entry
+is removed as soon as its queue drains, so memory follows the number of *active* chats,
+not the number of users the bot has ever seen.
+
+Updates without a chat (pre_checkout_query, inline queries) are keyed by the user; updates
+with neither pass straight through.
+"""
+
+import asyncio
+import time
+
+
+class _KeyQueue:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class ChatDispatcher:
+    def __init__(self):
+        self._queues: dict[tuple, _KeyQueue] = {}
+        self.processed = 0
+        self.waited = 0
+        self.max_depth = 0
+        self.wait_time_total = 0.0
+
+    def middleware(self, bot_id: int):
+        """Outer update middleware for this bot's Dispatcher.
+
+        Must be registered after aiogram's UserContextMiddleware (Dispatcher() does that
+        itself), which puts event_chat / event_from_user into `data`.
+        """
+        async def _serialize(handler, event, data):
+            key = self._key(bot_id, data)
+            if key is None:
+                return await handler(event, data)
+            return await self.run(key, handler, event, data)
+
+        return _serialize
+
+    @staticmethod
+    def _key(bot_id: int, data: dict) -> tuple | None:
+        chat = data.get("event_chat")
+        if chat is not None:
+            return (bot_id, chat.id)
+        user = data.get("event_from_user")
+        if user is not None:
+            return (bot_id, "u", user.id)
+        return None
+
+    async def run(self, key: tuple, handler, event, data):
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = _KeyQueue()
+        q.pending += 1
+        if q.pending > self.max_depth:
+            self.max_depth = q.pending
+        started = time.monotonic()
+        try:
+            async with q.lock:
+                waited = time.monotonic() - started
+                if waited > 0.001:
+                    self.waited += 1
+                    self.wait_time_total += waited
+                return await handler(event, data)
+        finally:
+            self.processed += 1
+            q.pending -= 1
+            # Очередь пуста — ключ больше не нужен
+            if q.pending == 0 and self._queues.get(key) is q:
+                del self._queues[key]
+
+    def stats(self, bot_id: int | None = None) -> dict:
+        keys = [k for k in self._queues if bot_id is None or k[0] == bot_id]
+        return {
+            "active_keys": len(keys),
+            "queued": sum(self._queues[k].pending for k in keys),
+            "processed": self.processed,
+            "waited": self.waited,
+            "avg_wait_ms": round(1000 * self.wait_time_total / self.waited, 2) if self.waited else 0.0,
+            "max_depth": self.max_depth,
+        }
@@ -0,0 +1,401 @@
+"""Pluggable storage for per-user bot state (user_states).
+
+user_states used to be a plain process-global dict: a restart or deploy dropped every
+in-progress checkout, and a bot could not move to another worker (see sharding.py).
+
+Each bot gets a UserStateStore — a MutableMapping user_id -> state record, so the handlers
+keep using `user_state[uid]`, `.get()`, `.pop()` unchanged. It is a local read-through cache
+in front of a backend:
+
+- reads hit the cache; a miss is loaded by `prefetch()` in an update middleware (in a
+  thread, before the handlers run), so handlers never block on the DB;
+- handlers mutate state dicts in place, so the middleware marks the user dirty after every
+  update; `flush()` writes all dirty users in one batch (and deletes popped ones) every
+  FSM_FLUSH_INTERVAL seconds and when the bot is stopped.
+
+Abandoned sessions used to stay in memory forever (full `prods` lists, cart snapshots,
+nested previous_state chains). A sweeper (every FSM_SWEEP_INTERVAL) now:
+
+- drops sessions idle longer than USER_STATE_TTL from the cache and the backend;
+- with a persistent backend, unloads sessions idle longer than FSM_CACHE_TTL from the
+  cache only (they are loaded back on the next message);
+- after every update the previous_state chain is cut to USER_STATE_HISTORY_DEPTH levels.
+
+memory_report() gives entry counts and approximate bytes per bot for node sizing.
+
+Backends (FSM_STORAGE): "memory" — process-local, the old behaviour; "postgres" — table
+user_states on a dedicated connection (default). A Redis-protocol backend only has to
+implement the same four methods.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections.abc import Mapping, MutableMapping
+
+import psycopg
+
+from app_bot.session import SESSION_CLASSES, Session, session_from
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "60"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "900"))
+USER_STATE_TTL = float(os.getenv("USER_STATE_TTL", str(24 * 3600)))
+USER_STATE_HISTORY_DEPTH = int(os.getenv("USER_STATE_HISTORY_DEPTH", "4"))
+
+
+# --- serialization: JSON that keeps tuples, non-str dict keys and session records ---
+def _pack(v):
+    if isinstance(v, Session):
+        packed = {k: _pack(x) for k, x in v.items()}
+        packed["__s"] = type(v).__name__
+        return packed
+    if isinstance(v, tuple):
+        return {"__t": [_pack(x) for x in v]}
+    if isinstance(v, list):
+        return [_pack(x) for x in v]
+    if isinstance(v, dict):
+        if all(isinstance(k, str) for k in v):
+            return {k: _pack(x) for k, x in v.items()}
+        return {"__d": [[_pack(k), _pack(x)] for k, x in v.items()]}
+    return v
+
+
+def _unpack(v):
+    if isinstance(v, list):
+        return [_unpack(x) for x in v]
+    if isinstance(v, dict):
+        cls_name = v.get("__s")
+        if cls_name is not None:
+            record = SESSION_CLASSES.get(cls_name, Session)()
+            for k, x in v.items():
+                if k != "__s":
+                    record[k] = _unpack(x)
+            return record
+        if len(v) == 1:
+            if "__t" in v:
+                return tuple(_unpack(x) for x in v["__t"])
+            if "__d" in v:
+                return {_unpack(k): _unpack(x) for k, x in v["__d"]}
+        return {k: _unpack(x) for k, x in v.items()}
+    return v
+
+
+def encode_state(state: dict) -> str:
+    return json.dumps(_pack(state), ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_state(data: str) -> Session:
+    return session_from(_unpack(json.loads(data)))
+
+
+def cap_history(state, depth: int = USER_STATE_HISTORY_DEPTH) -> int:
+    """Cut the previous_state chain after `depth` levels. Returns the depth found."""
+    level = 0
+    node = state
+    while isinstance(node, Mapping):
+        prev = node.get("previous_state")
+        if not isinstance(prev, Mapping):
+            return level
+        if level >= depth:
+            node.pop("previous_state", None)
+            return level
+        level += 1
+        node = prev
+    return level
+
+
+def approx_size(obj, _seen=None) -> int:
+    """Deep sys.getsizeof over dict/list/tuple/set (shared objects counted once)."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, Session):
+        if obj._extra is not None:
+            size += sys.getsizeof(obj._extra)
+        for k, v in obj.items():
+            size += approx_size(v, _seen)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_size(k, _seen) + approx_size(v, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += approx_size(v, _seen)
+    return size
+
+
+# --- backends ---
+class MemoryStateBackend:
+    """Keeps encoded states in process memory (same semantics as the DB backend)."""
+
+    persistent = False
+
+    def __init__(self):
+        self._data: dict[tuple[int, int], tuple[str, float]] = {}
+
+    def load(self, bot_id: int, user_id: int) -> str | None:
+        item = self._data.get((bot_id, user_id))
+        return item[0] if item else None
+
+    def save_many(self, bot_id: int, items: list[tuple[int, str]]):
+        now = time.time()
+        for user_id, data in items:
+            self._data[(bot_id, user_id)] = (data, now)
+
+    def delete_many(self, bot_id: int, user_ids: list[int]):
+        for user_id in user_ids:
+            self._data.pop((bot_id, user_id), None)
+
+    def expire(self, bot_id: int, older_than: float) -> int:
+        keys = [k for k, (_, ts) in self._data.items() if k[0] == bot_id and ts < older_than]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def close(self):
+        pass
+
+
+class PostgresStateBackend:
+    """Table user_states on its own connection (calls come from worker threads)."""
+
+    persistent = True
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._conn = None
+        # Одно соединение на все боты; транзакция батча не должна перемешаться с чужими запросами
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg.connect(self.dsn, autocommit=True)
+        return self._conn
+
+    def load(self, bot_id: int, user_id: int) -> str | None:
+        with self._lock, self._connection().cursor() as c:
+            c.execute("SELECT data FROM user_states WHERE bot_id=%s AND user_id=%s", (bot_id, user_id))
+            row = c.fetchone()
+        return row[0] if row else None
+
+    def save_many(self, bot_id: int, items: list[tuple[int, str]]):
+        now = int(time.time())
+        with self._lock:
+            self._save_many(bot_id, items, now)
+
+    def _save_many(self, bot_id: int, items: list[tuple[int, str]], now: int):
+        conn = self._connection()
+        with conn.transaction(), conn.cursor() as c:
+            c.executemany(
+                """
+                INSERT INTO user_states (bot_id, user_id, data, updated_at) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (bot_id, user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+                """,
+                [(bot_id, user_id, data, now) for user_id, data in items],
+            )
+
+    def delete_many(self, bot_id: int, user_ids: list[int]):
+        with self._lock, self._connection().cursor() as c:
+            c.execute("DELETE FROM user_states WHERE bot_id=%s AND user_id = ANY(%s)", (bot_id, list(user_ids)))
+
+    def expire(self, bot_id: int, older_than: float) -> int:
+        with self._lock, self._connection().cursor() as c:
+            c.execute("DELETE FROM user_states WHERE bot_id=%s AND updated_at < %s", (bot_id, int(older_than)))
+            return c.rowcount or 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def make_backend(kind: str = FSM_STORAGE, dsn: str | None = None):
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "postgres":
+        return PostgresStateBackend(dsn)
+    raise ValueError(f"unknown FSM_STORAGE: {kind}")
+
+
+# --- per-bot store ---
+class UserStateStore(MutableMapping):
+    def __init__(self, bot_id: int, backend):
+        self.bot_id = bot_id
+        self.backend = backend
+        self._cache: dict[int, dict] = {}
+        self._absent: set[int] = set()  # точно нет в хранилище — не ходим в БД повторно
+        self._dirty: set[int] = set()
+        self._deleted: set[int] = set()
+        self._touched: dict[int, float] = {}
+        self._flush_lock = asyncio.Lock()
+        self.evicted = 0
+        self.unloaded = 0
+        self.expired = 0
+
+    # --- mapping interface (sync, cache only) ---
+    def __getitem__(self, user_id):
+        return self._cache[user_id]
+
+    def __setitem__(self, user_id, state):
+        state = session_from(state)
+        self._cache[user_id] = state
+        self._touched[user_id] = time.monotonic()
+        self._absent.discard(user_id)
+        self._deleted.discard(user_id)
+        self._dirty.add(user_id)
+
+    def __delitem__(self, user_id):
+        del self._cache[user_id]
+        self._absent.add(user_id)
+        self._dirty.discard(user_id)
+        self._deleted.add(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._cache
+
+    def __iter__(self):
+        return iter(self._cache)
+
+    def __len__(self):
+        return len(self._cache)
+
+    # --- cache / persistence ---
+    async def prefetch(self, user_id: int):
+        """Load the user's state into the cache before the handlers run."""
+        if user_id in self._cache or user_id in self._absent:
+            return
+        try:
+            data = await asyncio.to_thread(self.backend.load, self.bot_id, user_id)
+        except Exception as e:
+            print("Ошибка загрузки состояния пользователя:", e)
+            return
+        if user_id in self._cache or user_id in self._absent:
+            return
+        if data is None:
+            self._absent.add(user_id)
+        else:
+            self._cache[user_id] = decode_state(data)
+
+    def mark_dirty(self, user_id: int):
+        self._touched[user_id] = time.monotonic()
+        state = self._cache.get(user_id)
+        if state is not None:
+            cap_history(state)
+            self._dirty.add(user_id)
+
+    async def flush(self):
+        """Write dirty states and deletions in one batch."""
+        async with self._flush_lock:
+            if not self._dirty and not self._deleted:
+                return
+            dirty, self._dirty = self._dirty, set()
+            deleted, self._deleted = self._deleted, set()
+            items = []
+            for user_id in dirty:
+                state = self._cache.get(user_id)
+                if state is None:
+                    continue
+                try:
+                    items.append((user_id, encode_state(state)))
+                except Exception as e:
+                    # Одно битое состояние не должно ронять весь батч; попробуем снова на следующем тике
+                    print(f"Состояние пользователя {user_id} не сериализуется:", e)
+                    self._dirty.add(user_id)
+            try:
+                if items:
+                    await asyncio.to_thread(self.backend.save_many, self.bot_id, items)
+                if deleted:
+                    await asyncio.to_thread(self.backend.delete_many, self.bot_id, list(deleted))
+            except Exception as e:
+                print("Ошибка записи состояний пользователей:", e)
+                # Повторим на следующем тике (если за это время не изменилось)
+                self._dirty |= {u for u, _ in items if u not in self._deleted}
+                self._deleted |= {u for u in deleted if u not in self._cache}
+
+    def discard(self):
+        """Drop pending writes without flushing (the bot's rows are already gone)."""
+        self._dirty.clear()
+        self._deleted.clear()
+        self._cache.clear()
+        self._touched.clear()
+
+    async def run_flusher(self, interval: float = FSM_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("Ошибка сброса состояний пользователей:", e)
+
+    async def sweep(self, state_ttl: float = USER_STATE_TTL, cache_ttl: float = FSM_CACHE_TTL):
+        """Evict idle sessions: drop abandoned ones, unload cold ones from the cache."""
+        now = time.monotonic()
+        persistent = getattr(self.backend, "persistent", False)
+        for user_id, touched in list(self._touched.items()):
+            idle = now - touched
+            if idle > state_ttl:
+                if user_id in self._cache:
+                    del self[user_id]
+                    self.evicted += 1
+                self._absent.discard(user_id)
+                self._touched.pop(user_id, None)
+            elif persistent and idle > cache_ttl and user_id not in self._dirty:
+                if self._cache.pop(user_id, None) is not None:
+                    self.unloaded += 1
+                self._absent.discard(user_id)
+                self._touched.pop(user_id, None)
+        await self.flush()
+        try:
+            self.expired += await asyncio.to_thread(self.backend.expire, self.bot_id, time.time() - state_ttl)
+        except Exception as e:
+            print("Ошибка очистки устаревших состояний:", e)
+
+    async def run_sweeper(self, interval: float = FSM_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    def memory_report(self) -> dict:
+        seen: set = set()
+        total = 0
+        largest = 0
+        max_depth = 0
+        for state in self._cache.values():
+            size = approx_size(state, seen)
+            total += size
+            largest = max(largest, size)
+            max_depth = max(max_depth, cap_history(state, depth=1 << 30))
+        return {
+            "bot_id": self.bot_id,
+            "entries": len(self._cache),
+            "approx_bytes": total,
+            "largest_entry_bytes": largest,
+            "max_history_depth": max_depth,
+            "dirty": len(self._dirty),
+            "tracked": len(self._touched),
+            "evicted": self.evicted,
+            "unloaded": self.unloaded,
+            "expired": self.expired,
+        }
+
+    def middleware(self):
+        """Outer update middleware: prefetch before the handlers, mark dirty after."""
+        async def _persist(handler, event, data):
+            user = data.get("event_from_user")
+            if user is None:
+                return await handler(event, data)
+            await self.prefetch(user.id)
+            try:
+                return await handler(event, data)
+            finally:
+                self.mark_dirty(user.id)
+
+        return _persist
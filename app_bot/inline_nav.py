@@ -0,0 +1,82 @@
+"""Compact callback_data for the inline catalog navigation mode (bots.inline_nav).
+
+In the reply-keyboard menu every page flip sends a new message (often a photo), and a choice
+is found by matching the button text against titles with embedded counts. In inline mode the
+menu is one message: buttons carry short ids and page numbers, and navigation edits that
+message in place (edit_message_media only when the picture changes, otherwise the caption /
+reply markup).
+
+callback_data is "n:<code>[:<int>...]", well below Telegram's 64-byte limit:
+
+    n:c:<page>              categories
+    n:k:<cat_id>            open a category (subcategories or its products)
+    n:s:<cat_id>:<page>     root subcategories of a category
+    n:u:<subcat_id>         open a subcategory (children or its products)
+    n:ss:<subcat_id>:<page> children of a subcategory
+    n:pc:<cat_id>:<page>    products directly in a category     (node "c:<id>")
+    n:ps:<subcat_id>:<page> products of a (sub)subcategory      (node "s:<id>")
+    n:pr:<prod_id>          product card
+    n:bc / n:bs:<cat_id> / n:bss:<subcat_id>
+                            back to categories / subcategories / children, at the page
+                            the user last saw there (kept in the session, not in the button)
+    n:cart / n:home / n:x   cart, main menu, no-op (page counter)
+
+Since no button depends on the user, a rendered screen can be shared by every user of the bot.
+"""
+
+NAV_PREFIX = "n:"
+
+# code -> number of integer arguments
+NAV_ARITY = {
+    "c": 1,
+    "k": 1,
+    "s": 2,
+    "u": 1,
+    "ss": 2,
+    "pc": 2,
+    "ps": 2,
+    "pr": 1,
+    "bc": 0,
+    "bs": 1,
+    "bss": 1,
+    "cart": 0,
+    "home": 0,
+    "x": 0,
+}
+
+# Экраны со страницами: последний аргумент — номер страницы
+PAGED_VIEWS = frozenset(("c", "s", "ss", "pc", "ps"))
+
+
+def nav_data(code: str, *args: int) -> str:
+    return NAV_PREFIX + ":".join((code, *(str(int(a)) for a in args)))
+
+
+def parse_nav(data: str | None) -> tuple | None:
+    """'n:s:12:3' -> ('s', 12, 3); None for foreign or malformed data."""
+    if not data or not data.startswith(NAV_PREFIX):
+        return None
+    code, *raw = data[len(NAV_PREFIX):].split(":")
+    if NAV_ARITY.get(code) != len(raw):
+        return None
+    try:
+        return (code, *(int(a) for a in raw))
+    except ValueError:
+        return None
+
+
+def resolve_back(view: tuple, pages: dict) -> tuple:
+    """Back codes -> paged view at the remembered page (other views are returned as is)."""
+    code = view[0]
+    if code == "bc":
+        return ("c", pages.get("c", 0))
+    if code == "bs":
+        return ("s", view[1], pages.get(f"s:{view[1]}", 0))
+    if code == "bss":
+        return ("ss", view[1], pages.get(f"ss:{view[1]}", 0))
+    return view
+
+
+def view_key(view: tuple) -> str:
+    """Key under which the page of a paged view is remembered ('c', 's:12', 'ps:34')."""
+    return ":".join(str(p) for p in view[:-1])
@@ -0,0 +1,56 @@
+"""Per-bot cache of prebuilt keyboards.
+
+Every screen used to rebuild its markup and the data behind it on each message: the main
+menu re-read bonuses_enabled, category pages re-counted products for every title. Now
+KeyboardCache keeps the built objects per bot, keyed by (screen, page, role, ...), for one
+(catalog_version, settings_version) pair:
+
+- versions come from CatalogIndex.versions() (the DB triggers that dashboard writes fire
+  bump them); when they differ from the cached pair, everything is dropped on next access;
+- entries are LRU-bounded (KEYBOARD_CACHE_SIZE per bot);
+- cached values are shared by every user of the bot and must not be mutated.
+"""
+
+import os
+from collections import OrderedDict
+
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "512"))
+
+
+class KeyboardCache:
+    def __init__(self, bot_id: int, max_entries: int = KEYBOARD_CACHE_SIZE):
+        self.bot_id = bot_id
+        self.max_entries = max_entries
+        self.version = None
+        self._items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, key: tuple, build):
+        """Cached value for key at version; build() makes it on a miss."""
+        if version != self.version:
+            self._items.clear()
+            self.version = version
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            value = self._items[key] = build()
+            if len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+            return value
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def invalidate(self):
+        self._items.clear()
+        self.version = None
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "entries": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -6,7 +6,7 @@ import uuid
 
 import qrcode
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -20,6 +20,19 @@ from aiogram.types import (
 
 from connection import conn, cur
 from core.utils import normalize_notify_chat_id
+from connection import DATABASE_URL
+from app_bot.supervisor import BotSupervisor
+from app_bot.dispatch import ChatDispatcher
+from app_bot.scheduling import BOT_WEIGHTS, FairScheduler
+from app_bot.fsm_router import StateRouter
+from app_bot.fsm_storage import UserStateStore, make_backend
+from app_bot.catalog import CatalogIndex, ProductList, category_node, subcategory_node
+from app_bot.inline_nav import NAV_PREFIX, PAGED_VIEWS, nav_data, parse_nav, resolve_back, view_key
+from app_bot.keyboards import KeyboardCache
+from app_bot.settings import BotSettingsCache
+from app_bot.cashiers import CashierIndex
+from core.invalidation import InvalidationBus
+from app_bot.sharding import BOT_SHARDING, ShardCoordinator
 from repo import (
     db_get_subcategories,
     db_count_enabled_subcategories,
@@ -38,26 +51,89 @@ DEFAULT_BOT_COMMANDS = [
     BotCommand(command="status", description="Статус заказа"),
 ]
 
+# === Меню: пагинация категорий / подкатегорий / товаров ===
+# (на уровне модуля: фильтры хендлеров ссылаются на них при регистрации)
+MENU_PAGE_SIZE = 8
+MENU_NAV_PREV = "◀️"
+MENU_NAV_NEXT = "▶️"
+MENU_PAGE_PREFIX = "Стр."
+
 active_bots: dict[int, dict] = {}
-user_states: dict[int, dict] = {}
+# bot_id -> UserStateStore (кэш + батч-запись в хранилище FSM_STORAGE)
+user_states: dict[int, UserStateStore] = {}
+# bot_id -> CatalogIndex (общий на всех пользователей бота список товаров по узлам меню)
+catalog_indexes: dict[int, CatalogIndex] = {}
+# bot_id -> KeyboardCache (готовые клавиатуры экранов, сбрасываются по версиям каталога/настроек)
+keyboard_caches: dict[int, KeyboardCache] = {}
+# Настройки ботов (строка bots) в памяти; сброс — invalidate_bot_settings()
+bot_settings = BotSettingsCache(conn)
+# Кассиры ботов (множества id в памяти); сброс — invalidate_cashiers()
+cashier_index = CashierIndex(conn)
+# События "что изменилось" между процессами (LISTEN/NOTIFY) -> сброс кэшей выше
+invalidation_bus = InvalidationBus(conn, DATABASE_URL)
+_state_backend = None
+# Владеет polling-задачами всех ботов: перезапуск с backoff, health-check, чистая остановка
+supervisor = BotSupervisor()
+# Апдейты одного чата обрабатываются строго по очереди, разных чатов — параллельно
+chat_dispatcher = ChatDispatcher()
+# Лимиты in-flight на бота и честное распределение слотов между ботами
+scheduler = FairScheduler()
+
+
+def get_state_backend():
+    global _state_backend
+    if _state_backend is None:
+        _state_backend = make_backend(dsn=DATABASE_URL)
+    return _state_backend
+
+
 async def launch_bot(bot_id: int, token: str, username: str):
     if bot_id in active_bots:
-        try:
-            await active_bots[bot_id]["bot"].session.close()
-        except:
-            pass
-        del active_bots[bot_id]
-        await asyncio.sleep(2)
+        await stop_bot(bot_id)
     bot = Bot(token=token)
     dp = Dispatcher()
+    scheduler.set_weight(bot_id, BOT_WEIGHTS.get(bot_id, 1.0))
+    # Порядок важен: допуск (лимит очереди бота) -> очередь чата -> слот исполнения
+    dp.update.outer_middleware(scheduler.admission_middleware(bot_id))
+    dp.update.outer_middleware(chat_dispatcher.middleware(bot_id))
+    dp.update.outer_middleware(scheduler.slot_middleware(bot_id))
     # Устанавливаем команды, чтобы появилась синяя кнопка "Меню" и список /команд
     try:
         await bot.set_my_commands(DEFAULT_BOT_COMMANDS)
     except Exception as e:
         print("Не удалось установить команды бота:", e)
     if bot_id not in user_states:
-        user_states[bot_id] = {}
+        user_states[bot_id] = UserStateStore(bot_id, get_state_backend())
     user_state = user_states[bot_id]
+    # Внутри очереди чата: состояние подгружается до хендлеров и помечается к записи после
+    dp.update.outer_middleware(user_state.middleware())
+    # Хендлеры сообщений индексируются по состоянию / флагу / тексту; в dp — один вход
+    router = StateRouter(user_state, bot_username=username)
+    catalog = catalog_indexes[bot_id] = CatalogIndex(bot_id, conn)
+    keyboards = keyboard_caches[bot_id] = KeyboardCache(bot_id)
+
+    def _cached_keyboard(key: tuple, build):
+        """Shared screen data / markup for key, rebuilt when catalog or settings version changes."""
+        return keyboards.get(catalog.versions(), key, build)
+
+    def _session_products(state) -> ProductList:
+        """Product list the session points at (node reference into the shared catalog)."""
+        node = state.get("node")
+        if node is None:
+            # состояние, сохранённое до перехода на ссылки, ещё держит копию списка
+            return ProductList("", state.get("prods") or [])
+        return catalog.products(node)
+
+    def _session_is_stale(state) -> bool:
+        """The product keyboard the user sees was built from an older catalog version."""
+        version = state.get("catalog_version")
+        return state.get("node") is not None and version is not None and version != catalog.current_version()
+
+    async def _refresh_stale_products(message: types.Message, state):
+        """Button from an outdated keyboard (product renamed/removed): resend the current page."""
+        await message.answer("Меню обновилось — вот актуальный список 👇")
+        state.pop("category_photo_message_id", None)
+        await show_category_products_keyboard(message, int(state.get("page") or 0))
 
     async def notify_client_status(order_id: int, status_text: str):
         cur.execute("SELECT user_id FROM orders WHERE id=? AND bot_id=?", (order_id, bot_id))
@@ -87,15 +163,12 @@ async def launch_bot(bot_id: int, token: str, username: str):
     def _get_bot_payment_settings(_bot_id: int | None = None):
         bid = _bot_id if _bot_id is not None else bot_id
         try:
-            cur.execute("SELECT payments_enabled, payment_provider_token FROM bots WHERE bot_id=?", (bid,))
-            row = cur.fetchone()
+            settings = bot_settings.get(bid)
         except Exception:
-            row = None
-        enabled = int(row[0] or 0) if row else 0
-        token = (row[1] or '').strip() if row else ''
-        if not token:
-            token = None
-        return {'enabled': enabled, 'provider_token': token}
+            settings = None
+        if settings is None:
+            return {'enabled': 0, 'provider_token': None}
+        return {'enabled': settings.payments_enabled, 'provider_token': settings.payment_provider_token}
 
     async def send_invoice_for_order(order_id: int, uid: int, temp_items: list | None = None) -> bool:
         settings = _get_bot_payment_settings()
@@ -219,7 +292,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             return
         await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
-    @dp.message(lambda m: getattr(m, 'successful_payment', None) is not None)
+    @router.message(where=lambda m: getattr(m, 'successful_payment', None) is not None)
     async def _successful_payment(message: types.Message):
         sp = message.successful_payment
         order_id = _parse_invoice_payload(sp.invoice_payload)
@@ -246,15 +319,15 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await show_main_menu(message)
 
     # /команды из синей кнопки "Меню"
-    @dp.message(Command("menu"))
+    @router.message(command="menu")
     async def cmd_menu(message: types.Message):
         await show_full_menu(message)
 
-    @dp.message(Command("cart"))
+    @router.message(command="cart")
     async def cmd_cart(message: types.Message):
         await show_cart(message)
 
-    @dp.message(Command("status"))
+    @router.message(command="status")
     async def cmd_status(message: types.Message):
         await show_orders_list(message)
     # === БОНУСНАЯ СИСТЕМА: helpers ===
@@ -266,17 +339,12 @@ async def launch_bot(bot_id: int, token: str, username: str):
         - legacy-алиасы (как раньше в коде): enabled, percent, max_pay_percent, ...
         """
         bid = _bot_id if _bot_id is not None else bot_id
-        cur.execute(
-            "SELECT bonuses_enabled, bonus_percent, max_bonus_pay_percent, min_order_for_bonus, bonus_expire_days "
-            "FROM bots WHERE bot_id=?",
-            (bid,)
-        )
-        row = cur.fetchone()
-        enabled = int(row[0] or 0) if row else 0
-        percent = int(row[1] or 0) if row else 0
-        max_pay_percent = int(row[2] or 0) if row else 0
-        min_order = int(row[3] or 0) if row else 0
-        expire_days = int(row[4] or 0) if row else 0
+        settings = bot_settings.get(bid)
+        enabled = settings.bonuses_enabled if settings else 0
+        percent = settings.bonus_percent if settings else 0
+        max_pay_percent = settings.max_bonus_pay_percent if settings else 0
+        min_order = settings.min_order_for_bonus if settings else 0
+        expire_days = settings.bonus_expire_days if settings else 0
 
         return {
             # canonical keys
@@ -397,8 +465,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         conn.commit()
     # === ГЛАВНОЕ МЕНЮ ===
     def is_cashier(user_id: int) -> bool:
-        cur.execute("SELECT 1 FROM cashiers WHERE bot_id=? AND cashier_id=?", (bot_id, user_id))
-        return cur.fetchone() is not None
+        return cashier_index.is_cashier(bot_id, user_id)
 
     def _extract_start_payload(text: str) -> str:
         if not text:
@@ -467,11 +534,10 @@ async def launch_bot(bot_id: int, token: str, username: str):
             reply_markup=kb
         )
 
-    async def show_main_menu(message_or_callback: types.Message | types.CallbackQuery):
+    def _build_main_menu_kb(cashier: bool) -> ReplyKeyboardMarkup:
         # Получаем настройку бонусов
-        cur.execute("SELECT bonuses_enabled FROM bots WHERE bot_id=?", (bot_id,))
-        row = cur.fetchone()
-        bonuses_enabled = row[0] if row else 1
+        settings = bot_settings.get(bot_id)
+        bonuses_enabled = settings.bonuses_enabled if settings else 1
         # Базовая клавиатура
         kb_buttons = [
             [KeyboardButton(text="Меню"), KeyboardButton(text="Корзина")],
@@ -488,11 +554,15 @@ async def launch_bot(bot_id: int, token: str, username: str):
                 [KeyboardButton(text="Меню"), KeyboardButton(text="Корзина")],
                 [KeyboardButton(text="Статус заказа"), KeyboardButton(text="О нас")]
             ]
-        uid = message_or_callback.from_user.id
-        if is_cashier(uid):
+        if cashier:
             kb_buttons.append([KeyboardButton(text="Кассир")])
 
-        kb = ReplyKeyboardMarkup(keyboard=kb_buttons, resize_keyboard=True)
+        return ReplyKeyboardMarkup(keyboard=kb_buttons, resize_keyboard=True)
+
+    async def show_main_menu(message_or_callback: types.Message | types.CallbackQuery):
+        uid = message_or_callback.from_user.id
+        role = "cashier" if is_cashier(uid) else "client"
+        kb = _cached_keyboard(("main", role), lambda: _build_main_menu_kb(role == "cashier"))
         if isinstance(message_or_callback, types.CallbackQuery):
             await message_or_callback.message.answer("Вы в главном меню", reply_markup=kb)
             await message_or_callback.answer()
@@ -570,7 +640,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Отмена")]], resize_keyboard=True)
         await message.answer("Укажите адрес доставки:", reply_markup=kb)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_address_confirm"))
+    @router.message(flag="awaiting_address_confirm")
     async def address_confirm_step(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -607,7 +677,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         await message.answer("Пожалуйста, выберите вариант кнопками ниже.")
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_address_input"))
+    @router.message(flag="awaiting_address_input")
     async def address_input_step(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -647,29 +717,13 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await _start_comment_step(message, delivery_type, temp_items, phone, address, prev)
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "category_products" and m.text == "Корзина")
+    @router.message(state="category_products", text="Корзина")
     async def go_to_cart_from_category(message: types.Message):
-        uid = message.from_user.id
-        # Сохраняем состояние категории перед уходом в корзину
-        if uid in user_state:
-            user_state[uid]["previous_state"] = {
-                "type": "category_products",
-                "cat_id": user_state[uid].get("cat_id"),
-                "prods": user_state[uid].get("prods"),
-                "page": user_state[uid].get("page", 0),
-                "cat_name": user_state[uid].get("cat_name"),
-                "cat_photo_path": user_state[uid].get("cat_photo_path"),
-                "back_mode": user_state[uid].get("back_mode"),
-                "back_cat_id": user_state[uid].get("back_cat_id"),
-                "back_cat_name": user_state[uid].get("back_cat_name"),
-                "categories_page": user_state[uid].get("categories_page"),
-                "sub_page": user_state[uid].get("sub_page"),
-                "parent_page": user_state[uid].get("parent_page"),
-            }
+        # show_cart запомнит текущую запись категории как previous_state (ссылкой)
         await show_cart(message)
     
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "category_products" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT])
+    @router.message(state="category_products", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)
     async def category_pagination(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -684,7 +738,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         state["page"] = page
         await show_category_products_keyboard(message, page)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "category_products" and m.text == "Назад")
+    @router.message(state="category_products", text="Назад")
     async def back_to_categories_from_products(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -728,7 +782,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
 
     #"НА ГЛАВНУЮ"
-    @dp.message(lambda m: m.text == "На главную")
+    @router.message(text="На главную")
     async def go_main_menu(message: types.Message):
         uid = message.from_user.id
         if uid in user_state:
@@ -750,6 +804,39 @@ async def launch_bot(bot_id: int, token: str, username: str):
             rows.append([InlineKeyboardButton(text="Отменить", callback_data=f"order_cancel*{order_id}")])
         return InlineKeyboardMarkup(inline_keyboard=rows)
 # ======== Карточка товара перед добавлением в корзину (выбор количества) ========
+    # Степпер количества — инлайн-кнопки под карточкой: "+1"/"-1" меняют только подпись
+    # и клавиатуру этого сообщения, данные товара берутся из сессии (читаются один раз)
+
+    def _pick_card_text(state) -> str:
+        qty = int(state.get("qty") or 1)
+        price = int(state.get("price") or 0)
+        text = f"<b>{state.get('name')}</b>\n"
+        if state.get("description"):
+            text += f"{state.get('description')}\n\n"
+        text += f"Цена: <b>{price} ₽</b>\nКоличество: <b>{qty} шт</b>\nСумма: <b>{price * qty} ₽</b>"
+        return text
+
+    def _pick_card_kb(prod_id: int, qty: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="-1", callback_data=f"pk:dec:{prod_id}"),
+                InlineKeyboardButton(text=f"{qty} шт", callback_data=f"pk:x:{prod_id}"),
+                InlineKeyboardButton(text="+1", callback_data=f"pk:inc:{prod_id}"),
+            ],
+            [InlineKeyboardButton(text="Добавить", callback_data=f"pk:add:{prod_id}")],
+            [InlineKeyboardButton(text="Назад", callback_data=f"pk:back:{prod_id}")],
+        ])
+
+    async def _edit_card(message: types.Message, text: str, kb: InlineKeyboardMarkup | None):
+        """Правит подпись (или текст) и клавиатуру карточки, не трогая фото."""
+        try:
+            if message.photo:
+                await message.edit_caption(caption=text, parse_mode="HTML", reply_markup=kb)
+            else:
+                await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                print("Не удалось обновить карточку товара:", e)
 
     async def show_product_pick_card(message: types.Message):
         uid = message.from_user.id
@@ -762,53 +849,117 @@ async def launch_bot(bot_id: int, token: str, username: str):
         qty = max(1, min(qty, 99))
         state["qty"] = qty
 
-        cur.execute("SELECT name, price, description, photo_path FROM products WHERE id=? AND enabled=1", (prod_id,))
-        row = cur.fetchone()
-        if not row:
-            # Товар удалён/выключен — возвращаемся назад
-            prev = state.get("previous_state", {})
-            user_state[uid] = prev if prev else {}
-            await message.answer("Товар недоступен.")
-            if user_state.get(uid, {}).get("type") == "category_products":
-                await show_category_products_keyboard(message, user_state[uid].get("page", 0))
-            else:
-                await show_main_menu(message)
-            return
-
-        name, price, description, photo_path = row
-        description = description or ""
-        total = int(price) * qty
-
-        text = f"<b>{name}</b>\n"
-        if description:
-            text += f"{description}\n\n"
-        text += f"Цена: <b>{price} ₽</b>\nКоличество: <b>{qty} шт</b>\nСумма: <b>{total} ₽</b>"
+        if state.get("name") is None:
+            cur.execute("SELECT name, price, description, photo_path FROM products WHERE id=? AND enabled=1", (prod_id,))
+            row = cur.fetchone()
+            if not row:
+                # Товар удалён/выключен — возвращаемся назад
+                prev = state.get("previous_state", {})
+                await message.answer("Товар недоступен.")
+                await _return_from_product_pick(message, prev)
+                return
+            name, price, description, photo_path = row
+            state["name"] = name
+            state["price"] = int(price)
+            state["description"] = description or ""
+            state["photo_path"] = photo_path
 
-        kb = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="-1"), KeyboardButton(text=f"{qty} шт"), KeyboardButton(text="+1")],
-                [KeyboardButton(text="Добавить")],
-                [KeyboardButton(text="Назад")],
-                [KeyboardButton(text="На главную")],
-            ],
-            resize_keyboard=True
-        )
+        text = _pick_card_text(state)
+        kb = _pick_card_kb(prod_id, qty)
 
+        photo_path = state.get("photo_path")
         if photo_path:
             try:
-                await message.answer_photo(FSInputFile(photo_path), caption=text, parse_mode="HTML", reply_markup=kb)
+                sent = await message.answer_photo(_nav_photo_input(photo_path), caption=text, parse_mode="HTML", reply_markup=kb)
+                _nav_remember_photo(photo_path, sent)
                 return
             except Exception as e:
+                nav_photo_ids.pop(photo_path, None)
                 print("Не удалось отправить фото товара:", e)
 
         await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "product_pick")
+    def _add_picked_to_cart(uid: int, state) -> str:
+        prod_id = int(state.get("prod_id") or 0)
+        qty = max(1, int(state.get("qty") or 1))
+        cur.execute(
+            """INSERT INTO cart (bot_id, user_id, prod_id, quantity)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(bot_id, user_id, prod_id)
+               DO UPDATE SET quantity = cart.quantity + EXCLUDED.quantity""",
+            (bot_id, uid, prod_id, qty)
+        )
+        conn.commit()
+        return f"✅ Добавлено в корзину: {state.get('name') or 'Товар'} ×{qty}"
+
+    async def _return_from_product_pick(message: types.Message, prev, card: types.Message | None = None):
+        """Back to the product list the card was opened from (reply keyboard or inline menu).
+
+        card: the product card message when called from its inline buttons — the inline
+        menu then replaces the card in place instead of sending a new message.
+        """
+        uid = message.from_user.id
+        if prev and prev.get("type") == "catalog_inline":
+            if card is not None:
+                user_state[uid] = prev
+                # на карточке фото товара, а не меню — пусть _nav_show сменит его
+                prev["nav_photo"] = None
+                prev["nav_caption"] = None
+                await _nav_show(uid, card, tuple(prev.get("nav_view") or ("c", 0)), edit=True)
+                return
+            await _nav_resume(message, prev)
+            return
+        if card is not None:
+            # reply-меню: убираем степпер со старой карточки
+            try:
+                await card.edit_reply_markup(reply_markup=None)
+            except TelegramBadRequest:
+                pass
+        user_state[uid] = prev if prev else {}
+        if user_state.get(uid, {}).get("type") == "category_products":
+            await show_category_products_keyboard(message, user_state[uid].get("page", 0))
+        else:
+            await show_main_menu(message)
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith("pk:"))
+    async def product_pick_callback(callback: types.CallbackQuery):
+        if not callback.message:
+            return
+        uid = callback.from_user.id
+        action, _, raw_id = callback.data[3:].partition(":")
+        state = user_state.get(uid, {})
+        if state.get("type") != "product_pick" or str(state.get("prod_id")) != raw_id or state.get("name") is None:
+            await callback.answer("Карточка устарела, откройте товар заново")
+            return
+
+        if action in ("inc", "dec"):
+            qty = int(state.get("qty") or 1)
+            new_qty = min(99, qty + 1) if action == "inc" else max(1, qty - 1)
+            if new_qty != qty:
+                state["qty"] = new_qty
+                await _edit_card(callback.message, _pick_card_text(state), _pick_card_kb(int(raw_id), new_qty))
+            await callback.answer()
+            return
+
+        if action == "add":
+            await callback.answer(_add_picked_to_cart(uid, state))
+            await _return_from_product_pick(_callback_message(callback), state.get("previous_state", {}), card=callback.message)
+            return
+
+        if action == "back":
+            await callback.answer()
+            await _return_from_product_pick(_callback_message(callback), state.get("previous_state", {}), card=callback.message)
+            return
+
+        await callback.answer()
+
+    @router.message(state="product_pick")
     async def product_pick_handler(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
         text = (message.text or "").strip()
 
+        # Кнопки старой reply-клавиатуры карточки ("+1"/"-1") — работают как раньше
         if text == "+1":
             state["qty"] = min(99, int(state.get("qty", 1)) + 1)
             await show_product_pick_card(message)
@@ -820,41 +971,12 @@ async def launch_bot(bot_id: int, token: str, username: str):
             return
 
         if text == "Добавить":
-            prod_id = int(state.get("prod_id") or 0)
-            qty = max(1, int(state.get("qty") or 1))
-
-            # имя — просто для красивого подтверждения
-            cur.execute("SELECT name FROM products WHERE id=?", (prod_id,))
-            r = cur.fetchone()
-            prod_name = r[0] if r else "Товар"
-
-            cur.execute(
-                """INSERT INTO cart (bot_id, user_id, prod_id, quantity)
-                   VALUES (?, ?, ?, ?)
-                   ON CONFLICT(bot_id, user_id, prod_id)
-                   DO UPDATE SET quantity = cart.quantity + EXCLUDED.quantity""",
-                (bot_id, uid, prod_id, qty)
-            )
-            conn.commit()
-
-            prev = state.get("previous_state", {})
-            user_state[uid] = prev if prev else {}
-
-            await message.answer(f"✅ Добавлено в корзину: {prod_name} ×{qty}")
-
-            if user_state.get(uid, {}).get("type") == "category_products":
-                await show_category_products_keyboard(message, user_state[uid].get("page", 0))
-            else:
-                await show_main_menu(message)
+            await message.answer(_add_picked_to_cart(uid, state))
+            await _return_from_product_pick(message, state.get("previous_state", {}))
             return
 
         if text == "Назад":
-            prev = state.get("previous_state", {})
-            user_state[uid] = prev if prev else {}
-            if user_state.get(uid, {}).get("type") == "category_products":
-                await show_category_products_keyboard(message, user_state[uid].get("page", 0))
-            else:
-                await show_main_menu(message)
+            await _return_from_product_pick(message, state.get("previous_state", {}))
             return
 
         if text == "На главную":
@@ -862,39 +984,47 @@ async def launch_bot(bot_id: int, token: str, username: str):
             await show_main_menu(message)
             return
 
+        # Под карточкой осталась клавиатура списка товаров — открываем выбранный товар
+        prev = state.get("previous_state")
+        if prev and prev.get("type") == "category_products":
+            prod_id = _session_products(prev).resolve(text)
+            if prod_id:
+                user_state[uid] = {"type": "product_pick", "prod_id": prod_id, "qty": 1, "previous_state": prev}
+                await show_product_pick_card(message)
+            elif _session_is_stale(prev):
+                user_state[uid] = prev
+                await _refresh_stale_products(message, prev)
         # Нажатие на "N шт" или любой другой текст — просто игнорируем
         return
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "category_products")
+    @router.message(state="category_products")
     async def add_product_from_keyboard(message: types.Message):
         uid = message.from_user.id
         state = user_state[uid]
-        prods = state["prods"]
         prod_name = (message.text or "").strip()
 
         # системные кнопки не трогаем
         if prod_name in [MENU_NAV_PREV, MENU_NAV_NEXT, "Назад", "Корзина", "На главную"]:
             return
 
-        # Находим prod_id по имени
-        prod_id = next((p[0] for p in prods if p[1] == prod_name), None)
+        # Находим prod_id по имени (словарь в общем индексе каталога)
+        prod_id = _session_products(state).resolve(prod_name)
         if not prod_id:
+            if _session_is_stale(state):
+                await _refresh_stale_products(message, state)
             return
 
-        # Сохраняем ТЕКУЩЕЕ состояние категории, чтобы вернуться на ту же страницу
-        prev_state = state.copy()
-        prev_state["type"] = "category_products"
-
+        # Запоминаем ТЕКУЩЕЕ состояние категории (ссылкой), чтобы вернуться на ту же страницу
         user_state[uid] = {
             "type": "product_pick",
             "prod_id": prod_id,
             "qty": 1,
-            "previous_state": prev_state
+            "previous_state": state
         }
 
         await show_product_pick_card(message)
 
-    @dp.message(CommandStart())
+    @router.message(command="start")
     async def cmd_start(message: types.Message):
         uid = message.from_user.id
         payload = _extract_start_payload(message.text or "")
@@ -915,10 +1045,9 @@ async def launch_bot(bot_id: int, token: str, username: str):
             conn.commit()
 
             # Приветственный бонус — отдельная логика (только для нового клиента)
-            cur.execute("SELECT welcome_bonus, bonuses_enabled FROM bots WHERE bot_id=?", (bot_id,))
-            bot_settings = cur.fetchone()
-            if bot_settings and bot_settings[1] == 1 and bot_settings[0] > 0:
-                welcome = bot_settings[0]
+            settings = bot_settings.get(bot_id)
+            if settings and settings.bonuses_enabled == 1 and settings.welcome_bonus > 0:
+                welcome = settings.welcome_bonus
                 # начисляем бонус через транзакции (clients.points — это кэш)
                 try:
                     add_bonus_tx(uid, welcome, None, comment="welcome")
@@ -935,23 +1064,23 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await show_main_menu(message)
 
     # === Slash-команды (для синей кнопки «Меню») ===
-    @dp.message(Command("menu"))
+    @router.message(command="menu")
     async def cmd_menu(message: types.Message):
         # Аналог кнопки «Меню»
         await show_full_menu(message)
 
-    @dp.message(Command("cart"))
+    @router.message(command="cart")
     async def cmd_cart(message: types.Message):
         # Аналог кнопки «Корзина»
         await show_cart(message)
 
-    @dp.message(Command("status"))
+    @router.message(command="status")
     async def cmd_status(message: types.Message):
         # Аналог кнопки «Статус заказа»
         await show_orders_list(message)
 
     # Доставка
-    @dp.message(lambda m: m.text == "Кассир")
+    @router.message(text="Кассир")
     async def cashier_menu(message: types.Message):
         uid = message.from_user.id
         if not is_cashier(uid):
@@ -967,7 +1096,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             reply_markup=kb
         )
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cashier_accrual")
+    @router.message(state="cashier_accrual")
     async def cashier_accrual_amount(message: types.Message):
         cashier_uid = message.from_user.id
         if not is_cashier(cashier_uid):
@@ -1020,7 +1149,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await message.answer(f"✅ Начислено: {points} бонусов\nКлиент: {client_uid}\nНовый баланс: {balance}")
         await show_main_menu(message)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cashier_op_select")
+    @router.message(state="cashier_op_select")
     async def cashier_choose_op(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -1061,7 +1190,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         await message.answer("Выберите действие кнопками ниже.")
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cashier_writeoff_purchase")
+    @router.message(state="cashier_writeoff_purchase")
     async def cashier_writeoff_purchase(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -1124,7 +1253,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             reply_markup=kb
         )
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cashier_writeoff_amount")
+    @router.message(state="cashier_writeoff_amount")
     async def cashier_writeoff_amount(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -1204,7 +1333,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await message.answer(text_out)
         await cashier_menu(message)
 
-    @dp.message(lambda m: m.text == "Статус заказа")
+    @router.message(text="Статус заказа")
     async def show_orders_list(message: types.Message):
         uid = message.from_user.id
         cur.execute("""SELECT id, created_at, total, status, delivery_type
@@ -1268,7 +1397,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         kb = ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
         await message.answer(text, parse_mode="HTML", reply_markup=kb)
     # === ЛИСТАНИЕ ЗАКАЗОВ + ОТМЕНА СО СТОРОНЫ КЛИЕНТА ===
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "orders" and (
+    @router.message(state="orders", where=lambda m: (
     (m.text or "").strip() in ["⬅️", "➡️", "Предыдущий", "Следующий", "На главную", "Отменить заказ", "Оплатить"]
     or re.fullmatch(r"\d+/\d+", (m.text or "").strip())
 ))
@@ -1329,7 +1458,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         state["index"] = index
         await show_order_detail(message, orders, index)
     # === ФИНАЛЬНАЯ ОТМЕНА ПОСЛЕ ВЫБОРА ПРИЧИНЫ (ПЕРВЫЙ ОБРАБОТЧИК!) ===
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_cancel_reason") is not None)
+    @router.message(flag="awaiting_cancel_reason", flag_not_none=True)
     async def client_cancel_with_reason(message: types.Message):
         uid = message.from_user.id
         order_id = user_state[uid]["awaiting_cancel_reason"]
@@ -1377,7 +1506,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         else:
             await message.answer("Заказ уже нельзя отменить.", reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="На главную")]], resize_keyboard=True))
     # === ПОДТВЕРЖДЕНИЕ ОТМЕНЫ (ВТОРОЙ ОБРАБОТЧИК) ===
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_cancel_confirm") is not None)
+    @router.message(flag="awaiting_cancel_confirm", flag_not_none=True)
     async def client_cancel_confirm(message: types.Message):
         uid = message.from_user.id
         order_id = user_state[uid]["awaiting_cancel_confirm"]
@@ -1427,20 +1556,13 @@ async def launch_bot(bot_id: int, token: str, username: str):
         # Просто игнорируем другие сообщения
         return
     # === КОРЗИНА (с пролистыванием, +1/-1, удалить) ===
-    @dp.message(lambda m: m.text == "Корзина")
+    @router.message(text="Корзина")
     async def show_cart(message: types.Message):
         uid = message.from_user.id
     
-        # ИНИЦИАЛИЗИРУЕМ СЛОВАРЬ ДЛЯ ПОЛЬЗОВАТЕЛЯ, ЕСЛИ ЕГО НЕТ
-        if uid not in user_state:
-            user_state[uid] = {}
-    
-        # 1. Сохраняем текущее состояние как предыдущее
-        current_state = user_state[uid].copy() # теперь безопасно, словарь существует
-        if current_state:
-            user_state[uid]["previous_state"] = current_state
-        else:
-            user_state[uid]["previous_state"] = {"from_main_menu": True}
+        # 1. Текущее состояние становится предыдущим (ссылкой: ниже оно заменяется новой записью)
+        current_state = user_state.get(uid)
+        previous_state = current_state if current_state else {"from_main_menu": True}
     
         # 2. Загружаем товары из корзины
         cur.execute("""SELECT c.prod_id, c.quantity, p.name, p.price
@@ -1452,7 +1574,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             # фикс: задаём отдельный тип состояния, чтобы "Назад" отрабатывал
             user_state[uid] = {
                 "type": "cart_empty",
-                "previous_state": user_state[uid].get("previous_state")
+                "previous_state": previous_state
             }
 
             await message.answer(
@@ -1467,9 +1589,9 @@ async def launch_bot(bot_id: int, token: str, username: str):
         # 3. УСТАНАВЛИВАЕМ СОСТОЯНИЕ КОРЗИНЫ
         user_state[uid] = {
             "type": "cart_view",
-            "items": [(row[0], row[1], row[2], row[3]) for row in items],
+            "cart_items": [(row[0], row[1], row[2], row[3]) for row in items],
             "page": 0,
-            "previous_state": user_state[uid].get("previous_state")
+            "previous_state": previous_state
         }
     
         # 4. Показываем корзину
@@ -1480,7 +1602,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         if state.get("type") != "cart_view":
             return
     
-        items = state["items"] # (prod_id, quantity, name, price)
+        items = state["cart_items"] # (prod_id, quantity, name, price)
         total_sum = sum(qty * price for _, qty, _, price in items)
     
         # Формируем полный список для сообщения
@@ -1516,61 +1638,180 @@ async def launch_bot(bot_id: int, token: str, username: str):
     
         await message.answer(full_text, parse_mode="HTML", reply_markup=kb)
         # Состояние для карточки товара в корзине
-    async def show_cart_product_card(message: types.Message, items: list, index: int):
-        uid = message.from_user.id
+    def _cart_card_info(state, prod_id: int):
+        """(photo_path, description) товара корзины — читается из БД один раз на сессию корзины."""
+        cache = state.get("card_cache")
+        if cache is None:
+            cache = state["card_cache"] = {}
+        info = cache.get(prod_id)
+        if info is None:
+            cur.execute("""SELECT p.photo_path, p.description
+                        FROM products p WHERE p.id = ?""", (prod_id,))
+            row = cur.fetchone()
+            info = cache[prod_id] = (row[0] if row else None, row[1] if row and row[1] else "")
+        return info
+
+    def _cart_card_text(state, items: list, index: int) -> str:
         prod_id, qty, name, price = items[index]
-    
-        # Получаем полную инфу о товаре (фото, описание)
-        cur.execute("""SELECT p.photo_path, p.description
-                    FROM products p WHERE p.id = ?""", (prod_id,))
-        row = cur.fetchone()
-        photo_path = row[0] if row else None
-        description = row[1] if row and row[1] else ""
-    
+        description = _cart_card_info(state, prod_id)[1]
+
         total_price = price * qty
         total_sum = sum(quantity * price for prod_id, quantity, name, price in items)
-    
+
         text = f"<b>{name}</b>\n"
         if description:
             text += f"{description}\n\n"
         text += f"Цена: {price} ₽ × {qty} = <b>{total_price} ₽</b>\n\n"
         text += f"Товар {index + 1} из {len(items)}\nОбщая сумма: <b>{total_sum} ₽</b>"
-    
+        return text
+
+    def _cart_card_kb(items: list, index: int) -> InlineKeyboardMarkup:
+        prod_id, qty = items[index][0], items[index][1]
+        rows = []
         nav = []
         if index > 0:
-            nav.append(KeyboardButton(text="Предыдущий"))
+            nav.append(InlineKeyboardButton(text="Предыдущий", callback_data=f"ct:prev:{prod_id}"))
         if index < len(items) - 1:
-            nav.append(KeyboardButton(text="Следующий"))
-    
-        kb = ReplyKeyboardMarkup(keyboard=[
-            nav if nav else [],
-            [KeyboardButton(text="-1"), KeyboardButton(text=f"{qty} шт"), KeyboardButton(text="+1")],
-            [KeyboardButton(text="Удалить")],
-            [KeyboardButton(text="Назад в корзину")]
-        ], resize_keyboard=True)
-    
+            nav.append(InlineKeyboardButton(text="Следующий", callback_data=f"ct:next:{prod_id}"))
+        if nav:
+            rows.append(nav)
+        rows.append([
+            InlineKeyboardButton(text="-1", callback_data=f"ct:dec:{prod_id}"),
+            InlineKeyboardButton(text=f"{qty} шт", callback_data=f"ct:x:{prod_id}"),
+            InlineKeyboardButton(text="+1", callback_data=f"ct:inc:{prod_id}"),
+        ])
+        rows.append([InlineKeyboardButton(text="Удалить", callback_data=f"ct:del:{prod_id}")])
+        rows.append([InlineKeyboardButton(text="Назад в корзину", callback_data=f"ct:list:{prod_id}")])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    async def show_cart_product_card(message: types.Message, items: list, index: int):
+        uid = message.from_user.id
+        state = user_state[uid]
+        prod_id = items[index][0]
+        photo_path = _cart_card_info(state, prod_id)[0]
+
+        text = _cart_card_text(state, items, index)
+        kb = _cart_card_kb(items, index)
+
         if photo_path:
-            await message.answer_photo(FSInputFile(photo_path), caption=text, parse_mode="HTML", reply_markup=kb)
+            sent = await message.answer_photo(_nav_photo_input(photo_path), caption=text, parse_mode="HTML", reply_markup=kb)
+            _nav_remember_photo(photo_path, sent)
         else:
             await message.answer(text, parse_mode="HTML", reply_markup=kb)
     
         # Сохраняем индекс для навигации
-        user_state[uid]["cart_item_index"] = index
+        state["cart_item_index"] = index
+
+    async def _switch_cart_card(callback: types.CallbackQuery, state, items: list, index: int):
+        """Предыдущий/Следующий из инлайн-карточки: меняем фото только если оно другое."""
+        state["cart_item_index"] = index
+        card = callback.message
+        photo_path = _cart_card_info(state, items[index][0])[0]
+        text = _cart_card_text(state, items, index)
+        kb = _cart_card_kb(items, index)
+        try:
+            if card.photo and photo_path:
+                sent = await card.edit_media(
+                    types.InputMediaPhoto(media=_nav_photo_input(photo_path), caption=text, parse_mode="HTML"),
+                    reply_markup=kb,
+                )
+                _nav_remember_photo(photo_path, sent)
+                return
+            if not card.photo and not photo_path:
+                await card.edit_text(text, parse_mode="HTML", reply_markup=kb)
+                return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            print("Не удалось обновить карточку товара:", e)
+        # фото <-> текст на месте не поменять — убираем старые кнопки и шлём новую карточку
+        try:
+            await card.edit_reply_markup(reply_markup=None)
+        except TelegramBadRequest:
+            pass
+        await show_cart_product_card(_callback_message(callback), items, index)
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith("ct:"))
+    async def cart_card_callback(callback: types.CallbackQuery):
+        if not callback.message:
+            return
+        uid = callback.from_user.id
+        action, _, raw_id = callback.data[3:].partition(":")
+        state = user_state.get(uid, {})
+        items = (state.get("cart_items") or []) if state.get("type") == "cart_view" else []
+        index = next((i for i, item in enumerate(items) if str(item[0]) == raw_id), None)
+        if index is None:
+            await callback.answer("Карточка устарела, откройте корзину заново")
+            return
+        prod_id = items[index][0]
+
+        if action in ("inc", "dec"):
+            qty = items[index][1]
+            new_qty = min(99, qty + 1) if action == "inc" else max(1, qty - 1)
+            if new_qty != qty:
+                items[index] = (prod_id, new_qty, items[index][2], items[index][3])
+                cur.execute("UPDATE cart SET quantity = ? WHERE bot_id=? AND user_id=? AND prod_id=?",
+                            (new_qty, bot_id, uid, prod_id))
+                conn.commit()
+                state["cart_item_index"] = index
+                await _edit_card(callback.message, _cart_card_text(state, items, index), _cart_card_kb(items, index))
+            await callback.answer()
+            return
+
+        if action in ("prev", "next"):
+            new_index = max(0, index - 1) if action == "prev" else min(len(items) - 1, index + 1)
+            await callback.answer()
+            if new_index != index:
+                await _switch_cart_card(callback, state, items, new_index)
+            return
+
+        if action == "del":
+            cur.execute("DELETE FROM cart WHERE bot_id=? AND user_id=? AND prod_id=?",
+                        (bot_id, uid, prod_id))
+            conn.commit()
+            del items[index]
+            await callback.answer()
+
+            if not items:
+                user_state.pop(uid, None)
+                await _edit_card(callback.message, "Корзина очищена!", None)
+                await callback.message.answer(
+                    "Корзина очищена!",
+                    reply_markup=ReplyKeyboardMarkup(
+                        keyboard=[[KeyboardButton(text="На главную")]],
+                        resize_keyboard=True
+                    )
+                )
+                return
+
+            await _switch_cart_card(callback, state, items, min(index, len(items) - 1))
+            return
+
+        if action == "list":
+            await callback.answer()
+            state.pop("cart_item_index", None)
+            try:
+                await callback.message.edit_reply_markup(reply_markup=None)
+            except TelegramBadRequest:
+                pass
+            await show_cart_full_list_and_keyboard(_callback_message(callback), state.get("page", 0))
+            return
+
+        await callback.answer()
     # Навигация и действия в карточке товара
     SYSTEM_BTNS = {
     "⬅️", "➡️", "Назад", "Заказать",
     "Назад в корзину", "Предыдущий", "Следующий",
     "+1", "-1", "Удалить", "На главную"
     }
-    @dp.message(lambda m: (
-    user_state.get(m.from_user.id, {}).get("type") == "cart_view"
-    and user_state.get(m.from_user.id, {}).get("cart_item_index") is None
+    @router.message(state="cart_view", where=lambda m: (
+    user_state[m.from_user.id].get("cart_item_index") is None
     and (m.text or "").strip() not in SYSTEM_BTNS
     ))
     async def open_cart_item_from_list(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
-        items = state.get("items", [])
+        items = state.get("cart_items", [])
         text = (message.text or "").strip()
 
         if text in SYSTEM_BTNS:
@@ -1582,14 +1823,11 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         state["cart_item_index"] = index
         await show_cart_product_card(message, items, index)
-    @dp.message(lambda m: (
-        user_state.get(m.from_user.id, {}).get("type") == "cart_view"
-        and user_state.get(m.from_user.id, {}).get("cart_item_index") is not None
-    ))
+    @router.message(state="cart_view", where=lambda m: user_state[m.from_user.id].get("cart_item_index") is not None)
     async def cart_item_navigation(message: types.Message):
         uid = message.from_user.id
         state = user_state[uid]
-        items = state["items"]
+        items = state["cart_items"]
         index = state["cart_item_index"]
 
         text = (message.text or "").strip()
@@ -1600,6 +1838,17 @@ async def launch_bot(bot_id: int, token: str, username: str):
             await show_cart_full_list_and_keyboard(message, state.get("page", 0))
             return
 
+        # Под инлайн-карточкой осталась клавиатура списка корзины — её кнопки работают как в списке
+        if text in ("⬅️", "➡️", "Заказать") or any(name == text for _, _, name, _ in items):
+            state.pop("cart_item_index", None)
+            if text == "Заказать":
+                await order_from_cart(message)
+            elif text in ("⬅️", "➡️"):
+                await cart_pagination(message)
+            else:
+                await open_cart_item_from_list(message)
+            return
+
         # ✅ Листание товаров в карточке
         if text == "Предыдущий":
             index = max(0, index - 1)
@@ -1656,7 +1905,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             return
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cart_view" and m.text in ["⬅️", "➡️"])
+    @router.message(state="cart_view", text=("⬅️", "➡️"))
     async def cart_pagination(message: types.Message):
         uid = message.from_user.id
         state = user_state[uid]
@@ -1667,7 +1916,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             page += 1
         state["page"] = page
         await show_cart_full_list_and_keyboard(message, page)
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cart_view" and m.text == "Назад")
+    @router.message(state="cart_view", text="Назад")
     async def back_from_cart(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -1676,6 +1925,10 @@ async def launch_bot(bot_id: int, token: str, username: str):
         if previous:
             # Восстанавливаем предыдущее состояние
             ptype = previous.get("type")
+            if ptype == "catalog_inline":
+                await _nav_resume(message, previous)
+                return
+
             if ptype == "category_products":
                 user_state[uid] = previous
                 await show_category_products_keyboard(message, previous.get("page", 0))
@@ -1702,11 +1955,9 @@ async def launch_bot(bot_id: int, token: str, username: str):
         uid = message.from_user.id
     
         # === ПРОВЕРКА ВРЕМЕНИ РАБОТЫ ===
-        cur.execute("""SELECT restrict_orders, timezone, work_start, work_end
-                    FROM bots WHERE bot_id = ?""", (bot_id,))
-        bot_settings = cur.fetchone()
-        if bot_settings and bot_settings[0] == 1: # если ограничение включено
-            restrict, tz_name, start_str, end_str = bot_settings
+        settings = bot_settings.get(bot_id)
+        if settings and settings.restrict_orders == 1: # если ограничение включено
+            tz_name, start_str, end_str = settings.timezone, settings.work_start, settings.work_end
             if start_str and end_str:
                 blocked = False
                 try:
@@ -1736,14 +1987,11 @@ async def launch_bot(bot_id: int, token: str, username: str):
                     return
     
         # === ДОСТУПНЫЕ СПОСОБЫ ПОЛУЧЕНИЯ ===
-        cur.execute("""SELECT allow_in_hall, allow_takeaway, allow_delivery, COALESCE(min_order_total, 0)
-                    FROM bots WHERE bot_id = ?""", (bot_id,))
-        row = cur.fetchone()
-        if not row:
+        if not settings:
             await message.answer("Ошибка настроек бота")
             return
-        allow_hall, allow_takeaway, allow_delivery, min_order_total = row
-        min_order_total = int(min_order_total or 0)
+        allow_hall, allow_takeaway, allow_delivery = settings.allow_in_hall, settings.allow_takeaway, settings.allow_delivery
+        min_order_total = settings.min_order_total
     
         # Берём товары из корзины
         cur.execute("""SELECT c.prod_id, c.quantity, p.name, p.price
@@ -1769,11 +2017,8 @@ async def launch_bot(bot_id: int, token: str, username: str):
             )
             return
 
-        # Сохраняем в состояние
-        if uid not in user_state:
-            user_state[uid] = {}
         # сохраняем товары и ПЕРЕКЛЮЧАЕМ режим, чтобы корзина не мешала
-        prev = user_state.get(uid, {}).copy()
+        prev = user_state.get(uid) or {}
         user_state[uid] = {
             "type": "delivery_type",
             "temp_order_items": items,
@@ -1800,7 +2045,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             reply_markup=kb
         )
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cart_empty" and (m.text or "").strip() == "Назад")
+    @router.message(state="cart_empty", text="Назад", strip=True)
     async def back_from_empty_cart(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -1808,6 +2053,10 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         if previous:
             ptype = previous.get("type")
+            if ptype == "catalog_inline":
+                await _nav_resume(message, previous)
+                return
+
             if ptype == "category_products":
                 user_state[uid] = previous
                 await show_category_products_keyboard(message, previous.get("page", 0))
@@ -1828,11 +2077,11 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await show_main_menu(message)
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "cart_view" and m.text == "Заказать")
+    @router.message(state="cart_view", text="Заказать")
     async def order_from_cart(message: types.Message):
         await ask_delivery_type(message)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "delivery_type")
+    @router.message(state="delivery_type")
     async def process_delivery_type(message: types.Message):
         uid = message.from_user.id
         choice = (message.text or "").strip()
@@ -1900,7 +2149,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             )
 
     # --- Телефон: подтверждение сохранённого ---
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "phone_confirm")
+    @router.message(state="phone_confirm")
     async def phone_confirm_step(message: types.Message):
         uid = message.from_user.id
         text = (message.text or "").strip()
@@ -1945,7 +2194,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await message.answer("Пожалуйста, выберите вариант кнопками ниже.")
 
     # --- Телефон: запрос контакта / переход на ручной ввод ---
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "phone_request")
+    @router.message(state="phone_request")
     async def phone_request_step(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -1993,7 +2242,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
 
     # --- Телефон: ручной ввод ---
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "phone_manual")
+    @router.message(state="phone_manual")
     async def phone_manual_step(message: types.Message):
         uid = message.from_user.id
         state = user_state.get(uid, {})
@@ -2151,10 +2400,8 @@ async def launch_bot(bot_id: int, token: str, username: str):
         )
 
         # Отправляем в чат сотрудников
-        cur.execute("SELECT notify_chat_id FROM bots WHERE bot_id=?", (bot_id,))
-        row = cur.fetchone()
-        chat_id = row[0] if row and row[0] else None
-        chat_id = normalize_notify_chat_id(chat_id)
+        settings = bot_settings.get(bot_id)
+        chat_id = settings.notify_chat_id if settings else None
 
         if chat_id:
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -2184,7 +2431,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         user_state.pop(uid, None)
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_comment"))
+    @router.message(flag="awaiting_comment")
     async def process_order_comment(message: types.Message):
         uid = message.from_user.id
         comment = (message.text or "").strip()
@@ -2241,7 +2488,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         )
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_bonus_choice"))
+    @router.message(flag="awaiting_bonus_choice")
     async def process_bonus_choice(message: types.Message):
         uid = message.from_user.id
         text = (message.text or "").strip()
@@ -2282,7 +2529,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await message.answer("Пожалуйста, выберите один из вариантов кнопками ниже.")
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("awaiting_bonus_amount"))
+    @router.message(flag="awaiting_bonus_amount")
     async def process_bonus_amount(message: types.Message):
         uid = message.from_user.id
         text = (message.text or "").strip()
@@ -2307,7 +2554,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         await _create_order_and_notify(message)
     # === ВСЕ ОСТАЛЬНЫЕ КНОПКИ (ОБЯЗАТЕЛЬНО!) ===
-    @dp.message(lambda m: m.text == "Виртуальная карта")
+    @router.message(text="Виртуальная карта")
     async def virtual_card(message: types.Message):
         uid = message.from_user.id
         cur.execute("SELECT code FROM clients WHERE bot_id=? AND user_id=?", (bot_id, uid))
@@ -2327,23 +2574,17 @@ async def launch_bot(bot_id: int, token: str, username: str):
         qrcode.make(link).save(qr_path)
         await message.answer_photo(FSInputFile(qr_path), caption=f"Твоя карта\nКод: <code>{code}</code>", parse_mode="HTML")
         os.remove(qr_path)
-    @dp.message(lambda m: m.text == "Мой баланс")
-    @dp.message(lambda m: m.text == "Мой баланс")
+    @router.message(text="Мой баланс")
     async def balance(message: types.Message):
         uid = message.from_user.id
         points = get_bonus_balance(uid)
         await message.answer(f"У тебя {points} бонусов")
-    @dp.message(lambda m: m.text == "О нас")
+    @router.message(text="О нас")
     async def about(message: types.Message):
-        cur.execute("SELECT about FROM bots WHERE bot_id=?", (bot_id,))
-        row = cur.fetchone()
-        text = row[0] if row and row[0] else "Скоро всё будет"
+        settings = bot_settings.get(bot_id)
+        text = settings.about if settings and settings.about else "Скоро всё будет"
         await message.answer(text)
     # ===== Меню: категории / подкатегории (2 уровня) =====
-    MENU_PAGE_SIZE = 8
-    MENU_NAV_PREV = "◀️"
-    MENU_NAV_NEXT = "▶️"
-    MENU_PAGE_PREFIX = "Стр."
 
     def _clamp_page(page: int, total_pages: int) -> int:
         if total_pages <= 1:
@@ -2362,59 +2603,95 @@ async def launch_bot(bot_id: int, token: str, username: str):
         # Теперь ничего не удаляем — как в пролистывании товаров.
         st.pop("menu_message_id", None)
 
-    async def show_categories_only(message: types.Message, page: int | None = None):
-        uid = message.from_user.id
+    MENU_BOTTOM_CATEGORIES = (("Назад",),)
+    MENU_BOTTOM_NODE = (("Назад", "Корзина"), ("На главную",))
 
-        prev = user_state.get(uid, {})
-        is_paging = prev.get("type") == "categories"
-        if is_paging:
-            await _delete_prev_menu_message(message, prev)
-            if page is None:
-                page = int(prev.get("page") or 0)
-        else:
-            if page is None:
-                page = 0
+    def _menu_reply_kb(visible: list[str], page: int, pages: int, bottom) -> ReplyKeyboardMarkup:
+        keyboard_rows = []
+        # компактно: 2 кнопки в ряд
+        for i in range(0, len(visible), 2):
+            keyboard_rows.append([KeyboardButton(text=t) for t in visible[i:i + 2]])
+
+        if pages > 1:
+            keyboard_rows.append([
+                KeyboardButton(text=MENU_NAV_PREV),
+                KeyboardButton(text=f"{MENU_PAGE_PREFIX} {page + 1}/{pages}"),
+                KeyboardButton(text=MENU_NAV_NEXT),
+            ])
+
+        keyboard_rows.extend([KeyboardButton(text=t) for t in row] for row in bottom)
+        return ReplyKeyboardMarkup(keyboard=keyboard_rows, resize_keyboard=True)
 
+    def _load_category_titles():
+        """title -> {id, name, photo_path} и порядок названий (с количеством в скобках)."""
         # Показываем только включённые категории
         cur.execute(
             "SELECT id, name, photo_path FROM categories WHERE bot_id=? AND enabled=1 ORDER BY sort_order, id",
             (bot_id,),
         )
-        cats = cur.fetchall()
-        if not cats:
-            user_state.pop(uid, None)
-            await message.answer("Категории ещё не добавлены.")
-            return
-
         mapping: dict[str, dict] = {}
         ordered_titles: list[str] = []
-        for cat_id, name, photo_path in cats:
+        for cat_id, name, photo_path in cur.fetchall():
             title = title_for_category(conn, bot_id, int(cat_id), name)
             # защита от дублей (на всякий)
             if title in mapping:
                 title = f"{title} #{cat_id}"
             mapping[title] = {"id": int(cat_id), "name": name, "photo_path": photo_path}
             ordered_titles.append(title)
+        return mapping, ordered_titles
 
-        visible, page, pages = _page_slice(ordered_titles, int(page or 0), MENU_PAGE_SIZE)
+    def _load_subcategory_titles(cat_id: int, parent_subcat_id: int | None, kind: str):
+        subs = db_get_subcategories(conn, bot_id, cat_id, parent_subcat_id=parent_subcat_id, include_disabled=False)
+        mapping: dict[str, dict] = {}
+        titles: list[str] = []
+        for sub_id, _b, _c, name, _en, _sort, sub_photo_path, _parent in subs:
+            t = title_for_subcategory(conn, bot_id, int(sub_id), name)
+            if t in mapping:
+                t = f"{t} #{sub_id}"
+            mapping[t] = {"kind": kind, "id": int(sub_id), "name": name, "photo_path": sub_photo_path}
+            titles.append(t)
+        return mapping, titles
 
-        keyboard_rows = []
-        # компактно: 2 кнопки в ряд
-        for i in range(0, len(visible), 2):
-            row = [KeyboardButton(text=visible[i])]
-            if i + 1 < len(visible):
-                row.append(KeyboardButton(text=visible[i + 1]))
-            keyboard_rows.append(row)
+    def _load_menu_cover():
+        try:
+            cur.execute(
+                "SELECT photo_path FROM menu_photos WHERE bot_id=? ORDER BY sort_order, id LIMIT 1",
+                (bot_id,),
+            )
+            row = cur.fetchone()
+            return row[0] if row and row[0] else None
+        except Exception:
+            return None
 
-        if pages > 1:
-            keyboard_rows.append([
-                KeyboardButton(text=MENU_NAV_PREV),
-                KeyboardButton(text=f"{MENU_PAGE_PREFIX} {page + 1}/{pages}"),
-                KeyboardButton(text=MENU_NAV_NEXT),
-            ])
+    async def show_categories_only(message: types.Message, page: int | None = None):
+        uid = message.from_user.id
 
-        keyboard_rows.append([KeyboardButton(text="Назад")])
-        kb = ReplyKeyboardMarkup(keyboard=keyboard_rows, resize_keyboard=True)
+        if _inline_nav_enabled():
+            await _nav_show(uid, message, ("c", int(page or 0)), edit=False)
+            return
+
+        prev = user_state.get(uid, {})
+        is_paging = prev.get("type") == "categories"
+        if is_paging:
+            await _delete_prev_menu_message(message, prev)
+            if page is None:
+                page = int(prev.get("page") or 0)
+        else:
+            if page is None:
+                page = 0
+
+        # Названия с количеством и клавиатура страницы — общие на всех пользователей бота
+        mapping, ordered_titles = _cached_keyboard(("categories",), _load_category_titles)
+        if not ordered_titles:
+            user_state.pop(uid, None)
+            await message.answer("Категории ещё не добавлены.")
+            return
+
+        visible, page, pages = _page_slice(ordered_titles, int(page or 0), MENU_PAGE_SIZE)
+        kb = _cached_keyboard(
+            ("categories", page),
+            lambda: _menu_reply_kb(visible, page, pages, MENU_BOTTOM_CATEGORIES),
+        )
 
         user_state[uid] = {
             "type": "categories",
@@ -2426,18 +2703,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         
 
         caption = "Выберите категорию:"
-        cover_path = None
-        if is_paging:
-            try:
-                cur.execute(
-                    "SELECT photo_path FROM menu_photos WHERE bot_id=? ORDER BY sort_order, id LIMIT 1",
-                    (bot_id,),
-                )
-                row = cur.fetchone()
-                if row and row[0]:
-                    cover_path = row[0]
-            except Exception:
-                cover_path = None
+        cover_path = _cached_keyboard(("menu_cover",), _load_menu_cover) if is_paging else None
 
         if is_paging and cover_path and os.path.exists(cover_path):
             sent = await message.answer_photo(FSInputFile(cover_path), caption=caption, reply_markup=kb)
@@ -2468,37 +2734,15 @@ async def launch_bot(bot_id: int, token: str, username: str):
             if parent_page is None:
                 parent_page = 0
 
-        subs = db_get_subcategories(conn, bot_id, cat_id, include_disabled=False)
-        mapping: dict[str, dict] = {}
-        keyboard = []
-
-        titles: list[str] = []
-        for sub_id, _b, _c, name, _en, _sort, sub_photo_path, _parent in subs:
-            t = title_for_subcategory(conn, bot_id, int(sub_id), name)
-            if t in mapping:
-                t = f"{t} #{sub_id}"
-            mapping[t] = {"kind": "subcat", "id": int(sub_id), "name": name, "photo_path": sub_photo_path}
-            titles.append(t)
-
+        mapping, titles = _cached_keyboard(
+            ("subcategories", int(cat_id)),
+            lambda: _load_subcategory_titles(int(cat_id), None, "subcat"),
+        )
         visible, page, pages = _page_slice(titles, int(page or 0), MENU_PAGE_SIZE)
-
-        for i in range(0, len(visible), 2):
-            row = [KeyboardButton(text=visible[i])]
-            if i + 1 < len(visible):
-                row.append(KeyboardButton(text=visible[i + 1]))
-            keyboard.append(row)
-
-        if pages > 1:
-            keyboard.append([
-                KeyboardButton(text=MENU_NAV_PREV),
-                KeyboardButton(text=f"{MENU_PAGE_PREFIX} {page + 1}/{pages}"),
-                KeyboardButton(text=MENU_NAV_NEXT),
-            ])
-
-        keyboard.append([KeyboardButton(text="Назад"), KeyboardButton(text="Корзина")])
-        keyboard.append([KeyboardButton(text="На главную")])
-
-        kb = ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+        kb = _cached_keyboard(
+            ("subcategories", int(cat_id), page),
+            lambda: _menu_reply_kb(visible, page, pages, MENU_BOTTOM_NODE),
+        )
         user_state[uid] = {
             "type": "subcategories",
             "cat_id": int(cat_id),
@@ -2552,37 +2796,15 @@ async def launch_bot(bot_id: int, token: str, username: str):
             if sub_page is None:
                 sub_page = int(sub_page or 0)
 
-        subs = db_get_subcategories(conn, bot_id, cat_id, parent_subcat_id=parent_subcat_id, include_disabled=False)
-
-        mapping: dict[str, dict] = {}
-        titles: list[str] = []
-        for sub_id, _b, _c, name, _en, _sort, sub_photo_path, _parent in subs:
-            t = title_for_subcategory(conn, bot_id, int(sub_id), name)
-            if t in mapping:
-                t = f"{t} #{sub_id}"
-            mapping[t] = {"kind": "subsub", "id": int(sub_id), "name": name, "photo_path": sub_photo_path}
-            titles.append(t)
-
+        mapping, titles = _cached_keyboard(
+            ("subsubcategories", int(parent_subcat_id)),
+            lambda: _load_subcategory_titles(int(cat_id), int(parent_subcat_id), "subsub"),
+        )
         visible, page, pages = _page_slice(titles, int(page or 0), MENU_PAGE_SIZE)
-
-        keyboard = []
-        for i in range(0, len(visible), 2):
-            row = [KeyboardButton(text=visible[i])]
-            if i + 1 < len(visible):
-                row.append(KeyboardButton(text=visible[i + 1]))
-            keyboard.append(row)
-
-        if pages > 1:
-            keyboard.append([
-                KeyboardButton(text=MENU_NAV_PREV),
-                KeyboardButton(text=f"{MENU_PAGE_PREFIX} {page + 1}/{pages}"),
-                KeyboardButton(text=MENU_NAV_NEXT),
-            ])
-
-        keyboard.append([KeyboardButton(text="Назад"), KeyboardButton(text="Корзина")])
-        keyboard.append([KeyboardButton(text="На главную")])
-
-        kb = ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+        kb = _cached_keyboard(
+            ("subsubcategories", int(parent_subcat_id), page),
+            lambda: _menu_reply_kb(visible, page, pages, MENU_BOTTOM_NODE),
+        )
 
         user_state[uid] = {
             "type": "subsubcategories",
@@ -2616,7 +2838,333 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         user_state[uid]["menu_message_id"] = sent.message_id
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "categories" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT])
+    # ===== Инлайн-навигация по каталогу (bots.inline_nav) =====
+    # Одно сообщение меню: callback_data несёт id узла и страницу, листание редактирует его
+    NAV_PRODUCTS_PAGE_SIZE = 6
+    # путь к фото -> file_id уже загруженного в Telegram фото (повторно не отправляем файл)
+    nav_photo_ids: dict[str, str] = {}
+
+    def _inline_nav_enabled() -> bool:
+        settings = bot_settings.get(bot_id)
+        return bool(settings and settings.inline_nav)
+
+    def _callback_message(callback: types.CallbackQuery) -> types.Message:
+        """Сообщение меню от имени нажавшего (хендлеры берут uid из message.from_user)."""
+        return callback.message.model_copy(update={"from_user": callback.from_user})
+
+    def _nav_session(uid: int):
+        st = user_state.get(uid)
+        if st is None or st.get("type") != "catalog_inline":
+            user_state[uid] = {"type": "catalog_inline", "nav_pages": {}}
+            st = user_state[uid]
+        return st
+
+    def _nav_photo_input(photo_path: str):
+        return nav_photo_ids.get(photo_path) or FSInputFile(photo_path)
+
+    def _nav_remember_photo(photo_path: str | None, sent):
+        photos = getattr(sent, "photo", None)
+        if photo_path and photos:
+            nav_photo_ids[photo_path] = photos[-1].file_id
+
+    def _nav_category(cat_id: int):
+        cur.execute(
+            "SELECT name, photo_path FROM categories WHERE id=? AND bot_id=? AND enabled=1",
+            (cat_id, bot_id),
+        )
+        return cur.fetchone()
+
+    def _nav_subcategory(subcat_id: int):
+        cur.execute(
+            "SELECT cat_id, name, photo_path, parent_subcat_id FROM subcategories WHERE id=? AND bot_id=? AND enabled=1",
+            (subcat_id, bot_id),
+        )
+        return cur.fetchone()
+
+    def _nav_keyboard(buttons: list, page: int, pages: int, page_view, back_data: str | None, cart: bool = False):
+        """buttons: [(text, callback_data)], по 2 в ряд; page_view(page) -> callback_data страницы."""
+        rows = []
+        for i in range(0, len(buttons), 2):
+            rows.append([InlineKeyboardButton(text=t, callback_data=d) for t, d in buttons[i:i + 2]])
+        if pages > 1:
+            noop = nav_data("x")
+            rows.append([
+                InlineKeyboardButton(text=MENU_NAV_PREV, callback_data=page_view(page - 1) if page > 0 else noop),
+                InlineKeyboardButton(text=f"{MENU_PAGE_PREFIX} {page + 1}/{pages}", callback_data=noop),
+                InlineKeyboardButton(text=MENU_NAV_NEXT, callback_data=page_view(page + 1) if page < pages - 1 else noop),
+            ])
+        last = []
+        if back_data:
+            last.append(InlineKeyboardButton(text="Назад", callback_data=back_data))
+        if cart:
+            last.append(InlineKeyboardButton(text="Корзина", callback_data=nav_data("cart")))
+        if last:
+            rows.append(last)
+        rows.append([InlineKeyboardButton(text="На главную", callback_data=nav_data("home"))])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    def _nav_back_to_parent(cat_id: int, parent_subcat_id) -> str:
+        """callback_data «Назад» к списку, в котором лежит подкатегория."""
+        if parent_subcat_id:
+            return nav_data("bss", parent_subcat_id)
+        return nav_data("bs", cat_id)
+
+    def _nav_render(view: tuple):
+        """Экран для view -> (caption, photo_path, markup, view) или None, если узла больше нет.
+
+        "k"/"u" (открыть категорию / подкатегорию) раскрываются в конкретный экран здесь,
+        поэтому кнопкам не нужно заранее знать, есть ли у узла дочерние подкатегории.
+        Результат не зависит от пользователя и кэшируется в keyboards (см. _nav_screen).
+        """
+        code = view[0]
+
+        if code == "c":
+            cur.execute(
+                "SELECT id, name FROM categories WHERE bot_id=? AND enabled=1 ORDER BY sort_order, id",
+                (bot_id,),
+            )
+            cats = cur.fetchall()
+            if not cats:
+                return None
+            visible, page, pages = _page_slice(cats, view[1], MENU_PAGE_SIZE)
+            # счётчики в названиях считаем только для видимой страницы
+            buttons = [(title_for_category(conn, bot_id, int(cid), name), nav_data("k", cid)) for cid, name in visible]
+            cur.execute(
+                "SELECT photo_path FROM menu_photos WHERE bot_id=? ORDER BY sort_order, id LIMIT 1",
+                (bot_id,),
+            )
+            row = cur.fetchone()
+            kb = _nav_keyboard(buttons, page, pages, lambda p: nav_data("c", p), None)
+            return "Выберите категорию:", (row[0] if row else None), kb, ("c", page)
+
+        if code == "k":
+            cat_id = view[1]
+            if has_enabled_subcategories(conn, bot_id, cat_id):
+                return _nav_render(("s", cat_id, 0))
+            return _nav_render(("pc", cat_id, 0))
+
+        if code == "u":
+            subcat_id = view[1]
+            cur.execute(
+                "SELECT COUNT(1) FROM subcategories WHERE bot_id=? AND parent_subcat_id=? AND enabled=1",
+                (bot_id, subcat_id),
+            )
+            if int(cur.fetchone()[0] or 0) > 0:
+                return _nav_render(("ss", subcat_id, 0))
+            return _nav_render(("ps", subcat_id, 0))
+
+        if code == "s":
+            cat_id = view[1]
+            cat = _nav_category(cat_id)
+            if not cat:
+                return None
+            cat_name, cat_photo_path = cat
+            subs = db_get_subcategories(conn, bot_id, cat_id, include_disabled=False)
+            visible, page, pages = _page_slice(subs, view[2], MENU_PAGE_SIZE)
+            buttons = [
+                (title_for_subcategory(conn, bot_id, int(sub[0]), sub[3]), nav_data("u", sub[0]))
+                for sub in visible
+            ]
+            kb = _nav_keyboard(buttons, page, pages, lambda p: nav_data("s", cat_id, p),
+                               nav_data("bc"), cart=True)
+            caption = f"<b>{cat_name}</b>\nВыберите подкатегорию:"
+            return caption, cat_photo_path, kb, ("s", cat_id, page)
+
+        if code == "ss":
+            subcat_id = view[1]
+            sub = _nav_subcategory(subcat_id)
+            if not sub:
+                return None
+            cat_id, sub_name, sub_photo_path, parent_id = sub
+            cat = _nav_category(cat_id)
+            if not cat:
+                return None
+            cat_name, cat_photo_path = cat
+            children = db_get_subcategories(conn, bot_id, cat_id, parent_subcat_id=subcat_id, include_disabled=False)
+            visible, page, pages = _page_slice(children, view[2], MENU_PAGE_SIZE)
+            buttons = [
+                (title_for_subcategory(conn, bot_id, int(ch[0]), ch[3]), nav_data("u", ch[0]))
+                for ch in visible
+            ]
+            kb = _nav_keyboard(buttons, page, pages, lambda p: nav_data("ss", subcat_id, p),
+                               _nav_back_to_parent(cat_id, parent_id), cart=True)
+            caption = f"<b>{cat_name} → {sub_name}</b>\nВыберите подподкатегорию:"
+            return caption, (sub_photo_path or cat_photo_path), kb, ("ss", subcat_id, page)
+
+        if code in ("pc", "ps"):
+            if code == "pc":
+                cat_id = view[1]
+                cat = _nav_category(cat_id)
+                if not cat:
+                    return None
+                breadcrumb, photo_path = cat
+                node = category_node(cat_id)
+                back = nav_data("bc")
+            else:
+                sub = _nav_subcategory(view[1])
+                if not sub:
+                    return None
+                cat_id, sub_name, sub_photo_path, parent_id = sub
+                cat = _nav_category(cat_id)
+                if not cat:
+                    return None
+                cat_name, cat_photo_path = cat
+                names = [cat_name]
+                photo_path = sub_photo_path
+                if parent_id:
+                    parent = _nav_subcategory(parent_id)
+                    if parent:
+                        names.append(parent[1])
+                        photo_path = photo_path or parent[2]
+                names.append(sub_name)
+                breadcrumb = " → ".join(names)
+                photo_path = photo_path or cat_photo_path
+                node = subcategory_node(view[1])
+                back = _nav_back_to_parent(cat_id, parent_id)
+
+            prods = catalog.products(node)
+            total_pages = max(1, (len(prods) + NAV_PRODUCTS_PAGE_SIZE - 1) // NAV_PRODUCTS_PAGE_SIZE)
+            page = _clamp_page(view[2], total_pages)
+            start = page * NAV_PRODUCTS_PAGE_SIZE
+            buttons = [
+                (name, nav_data("pr", pid))
+                for pid, name in zip(prods.ids[start:start + NAV_PRODUCTS_PAGE_SIZE],
+                                     prods.names[start:start + NAV_PRODUCTS_PAGE_SIZE])
+            ]
+            kb = _nav_keyboard(buttons, page, total_pages, lambda p: nav_data(code, view[1], p), back, cart=True)
+            caption = f"<b>{breadcrumb}</b>"
+            if not prods:
+                caption += "\nЗдесь пока нет товаров."
+            return caption, photo_path, kb, (code, view[1], page)
+
+        return None
+
+    def _nav_screen(view: tuple):
+        return _cached_keyboard(("nav",) + view, lambda: _nav_render(view))
+
+    async def _nav_show(uid: int, message: types.Message, view: tuple, edit: bool):
+        """Показывает экран view: edit=True — правит message на месте, иначе шлёт новое сообщение."""
+        st = _nav_session(uid)
+        view = resolve_back(view, st.get("nav_pages") or {})
+        rendered = _nav_screen(view)
+        if rendered is None and view[0] != "c":
+            # узел удалили/выключили — возвращаемся к категориям
+            rendered = _nav_screen(("c", (st.get("nav_pages") or {}).get("c", 0)))
+        if rendered is None:
+            user_state.pop(uid, None)
+            await message.answer("Категории ещё не добавлены.")
+            return
+
+        caption, photo_path, kb, shown = rendered
+        if not (photo_path and os.path.exists(photo_path)):
+            photo_path = None
+        if shown[0] in PAGED_VIEWS:
+            pages_seen = dict(st.get("nav_pages") or {})
+            pages_seen[view_key(shown)] = shown[-1]
+            st["nav_pages"] = pages_seen
+        st["nav_view"] = shown
+        if shown[0] in ("pc", "ps"):
+            # кнопки inline-экрана несут id товаров, версия каталога им не нужна
+            st["node"] = category_node(shown[1]) if shown[0] == "pc" else subcategory_node(shown[1])
+            st["page"] = shown[2]
+
+        sent = None
+        if edit:
+            try:
+                if message.photo:
+                    if photo_path and photo_path != st.get("nav_photo"):
+                        sent = await message.edit_media(
+                            types.InputMediaPhoto(media=_nav_photo_input(photo_path), caption=caption, parse_mode="HTML"),
+                            reply_markup=kb,
+                        )
+                        _nav_remember_photo(photo_path, sent)
+                        st["nav_photo"] = photo_path
+                    elif st.get("nav_photo") is None:
+                        # на сообщении чужое фото (карточка товара), а у экрана фото нет — ниже новое
+                        pass
+                    elif caption != st.get("nav_caption"):
+                        # у экрана нет своего фото — оставляем прежнее, меняем подпись
+                        sent = await message.edit_caption(caption=caption, parse_mode="HTML", reply_markup=kb)
+                    else:
+                        # листание: фото и подпись те же — только клавиатура
+                        sent = await message.edit_reply_markup(reply_markup=kb)
+                elif not photo_path:
+                    if caption != st.get("nav_caption"):
+                        sent = await message.edit_text(caption, parse_mode="HTML", reply_markup=kb)
+                    else:
+                        sent = await message.edit_reply_markup(reply_markup=kb)
+                # текстовое сообщение нельзя превратить в фото — ниже отправим новое
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    sent = message
+                else:
+                    print("Не удалось отредактировать меню:", e)
+                    sent = None
+
+        if sent is None:
+            if photo_path:
+                try:
+                    sent = await message.answer_photo(_nav_photo_input(photo_path), caption=caption,
+                                                      parse_mode="HTML", reply_markup=kb)
+                    _nav_remember_photo(photo_path, sent)
+                except Exception as e:
+                    print("Не удалось отправить фото меню:", e)
+                    nav_photo_ids.pop(photo_path, None)
+                    photo_path = None
+            if sent is None:
+                sent = await message.answer(caption, parse_mode="HTML", reply_markup=kb)
+            st["menu_message_id"] = sent.message_id
+            st["nav_photo"] = photo_path
+        elif isinstance(sent, types.Message):
+            st["menu_message_id"] = sent.message_id
+        st["nav_caption"] = caption
+
+    async def _nav_resume(message: types.Message, previous) -> None:
+        """Возврат к инлайн-меню (после карточки товара / корзины) — новым сообщением."""
+        uid = message.from_user.id
+        user_state[uid] = previous
+        await _nav_show(uid, message, tuple(previous.get("nav_view") or ("c", 0)), edit=False)
+
+    @dp.callback_query(lambda c: c.data and c.data.startswith(NAV_PREFIX))
+    async def inline_nav_callback(callback: types.CallbackQuery):
+        if not callback.message:
+            return
+        view = parse_nav(callback.data)
+        if view is None or view[0] == "x":
+            await callback.answer()
+            return
+
+        uid = callback.from_user.id
+        code = view[0]
+
+        if code == "home":
+            user_state.pop(uid, None)
+            await show_main_menu(callback)
+            return
+
+        if code == "cart":
+            await callback.answer()
+            _nav_session(uid)
+            await show_cart(_callback_message(callback))
+            return
+
+        if code == "pr":
+            # Карточка товара; "Назад" вернёт в это же меню (запись сессии — ссылкой)
+            st = _nav_session(uid)
+            user_state[uid] = {
+                "type": "product_pick",
+                "prod_id": view[1],
+                "qty": 1,
+                "previous_state": st,
+            }
+            await callback.answer()
+            await show_product_pick_card(_callback_message(callback))
+            return
+
+        await _nav_show(uid, callback.message, view, edit=True)
+        await callback.answer()
+
+    @router.message(state="categories", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)
     async def categories_pagination(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2629,7 +3177,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         page = _clamp_page(page, pages)
         await show_categories_only(message, page=page)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "subcategories" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT])
+    @router.message(state="subcategories", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)
     async def subcategories_pagination(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2650,7 +3198,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         )
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "subsubcategories" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT])
+    @router.message(state="subsubcategories", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)
     async def subsubcategories_pagination(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2674,7 +3222,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
             sub_page=int(st.get("sub_page") or 0),
         )
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "subsubcategories" and (m.text or "").strip() == "Назад")
+    @router.message(state="subsubcategories", text="Назад", strip=True)
     async def back_to_subcategories_from_subsubcategories(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2688,13 +3236,13 @@ async def launch_bot(bot_id: int, token: str, username: str):
         )
 
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "categories" and (m.text or "").strip() == "Назад")
+    @router.message(state="categories", text="Назад", strip=True)
     async def back_to_main_from_categories_state(message: types.Message):
         uid = message.from_user.id
         user_state.pop(uid, None)
         await show_main_menu(message)
 
-    @dp.message(lambda m: user_state.get(m.from_user.id, {}).get("type") == "subcategories" and (m.text or "").strip() == "Назад")
+    @router.message(state="subcategories", text="Назад", strip=True)
     async def back_to_categories_from_subcategories(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2713,7 +3261,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         return st.get("type") == "subsubcategories" and (m.text or "") in st.get("subs", {})
 
 
-    @dp.message(lambda m: m.text == "Меню")
+    @router.message(text="Меню")
     async def show_full_menu(message: types.Message):
         cur.execute("SELECT photo_path FROM menu_photos WHERE bot_id=? ORDER BY sort_order, id", (bot_id,))
         photos = cur.fetchall()
@@ -2730,7 +3278,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         # Сразу показываем категории (с количеством в скобках)
         await show_categories_only(message, page=0)
 
-    @dp.message(_is_category_choice)
+    @router.message(state="categories", where=_is_category_choice)
     async def category_selected(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2748,16 +3296,14 @@ async def launch_bot(bot_id: int, token: str, username: str):
             return
 
         # В этой категории нет включённых подкатегорий — показываем товары прямо в категории
-        cur.execute(
-            "SELECT id, name FROM products WHERE bot_id=? AND cat_id=? AND (subcat_id IS NULL OR subcat_id=0) AND enabled=1 ORDER BY sort_order, id",
-            (bot_id, cat_id),
-        )
-        prods = cur.fetchall()
+        node = category_node(cat_id)
+        catalog.products(node)
 
         user_state[uid] = {
             "type": "category_products",
             "cat_id": cat_id,
-            "prods": [(p[0], p[1]) for p in prods],
+            "catalog_version": catalog.version,
+            "node": node,
             "page": 0,
             "cat_name": cat_name,
             "cat_photo_path": photo_path,
@@ -2767,7 +3313,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await show_category_products_keyboard(message, 0)
         return
 
-    @dp.message(_is_subcategory_choice)
+    @router.message(state="subcategories", where=_is_subcategory_choice)
     async def subcategory_selected(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2812,11 +3358,8 @@ async def launch_bot(bot_id: int, token: str, username: str):
         # Лист — показываем товары
         photo_path = sub_photo_path or cat_photo_path
 
-        cur.execute(
-            "SELECT id, name FROM products WHERE bot_id=? AND subcat_id=? AND enabled=1 ORDER BY sort_order, id",
-            (bot_id, subcat_id),
-        )
-        prods = cur.fetchall()
+        node = subcategory_node(subcat_id)
+        prods = catalog.products(node)
         breadcrumb = f"{base_cat_name} → {sub_name}"
 
         if not prods:
@@ -2830,7 +3373,8 @@ async def launch_bot(bot_id: int, token: str, username: str):
         user_state[uid] = {
             "type": "category_products",
             "cat_id": cat_id,
-            "prods": [(p[0], p[1]) for p in prods],
+            "catalog_version": catalog.version,
+            "node": node,
             "page": 0,
             "cat_name": breadcrumb,  # используется в заголовке (хлебные крошки)
             "cat_photo_path": photo_path,  # фото для товаров (приоритет: подкатегория)
@@ -2845,7 +3389,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         await show_category_products_keyboard(message, 0)
 
 
-    @dp.message(_is_subsub_choice)
+    @router.message(state="subsubcategories", where=_is_subsub_choice)
     async def subsubcategory_selected(message: types.Message):
         uid = message.from_user.id
         st = user_state.get(uid, {})
@@ -2867,11 +3411,8 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         photo_path = sub_photo_path or parent_sub_photo_path or cat_photo_path
 
-        cur.execute(
-            "SELECT id, name FROM products WHERE bot_id=? AND subcat_id=? AND enabled=1 ORDER BY sort_order, id",
-            (bot_id, subcat_id),
-        )
-        prods = cur.fetchall()
+        node = subcategory_node(subcat_id)
+        prods = catalog.products(node)
 
         breadcrumb = f"{base_cat_name} → {parent_sub_name} → {sub_name}"
 
@@ -2886,7 +3427,8 @@ async def launch_bot(bot_id: int, token: str, username: str):
         user_state[uid] = {
             "type": "category_products",
             "cat_id": cat_id,
-            "prods": [(p[0], p[1]) for p in prods],
+            "catalog_version": catalog.version,
+            "node": node,
             "page": 0,
             "cat_name": breadcrumb,  # хлебные крошки
             "cat_photo_path": photo_path,  # фото для товаров (приоритет: подподкатегория)
@@ -2910,34 +3452,17 @@ async def launch_bot(bot_id: int, token: str, username: str):
         if state.get("type") != "category_products":
             return
 
-        prods = state.get("prods") or []
+        prods = _session_products(state)
         per_page = 6
         total_pages = max(1, (len(prods) + per_page - 1) // per_page)
         page = _clamp_page(int(page or 0), total_pages)
 
-        start = page * per_page
-        end = start + per_page
-        current_prods = prods[start:end]
-
-        keyboard = []
-        for i in range(0, len(current_prods), 2):
-            row = [KeyboardButton(text=current_prods[i][1])]
-            if i + 1 < len(current_prods):
-                row.append(KeyboardButton(text=current_prods[i + 1][1]))
-            keyboard.append(row)
-
         # Стрелки + "Стр. x/y" — в том же стиле, что категории/подкатегории
-        if total_pages > 1:
-            keyboard.append([
-                KeyboardButton(text=MENU_NAV_PREV),
-                KeyboardButton(text=f"{MENU_PAGE_PREFIX} {page + 1}/{total_pages}"),
-                KeyboardButton(text=MENU_NAV_NEXT),
-            ])
-
-        keyboard.append([KeyboardButton(text="Назад"), KeyboardButton(text="Корзина")])
-        keyboard.append([KeyboardButton(text="На главную")])
+        def build_kb():
+            return _menu_reply_kb(list(prods.page_names(page, per_page)), page, total_pages, MENU_BOTTOM_NODE)
 
-        kb = ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+        # у старого состояния со своей копией списка нет узла — такую клавиатуру не кэшируем
+        kb = _cached_keyboard(("products", prods.node, page), build_kb) if prods.node else build_kb()
 
         # Если это первое открытие категории — отправляем фото + название
         if "category_photo_message_id" not in state:
@@ -2974,8 +3499,10 @@ async def launch_bot(bot_id: int, token: str, username: str):
 
         state["page"] = page
         state["pages"] = total_pages
+        if prods.node:
+            state["catalog_version"] = catalog.version
 
-    @dp.message(lambda m: m.text == "Купить" and user_state.get(m.from_user.id, {}).get("type") == "product")
+    @router.message(state="product", text="Купить")
     async def buy_product(message: types.Message):
         uid = message.from_user.id
         state = user_state[uid]
@@ -2989,8 +3516,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
                     (bot_id, uid, prod_id))
         conn.commit()
         await message.answer("Товар добавлен в корзину!")
-    @dp.message(lambda m: m.text in ["Предыдущий", "Следующий", "Назад", "На главную"]
-                and user_state.get(m.from_user.id, {}).get("type") == "product")
+    @router.message(state="product", text=("Предыдущий", "Следующий", "Назад", "На главную"))
     async def navigate_product(message: types.Message):
         uid = message.from_user.id
         state = user_state[uid]
@@ -3009,7 +3535,7 @@ async def launch_bot(bot_id: int, token: str, username: str):
         cur.execute("SELECT id, name, price, description, photo_path FROM products WHERE cat_id=? ORDER BY id", (cat_id,))
         prods = cur.fetchall()
         await show_product(message, prods, index)
-    @dp.message(lambda m: m.text == "Назад" and user_state.get(m.from_user.id) is None)
+    @router.message(text="Назад", no_state=True)
     async def back_to_main_from_categories(message: types.Message):
         await show_main_menu(message)
 # @dp.message(lambda m: m.text == "Назад")
@@ -3246,8 +3772,9 @@ async def launch_bot(bot_id: int, token: str, username: str):
             await callback.answer("Ошибка обработки", show_alert=True)
 
     # === ЗАПУСК ===
+    dp.message.register(router.dispatch)
     active_bots[bot_id] = {"bot": bot, "dp": dp}
-    asyncio.create_task(dp.start_polling(bot))
+    supervisor.start(bot_id, bot, dp, username=username)
     print(f"Бот @{username} (ID: {bot_id}) — полностью готов!")
 # === АВТООТМЕНА ЗАКАЗОВ ===
     async def auto_cancel_task():
@@ -3302,7 +3829,9 @@ async def launch_bot(bot_id: int, token: str, username: str):
                             print("Ошибка редактирования при автоотмене:", e)
             except Exception as e:
                 print("Ошибка автоотмены:", e)
-    asyncio.create_task(auto_cancel_task())
+    supervisor.add_task(bot_id, auto_cancel_task())
+    supervisor.add_task(bot_id, user_state.run_flusher())
+    supervisor.add_task(bot_id, user_state.run_sweeper())
 # === Автозапуск всех ботов при старте ===
 
 
@@ -3314,8 +3843,84 @@ async def start_all_bots():
             await launch_bot(bot_id, token, username)
 
 
-async def stop_bot(bot_id: int):
-    """Stop a running bot if it exists."""
+# === Шардирование ботов между воркерами (BOT_SHARDING=1) ===
+coordinator: ShardCoordinator | None = None
+
+
+def _drop_derived_caches(bot_id: int | None, version: int | None = None):
+    """Catalog or settings of a bot (None = of all bots) changed: drop what was built from them."""
+    bot_ids = list(keyboard_caches) if bot_id is None else [bot_id]
+    for bid in bot_ids:
+        index = catalog_indexes.get(bid)
+        if index is not None and version is not None and index.version is not None and version <= index.version:
+            continue  # уже видели эту версию каталога
+        kbs = keyboard_caches.get(bid)
+        if kbs is not None:
+            kbs.invalidate()
+        if index is not None:
+            # перечитать версии при следующем обращении, не дожидаясь CATALOG_CHECK_INTERVAL
+            index.invalidate()
+
+
+def _on_settings_event(bot_id: int | None, version: int | None):
+    bot_settings.invalidate(bot_id)
+    _drop_derived_caches(bot_id)
+
+
+invalidation_bus.subscribe("settings", _on_settings_event)
+# "catalog" шлёт триггер bump_catalog_version (с новой версией) при любой правке меню
+invalidation_bus.subscribe("catalog", _drop_derived_caches)
+invalidation_bus.subscribe("cashiers", lambda bot_id, version: cashier_index.invalidate(bot_id))
+
+
+def invalidate_bot_settings(bot_id: int):
+    """Called by dashboard routes after writing the bots row (here and, via NOTIFY, elsewhere)."""
+    invalidation_bus.publish(bot_id, "settings")
+
+
+def invalidate_cashiers(bot_id: int):
+    """Called by dashboard routes after adding / removing a cashier."""
+    invalidation_bus.publish(bot_id, "cashiers")
+
+
+async def start_bots():
+    """FastAPI startup: with BOT_SHARDING each worker polls only the bots it holds a lock for."""
+    global coordinator
+    await invalidation_bus.start()
+    if not BOT_SHARDING:
+        await start_all_bots()
+        return
+    coordinator = ShardCoordinator(DATABASE_URL, on_acquire=launch_bot, on_release=stop_bot)
+    await coordinator.start()
+
+
+async def shutdown_bots():
+    global coordinator
+    await invalidation_bus.stop()
+    if coordinator is not None:
+        await coordinator.stop()
+        coordinator = None
+    await stop_all_bots()
+    if _state_backend is not None:
+        _state_backend.close()
+
+
+async def claim_bot(bot_id: int, token: str, username: str) -> bool:
+    """Start a newly created bot. In sharded mode only if this worker wins its lock,
+    otherwise the owning worker picks it up on its next rebalance."""
+    if coordinator is None:
+        await launch_bot(bot_id, token, username)
+        return True
+    return await coordinator.try_claim(bot_id, token, username)
+
+
+async def stop_bot(bot_id: int, deleted: bool = False):
+    """Stop a running bot if it exists: cancel polling/aux tasks, close the session.
+
+    deleted=True: the bot's rows are already removed, so pending user states are dropped
+    instead of flushed (user_states references bots).
+    """
+    await supervisor.stop(bot_id)
     if bot_id in active_bots:
         try:
             await active_bots[bot_id]["bot"].session.close()
@@ -3325,3 +3930,50 @@ async def stop_bot(bot_id: int):
             del active_bots[bot_id]
         except Exception:
             pass
+    scheduler.forget(bot_id)
+    catalog_indexes.pop(bot_id, None)
+    keyboard_caches.pop(bot_id, None)
+    bot_settings.invalidate(bot_id)
+    cashier_index.invalidate(bot_id)
+    # Сбрасываем состояния в хранилище: бот может переехать на другой воркер
+    store = user_states.pop(bot_id, None)
+    if store is not None:
+        if deleted:
+            store.discard()
+        else:
+            await store.flush()
+
+
+async def stop_all_bots():
+    """Stop every bot on FastAPI shutdown."""
+    for bot_id in list(active_bots):
+        await stop_bot(bot_id)
+
+
+def bot_status(bot_id: int) -> dict | None:
+    """Supervisor state of a bot: running / backoff / disabled (None if not launched here)."""
+    st = supervisor.status(bot_id)
+    if st is not None:
+        st["dispatch"] = chat_dispatcher.stats(bot_id)
+        st["scheduling"] = scheduler.stats(bot_id)
+        store = user_states.get(bot_id)
+        st["memory"] = store.memory_report() if store is not None else None
+        index = catalog_indexes.get(bot_id)
+        st["catalog"] = index.stats() if index is not None else None
+        kbs = keyboard_caches.get(bot_id)
+        st["keyboards"] = kbs.stats() if kbs is not None else None
+    return st
+
+
+def cache_status() -> dict:
+    """Process-wide caches: settings, cashiers and the invalidation bus feeding them."""
+    return {
+        "settings": bot_settings.stats(),
+        "cashiers": cashier_index.stats(),
+        "invalidation": invalidation_bus.stats(),
+    }
+
+
+def shard_status() -> dict | None:
+    """Which bots this worker owns under BOT_SHARDING (None when sharding is off)."""
+    return coordinator.status() if coordinator is not None else None
@@ -0,0 +1,237 @@
+"""Fair multi-tenant update scheduling and backpressure.
+
+All bots share one event loop and one DB connection. Without admission control a single
+tenant running a promo can queue thousands of handler tasks and push latency up for every
+other bot. FairScheduler adds two outer update middlewares per bot:
+
+- admission (outermost): counts every accepted update of the bot until it is done. Above
+  BOT_MAX_PENDING the update is rejected: metrics are bumped and, if BOT_BUSY_REPLY is set,
+  the chat gets a short "we're busy" answer (at most once per BOT_BUSY_REPLY_INTERVAL);
+- slot (innermost, after per-chat serialization): a handler may run only with a slot.
+  At most BOT_SCHED_CAPACITY handlers run process-wide and at most BOT_MAX_INFLIGHT per bot.
+  Free slots go to the waiting bot with the smallest virtual time (vtime += 1 / weight on
+  every grant), i.e. weighted fair queuing: a noisy bot gets its share, not the whole loop.
+
+Weights come from BOT_WEIGHTS ("<bot_id>:<weight>,...", default 1.0) and are applied by
+launch_bot via set_weight: a bot with weight 2 gets twice the slots of a busy weight-1 bot.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+
+BOT_SCHED_CAPACITY = int(os.getenv("BOT_SCHED_CAPACITY", "64"))
+BOT_MAX_INFLIGHT = int(os.getenv("BOT_MAX_INFLIGHT", "16"))
+BOT_MAX_PENDING = int(os.getenv("BOT_MAX_PENDING", "200"))
+BOT_BUSY_REPLY = os.getenv("BOT_BUSY_REPLY", "Сейчас очень много запросов, повторите, пожалуйста, через минуту 🙏")
+BOT_BUSY_REPLY_INTERVAL = float(os.getenv("BOT_BUSY_REPLY_INTERVAL", "30"))
+
+
+def parse_weights(raw: str) -> dict[int, float]:
+    """"123:2,456:0.5" -> {123: 2.0, 456: 0.5}; malformed entries are skipped."""
+    weights: dict[int, float] = {}
+    for item in raw.split(","):
+        bot_id, sep, weight = item.strip().partition(":")
+        if not sep:
+            continue
+        try:
+            weights[int(bot_id)] = float(weight)
+        except ValueError:
+            print("BOT_WEIGHTS: пропущена запись", repr(item))
+    return weights
+
+
+BOT_WEIGHTS = parse_weights(os.getenv("BOT_WEIGHTS", ""))
+
+
+class _Lane:
+    """Per-bot scheduling state and metrics."""
+
+    __slots__ = (
+        "weight", "vtime", "in_flight", "pending", "waiters",
+        "accepted", "rejected", "busy_replies", "wait_total", "wait_max", "granted",
+    )
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.vtime = 0.0
+        self.in_flight = 0
+        self.pending = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.accepted = 0
+        self.rejected = 0
+        self.busy_replies = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.granted = 0
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        capacity: int = BOT_SCHED_CAPACITY,
+        max_inflight: int = BOT_MAX_INFLIGHT,
+        max_pending: int = BOT_MAX_PENDING,
+        busy_reply: str = BOT_BUSY_REPLY,
+        busy_reply_interval: float = BOT_BUSY_REPLY_INTERVAL,
+    ):
+        self.capacity = max(1, capacity)
+        self.max_inflight = max(1, max_inflight)
+        self.max_pending = max(1, max_pending)
+        self.busy_reply = busy_reply
+        self.busy_reply_interval = busy_reply_interval
+        self._lanes: dict[int, _Lane] = {}
+        self._in_flight = 0
+        self._vclock = 0.0
+        self._busy_replied: dict[tuple, float] = {}
+
+    # --- configuration ---
+    def lane(self, bot_id: int) -> _Lane:
+        lane = self._lanes.get(bot_id)
+        if lane is None:
+            lane = self._lanes[bot_id] = _Lane(1.0)
+        return lane
+
+    def set_weight(self, bot_id: int, weight: float):
+        self.lane(bot_id).weight = max(0.01, float(weight))
+
+    def forget(self, bot_id: int):
+        """Drop the lane of a stopped bot once nothing of it is running or queued."""
+        lane = self._lanes.get(bot_id)
+        if lane is not None and lane.pending == 0 and lane.in_flight == 0 and not lane.waiters:
+            del self._lanes[bot_id]
+        for key in [k for k in self._busy_replied if k[0] == bot_id]:
+            del self._busy_replied[key]
+
+    # --- middlewares ---
+    def admission_middleware(self, bot_id: int):
+        async def _admit(handler, event, data):
+            lane = self.lane(bot_id)
+            if lane.pending >= self.max_pending:
+                lane.rejected += 1
+                await self._reply_busy(bot_id, lane, event)
+                return None
+            lane.pending += 1
+            lane.accepted += 1
+            try:
+                return await handler(event, data)
+            finally:
+                lane.pending -= 1
+
+        return _admit
+
+    def slot_middleware(self, bot_id: int):
+        async def _slot(handler, event, data):
+            await self.acquire(bot_id)
+            try:
+                return await handler(event, data)
+            finally:
+                self.release(bot_id)
+
+        return _slot
+
+    # --- slots ---
+    async def acquire(self, bot_id: int):
+        lane = self.lane(bot_id)
+        if not lane.waiters and lane.in_flight == 0:
+            # Бот "проснулся" — не даём ему накопленного за время простоя кредита
+            lane.vtime = max(lane.vtime, self._vclock)
+        fut = asyncio.get_running_loop().create_future()
+        lane.waiters.append(fut)
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Слот уже выдан, а задачу отменили — возвращаем
+                self.release(bot_id)
+            else:
+                try:
+                    lane.waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+        waited = time.monotonic() - started
+        lane.wait_total += waited
+        if waited > lane.wait_max:
+            lane.wait_max = waited
+
+    def release(self, bot_id: int):
+        lane = self._lanes.get(bot_id)
+        if lane is not None and lane.in_flight > 0:
+            lane.in_flight -= 1
+        self._in_flight = max(0, self._in_flight - 1)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._in_flight < self.capacity:
+            best = None
+            for lane in self._lanes.values():
+                if not lane.waiters or lane.in_flight >= self.max_inflight:
+                    continue
+                if best is None or lane.vtime < best.vtime:
+                    best = lane
+            if best is None:
+                return
+            fut = best.waiters.popleft()
+            if fut.done():
+                continue
+            best.in_flight += 1
+            best.granted += 1
+            self._in_flight += 1
+            self._vclock = best.vtime
+            best.vtime += 1.0 / best.weight
+            fut.set_result(None)
+
+    # --- backpressure ---
+    async def _reply_busy(self, bot_id: int, lane: _Lane, event):
+        if not self.busy_reply:
+            return
+        message = getattr(event, "message", None)
+        callback = getattr(event, "callback_query", None)
+        chat_id = message.chat.id if message is not None else (callback.from_user.id if callback is not None else None)
+        if chat_id is None:
+            return
+        now = time.monotonic()
+        key = (bot_id, chat_id)
+        if now - self._busy_replied.get(key, 0.0) < self.busy_reply_interval:
+            return
+        if len(self._busy_replied) > 10000:
+            self._busy_replied = {k: t for k, t in self._busy_replied.items() if now - t < self.busy_reply_interval}
+        self._busy_replied[key] = now
+        lane.busy_replies += 1
+        try:
+            if callback is not None:
+                await callback.answer(self.busy_reply)
+            else:
+                await message.answer(self.busy_reply)
+        except Exception as e:
+            print("Не удалось отправить ответ о перегрузке:", e)
+
+    # --- metrics ---
+    def stats(self, bot_id: int) -> dict | None:
+        lane = self._lanes.get(bot_id)
+        if lane is None:
+            return None
+        return {
+            "weight": lane.weight,
+            "in_flight": lane.in_flight,
+            "pending": lane.pending,
+            "waiting_for_slot": len(lane.waiters),
+            "accepted": lane.accepted,
+            "rejected": lane.rejected,
+            "busy_replies": lane.busy_replies,
+            "avg_slot_wait_ms": round(1000 * lane.wait_total / lane.granted, 2) if lane.granted else 0.0,
+            "max_slot_wait_ms": round(1000 * lane.wait_max, 2),
+            "overloaded": lane.pending >= self.max_pending,
+        }
+
+    def totals(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "in_flight": self._in_flight,
+            "waiting_for_slot": sum(len(l.waiters) for l in self._lanes.values()),
+            "bots": len(self._lanes),
+        }
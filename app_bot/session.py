@@ -0,0 +1,187 @@
+"""Compact per-screen session records for user_state.
+
+Every screen used to be a fresh dict, and navigation copied the whole current dict into
+"previous_state" (`state.copy()`), so memory per user grew with navigation depth and each
+level carried a full dict hash table.
+
+Now each screen is a `__slots__` record (CatalogSession, CartSession, CheckoutSession, ...)
+that still behaves like a mapping — `st.get("page")`, `st["qty"] = 2`, `"x" in st`,
+`st.pop(...)` — so the handlers did not change. Keys a screen does not declare go to a small
+overflow dict. History is a chain of references: the new screen points at the previous
+record instead of a copy of it (the previous record is no longer the live state, so nobody
+mutates it until "Назад" makes it current again).
+
+UserStateStore converts plain dicts on assignment (session_from()), the FSM store packs a
+record as its class name plus the set fields.
+"""
+
+from collections.abc import MutableMapping
+
+_MISSING = object()
+
+
+class Session(MutableMapping):
+    """Base record: no declared fields, everything lives in the overflow dict."""
+
+    __slots__ = ("_extra",)
+    fields: tuple = ()
+
+    def __init__(self, data=None, **kwargs):
+        self._extra = None
+        if data:
+            for k, v in data.items():
+                self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    # --- mapping interface ---
+    def __getitem__(self, key):
+        if key in self._field_set:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __setitem__(self, key, value):
+        if key == "previous_state" and type(value) is dict:
+            value = session_from(value)
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return getattr(self, key, _MISSING) is not _MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for name in self.fields:
+            if getattr(self, name, _MISSING) is not _MISSING:
+                yield name
+        if self._extra:
+            yield from list(self._extra)
+
+    def __len__(self):
+        n = sum(1 for name in self.fields if getattr(self, name, _MISSING) is not _MISSING)
+        return n + (len(self._extra) if self._extra else 0)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def copy(self):
+        """Shallow copy (same class). Navigation should keep references instead."""
+        clone = type(self)()
+        for k, v in self.items():
+            clone[k] = v
+        return clone
+
+    def to_fields(self) -> dict:
+        return {k: self[k] for k in self}
+
+
+def _session_class(name: str, fields: tuple):
+    """Record class with `fields` as slots (typed screen)."""
+    # слот с именем метода (items, keys, get...) закрыл бы сам метод маппинга
+    shadowed = [f for f in fields if hasattr(Session, f)]
+    if shadowed:
+        raise ValueError(f"{name}: fields {shadowed} shadow Session attributes")
+    return type(name, (Session,), {"__slots__": fields, "fields": fields, "_field_set": frozenset(fields)})
+
+
+Session._field_set = frozenset()
+
+_NAV = ("type", "previous_state", "menu_message_id")
+
+CatalogSession = _session_class("CatalogSession", _NAV + (
+    "page", "pages", "titles", "cats", "subs", "node", "catalog_version",
+    "cat_id", "cat_name", "cat_photo_path",
+    "parent_subcat_id", "parent_sub_name", "parent_sub_photo_path",
+    "categories_page", "parent_page", "sub_page", "subsub_page",
+    "back_mode", "back_cat_id", "back_cat_name", "back_cat_photo_path",
+    "category_photo_message_id",
+    "nav_view", "nav_pages", "nav_photo", "nav_caption",
+))
+ProductPickSession = _session_class("ProductPickSession", _NAV + (
+    "prod_id", "qty", "name", "price", "description", "photo_path",
+))
+ProductSession = _session_class("ProductSession", _NAV + ("cat_id", "index"))
+CartSession = _session_class("CartSession", _NAV + ("cart_items", "page", "pages", "cart_item_index", "card_cache"))
+CheckoutSession = _session_class("CheckoutSession", _NAV + (
+    "delivery_type", "temp_order_items", "phone", "address", "saved_address", "comment",
+    "bonus_used", "bonus_max",
+    "awaiting_address_confirm", "awaiting_address_input", "awaiting_comment",
+    "awaiting_bonus_choice", "awaiting_bonus_amount",
+))
+OrdersSession = _session_class("OrdersSession", _NAV + (
+    "orders_list", "index", "awaiting_cancel_reason", "awaiting_cancel_confirm",
+))
+CashierSession = _session_class("CashierSession", _NAV + ("client_uid", "purchase_amount", "max_bonus"))
+
+SESSION_CLASSES = {
+    cls.__name__: cls
+    for cls in (Session, CatalogSession, ProductPickSession, ProductSession, CartSession,
+                CheckoutSession, OrdersSession, CashierSession)
+}
+
+_BY_TYPE = {
+    "categories": CatalogSession,
+    "subcategories": CatalogSession,
+    "subsubcategories": CatalogSession,
+    "category_products": CatalogSession,
+    "catalog_inline": CatalogSession,
+    "product_pick": ProductPickSession,
+    "product": ProductSession,
+    "cart_view": CartSession,
+    "cart_empty": CartSession,
+    "delivery_type": CheckoutSession,
+    "phone_confirm": CheckoutSession,
+    "phone_request": CheckoutSession,
+    "phone_manual": CheckoutSession,
+    "comment": CheckoutSession,
+    "address_confirm": CheckoutSession,
+    "address_input": CheckoutSession,
+    "orders": OrdersSession,
+    "cashier_op_select": CashierSession,
+    "cashier_accrual": CashierSession,
+    "cashier_writeoff_purchase": CashierSession,
+    "cashier_writeoff_amount": CashierSession,
+}
+
+# Состояния без "type", заданные только флагом
+_BY_FLAG = {
+    "awaiting_cancel_reason": OrdersSession,
+    "awaiting_cancel_confirm": OrdersSession,
+}
+
+
+def session_from(data) -> Session:
+    """Plain dict -> record of the screen's class (records are returned as is)."""
+    if isinstance(data, Session):
+        return data
+    cls = _BY_TYPE.get(data.get("type"))
+    if cls is None:
+        cls = next((c for flag, c in _BY_FLAG.items() if flag in data), Session)
+    return cls(data)
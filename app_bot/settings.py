@@ -0,0 +1,94 @@
+"""Per-bot settings cache.
+
+Hot paths used to re-read the bots row on every call: bonus and payment settings, the main
+menu (bonuses_enabled), "О нас", ask_delivery_type (two queries), notify_chat_id... Now
+BotSettingsCache keeps one typed BotSettings object per bot:
+
+- loaded with a single query on first use, and reloaded after invalidate(bot_id) or once
+  it is older than BOT_SETTINGS_TTL seconds (a safety net, not the main mechanism);
+- every dashboard save_* / toggle_* route calls manager.invalidate_bot_settings(bot_id),
+  which publishes a "settings" event on the invalidation bus (core/invalidation.py): the
+  local copy is dropped at once, other processes drop theirs via LISTEN/NOTIFY.
+"""
+
+import os
+import time
+
+from core.utils import normalize_notify_chat_id
+from repo import BOT_SETTINGS_COLUMNS, db_get_bot_settings
+
+BOT_SETTINGS_TTL = float(os.getenv("BOT_SETTINGS_TTL", "300"))
+
+# Значения по умолчанию — как в схеме таблицы bots
+_INT_DEFAULTS = {
+    "allow_in_hall": 1,
+    "allow_takeaway": 1,
+    "allow_delivery": 1,
+    "restrict_orders": 0,
+    "auto_cancel_minutes": 60,
+    "auto_cancel_enabled": 1,
+    "bonuses_enabled": 1,
+    "bonus_percent": 10,
+    "max_bonus_pay_percent": 30,
+    "min_order_for_bonus": 0,
+    "bonus_expire_days": 0,
+    "welcome_bonus": 0,
+    "payments_enabled": 0,
+    "min_order_total": 0,
+    "inline_nav": 0,
+    "settings_version": 0,
+}
+
+
+class BotSettings:
+    __slots__ = ("bot_id", "loaded_at") + BOT_SETTINGS_COLUMNS
+
+    def __init__(self, bot_id: int, row):
+        self.bot_id = bot_id
+        self.loaded_at = time.monotonic()
+        for name, value in zip(BOT_SETTINGS_COLUMNS, row):
+            if name in _INT_DEFAULTS:
+                value = _INT_DEFAULTS[name] if value is None else int(value)
+            setattr(self, name, value)
+        if self.notify_chat_id is not None:
+            self.notify_chat_id = normalize_notify_chat_id(str(self.notify_chat_id))
+        self.payment_provider_token = (self.payment_provider_token or "").strip() or None
+        self.timezone = self.timezone or "Europe/Moscow"
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in BOT_SETTINGS_COLUMNS}
+
+
+class BotSettingsCache:
+    def __init__(self, conn, ttl: float = BOT_SETTINGS_TTL):
+        self.conn = conn
+        self.ttl = ttl
+        self._items: dict[int, BotSettings] = {}
+        self.loads = 0
+        self.invalidations = 0
+
+    def get(self, bot_id: int) -> BotSettings | None:
+        settings = self._items.get(bot_id)
+        if settings is not None and time.monotonic() - settings.loaded_at < self.ttl:
+            return settings
+        row = db_get_bot_settings(self.conn, bot_id)
+        self.loads += 1
+        if row is None:
+            self._items.pop(bot_id, None)
+            return None
+        settings = self._items[bot_id] = BotSettings(bot_id, row)
+        return settings
+
+    def invalidate(self, bot_id: int | None = None):
+        self.invalidations += 1
+        if bot_id is None:
+            self._items.clear()
+        else:
+            self._items.pop(bot_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._items),
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,230 @@
+"""Bot ownership across uvicorn workers (Postgres advisory locks).
+
+With `uvicorn --workers N` every worker runs on_startup, and start_all_bots() used to launch
+every bot in every worker -> several getUpdates loops per token (TelegramConflictError).
+
+With BOT_SHARDING=1 each worker runs a ShardCoordinator:
+
+- it holds a dedicated connection (advisory locks belong to a session, so when a worker dies
+  Postgres drops its connection and the locks are released automatically);
+- every BOT_SHARD_INTERVAL seconds it heartbeats into `bot_workers` and removes workers whose
+  heartbeat is older than BOT_SHARD_WORKER_TTL;
+- fair share = ceil(bots / live workers). A worker over its share releases the extra bots,
+  a worker under its share grabs free bots with pg_try_advisory_lock;
+- a bot is polled only by the worker holding its lock.
+
+Failover: when a worker dies, after BOT_SHARD_WORKER_TTL the survivor sees it gone, its locks
+are already free, and the bots are launched on the survivor (see GET /bot_status and the
+"захвачен"/"освобождён" log lines). tests/test_sharding_failover.py checks this against a real
+Postgres (TEST_DATABASE_URL).
+"""
+
+import asyncio
+import math
+import os
+import socket
+import time
+import uuid
+
+import psycopg
+
+BOT_SHARDING = os.getenv("BOT_SHARDING", "0") == "1"
+BOT_SHARD_INTERVAL = float(os.getenv("BOT_SHARD_INTERVAL", "10"))
+BOT_SHARD_WORKER_TTL = int(os.getenv("BOT_SHARD_WORKER_TTL", "30"))
+
+# Ключ advisory-lock считается в Postgres: hashtextextended('bot_owner:<id>', 0) -> bigint
+_LOCK_KEY_SQL = "hashtextextended('bot_owner:' || %s::text, 0)"
+
+
+class ShardCoordinator:
+    def __init__(
+        self,
+        dsn: str,
+        on_acquire,
+        on_release,
+        interval: float = BOT_SHARD_INTERVAL,
+        worker_ttl: int = BOT_SHARD_WORKER_TTL,
+        worker_id: str | None = None,
+    ):
+        """on_acquire(bot_id, token, username) / on_release(bot_id, deleted=False) are coroutines."""
+        self.dsn = dsn
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.interval = interval
+        self.worker_ttl = worker_ttl
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.owned: set[int] = set()
+        self.live_workers = 0
+        self._conn = None
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    # --- lifecycle ---
+    async def start(self):
+        self._conn = await asyncio.to_thread(psycopg.connect, self.dsn, autocommit=True)
+        await self.rebalance()
+        self._task = asyncio.create_task(self._loop(), name="bot-shard-coordinator")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        async with self._lock:
+            for bot_id in sorted(self.owned):
+                await self.on_release(bot_id)
+            self.owned.clear()
+            if self._conn is not None:
+                try:
+                    await asyncio.to_thread(self._unregister)
+                except Exception:
+                    pass
+                # Закрытие сессии снимает все advisory-локи этого воркера
+                await asyncio.to_thread(self._conn.close)
+                self._conn = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.rebalance()
+            except Exception as e:
+                print("Ошибка ребалансировки ботов:", e)
+                await self._reconnect()
+
+    async def _reconnect(self):
+        # Соединение упало -> локи уже потеряны; останавливаем своих ботов, чтобы не было двойного polling
+        async with self._lock:
+            for bot_id in sorted(self.owned):
+                await self.on_release(bot_id)
+            self.owned.clear()
+            try:
+                if self._conn is not None:
+                    await asyncio.to_thread(self._conn.close)
+            except Exception:
+                pass
+            try:
+                self._conn = await asyncio.to_thread(psycopg.connect, self.dsn, autocommit=True)
+            except Exception as e:
+                self._conn = None
+                print("Не удалось переподключиться к БД для шардирования:", e)
+
+    # --- rebalancing ---
+    async def rebalance(self):
+        if self._conn is None:
+            await self._reconnect()
+            if self._conn is None:
+                return
+        async with self._lock:
+            plan = await asyncio.to_thread(self._plan)
+            for bot_id in plan["release"]:
+                await self.on_release(bot_id, deleted=bot_id in plan["deleted"])
+                await asyncio.to_thread(self._unlock, bot_id)
+                self.owned.discard(bot_id)
+                print(f"Бот {bot_id} освобождён воркером {self.worker_id}")
+            for bot_id, token, username in plan["acquire"]:
+                try:
+                    await self.on_acquire(bot_id, token, username)
+                    print(f"Бот {bot_id} захвачен воркером {self.worker_id}")
+                except Exception as e:
+                    print(f"Не удалось запустить бота {bot_id}:", e)
+                    await asyncio.to_thread(self._unlock, bot_id)
+                    self.owned.discard(bot_id)
+
+    async def try_claim(self, bot_id: int, token: str, username: str) -> bool:
+        """Claim a freshly created bot right away instead of waiting for the next tick."""
+        if self._conn is None:
+            return False
+        async with self._lock:
+            if bot_id in self.owned:
+                return True
+            ok = await asyncio.to_thread(self._try_lock, bot_id)
+            if not ok:
+                return False
+            self.owned.add(bot_id)
+            try:
+                await self.on_acquire(bot_id, token, username)
+            except Exception as e:
+                print(f"Не удалось запустить бота {bot_id}:", e)
+                await asyncio.to_thread(self._unlock, bot_id)
+                self.owned.discard(bot_id)
+                return False
+            print(f"Бот {bot_id} захвачен воркером {self.worker_id}")
+            return True
+
+    async def release(self, bot_id: int):
+        async with self._lock:
+            if bot_id not in self.owned:
+                return
+            await self.on_release(bot_id)
+            await asyncio.to_thread(self._unlock, bot_id)
+            self.owned.discard(bot_id)
+
+    # --- sync DB part (runs in a thread on the dedicated connection) ---
+    def _plan(self) -> dict:
+        now = int(time.time())
+        c = self._conn.cursor()
+        c.execute(
+            """
+            INSERT INTO bot_workers (worker_id, hostname, pid, started_at, heartbeat_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = EXCLUDED.heartbeat_at
+            """,
+            (self.worker_id, socket.gethostname(), os.getpid(), now, now),
+        )
+        c.execute("DELETE FROM bot_workers WHERE heartbeat_at < %s", (now - self.worker_ttl,))
+        c.execute("SELECT COUNT(*) FROM bot_workers")
+        self.live_workers = max(1, int(c.fetchone()[0] or 1))
+
+        c.execute("SELECT bot_id, token, username FROM bots ORDER BY bot_id")
+        bots = c.fetchall()
+        existing = {int(r[0]) for r in bots}
+        fair_share = max(1, math.ceil(len(bots) / self.live_workers)) if bots else 0
+
+        # Бот удалён из БД — отпускаем
+        deleted = sorted(self.owned - existing)
+        release: list[int] = list(deleted)
+        # Воркер перегружен (кто-то присоединился) — отдаём лишних
+        keep = sorted(self.owned & existing)
+        if len(keep) > fair_share:
+            release.extend(keep[fair_share:])
+            keep = keep[:fair_share]
+
+        # Отпускать будем после остановки polling (в rebalance), чтобы не было двойного getUpdates
+        acquire: list[tuple] = []
+        if len(keep) < fair_share:
+            for bot_id, token, username in bots:
+                bot_id = int(bot_id)
+                if bot_id in self.owned:
+                    continue
+                if len(keep) + len(acquire) >= fair_share:
+                    break
+                if self._try_lock(bot_id):
+                    self.owned.add(bot_id)
+                    acquire.append((bot_id, token, username))
+        c.close()
+        return {"release": release, "acquire": acquire, "deleted": set(deleted)}
+
+    def _try_lock(self, bot_id: int) -> bool:
+        c = self._conn.cursor()
+        c.execute(f"SELECT pg_try_advisory_lock({_LOCK_KEY_SQL})", (bot_id,))
+        ok = bool(c.fetchone()[0])
+        c.close()
+        return ok
+
+    def _unlock(self, bot_id: int):
+        c = self._conn.cursor()
+        c.execute(f"SELECT pg_advisory_unlock({_LOCK_KEY_SQL})", (bot_id,))
+        c.close()
+
+    def _unregister(self):
+        c = self._conn.cursor()
+        c.execute("DELETE FROM bot_workers WHERE worker_id=%s", (self.worker_id,))
+        c.close()
+
+    def status(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "live_workers": self.live_workers,
+            "owned": sorted(self.owned),
+        }
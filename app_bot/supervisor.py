@@ -0,0 +1,232 @@
+"""Supervisor for bot polling tasks.
+
+launch_bot() used to fire `asyncio.create_task(dp.start_polling(bot))` and forget the task.
+aiogram retries getUpdates forever on its own (even with a revoked token), so a dead bot
+looked exactly like a quiet one. The supervisor owns every polling task:
+
+- records the time of the last update (outer middleware on dp.update);
+- when a bot is quiet for longer than BOT_STALL_TIMEOUT, pings getMe to tell
+  "no customers" apart from "polling is broken";
+- restarts polling with exponential backoff when it exits or stalls;
+- disables the bot (no more restarts) when Telegram rejects the token;
+- cancels polling and auxiliary per-bot tasks cleanly on stop().
+"""
+
+import asyncio
+import os
+import time
+
+STATE_STARTING = "starting"
+STATE_RUNNING = "running"
+STATE_BACKOFF = "backoff"
+STATE_DISABLED = "disabled"
+STATE_STOPPED = "stopped"
+
+BOT_BACKOFF_BASE = float(os.getenv("BOT_BACKOFF_BASE", "2"))
+BOT_BACKOFF_MAX = float(os.getenv("BOT_BACKOFF_MAX", "300"))
+BOT_STALL_TIMEOUT = float(os.getenv("BOT_STALL_TIMEOUT", "120"))
+BOT_HEALTH_INTERVAL = float(os.getenv("BOT_HEALTH_INTERVAL", "30"))
+
+
+def _is_unauthorized(exc: BaseException | None) -> bool:
+    """Telegram rejected the token (revoked / deleted bot) — restarting won't help."""
+    if exc is None:
+        return False
+    try:
+        from aiogram.exceptions import TelegramUnauthorizedError
+    except Exception:  # pragma: no cover - aiogram is always installed in prod
+        return False
+    return isinstance(exc, TelegramUnauthorizedError)
+
+
+class BotHandle:
+    """Runtime state of one supervised bot."""
+
+    __slots__ = (
+        "bot_id", "bot", "dp", "username",
+        "state", "task", "poll_task", "aux_tasks",
+        "started_at", "last_update_at", "last_ok_at",
+        "failures", "restarts", "last_error", "next_retry_at",
+    )
+
+    def __init__(self, bot_id: int, bot, dp, username: str | None = None):
+        self.bot_id = bot_id
+        self.bot = bot
+        self.dp = dp
+        self.username = username
+        self.state = STATE_STARTING
+        self.task: asyncio.Task | None = None
+        self.poll_task: asyncio.Task | None = None
+        self.aux_tasks: list[asyncio.Task] = []
+        now = time.time()
+        self.started_at = now
+        self.last_update_at: float | None = None
+        self.last_ok_at = now
+        self.failures = 0
+        self.restarts = 0
+        self.last_error: str | None = None
+        self.next_retry_at: float | None = None
+
+    def status(self) -> dict:
+        return {
+            "bot_id": self.bot_id,
+            "username": self.username,
+            "state": self.state,
+            "started_at": int(self.started_at),
+            "last_update_at": int(self.last_update_at) if self.last_update_at else None,
+            "last_ok_at": int(self.last_ok_at) if self.last_ok_at else None,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "next_retry_at": int(self.next_retry_at) if self.next_retry_at else None,
+        }
+
+
+class _LastUpdateMiddleware:
+    """Outer update middleware: stamps the handle on every incoming update."""
+
+    def __init__(self, handle: BotHandle):
+        self._handle = handle
+
+    async def __call__(self, handler, event, data):
+        now = time.time()
+        self._handle.last_update_at = now
+        self._handle.last_ok_at = now
+        return await handler(event, data)
+
+
+class BotSupervisor:
+    def __init__(
+        self,
+        backoff_base: float = BOT_BACKOFF_BASE,
+        backoff_max: float = BOT_BACKOFF_MAX,
+        stall_timeout: float = BOT_STALL_TIMEOUT,
+        health_interval: float = BOT_HEALTH_INTERVAL,
+    ):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stall_timeout = stall_timeout
+        self.health_interval = health_interval
+        self._handles: dict[int, BotHandle] = {}
+
+    # --- public API ---
+    def start(self, bot_id: int, bot, dp, username: str | None = None) -> BotHandle:
+        """Take ownership of polling for this bot. The bot must not be supervised yet."""
+        if bot_id in self._handles:
+            raise RuntimeError(f"bot {bot_id} is already supervised")
+        handle = BotHandle(bot_id, bot, dp, username)
+        dp.update.outer_middleware(_LastUpdateMiddleware(handle))
+        handle.task = asyncio.create_task(self._run(handle), name=f"bot-supervisor-{bot_id}")
+        self._handles[bot_id] = handle
+        return handle
+
+    def add_task(self, bot_id: int, coro) -> asyncio.Task | None:
+        """Run an auxiliary coroutine (e.g. auto-cancel loop) tied to the bot's lifetime."""
+        handle = self._handles.get(bot_id)
+        if handle is None:
+            coro.close()
+            return None
+        t = asyncio.create_task(coro, name=f"bot-aux-{bot_id}")
+        handle.aux_tasks.append(t)
+        return t
+
+    async def stop(self, bot_id: int):
+        """Cancel polling + auxiliary tasks and close the HTTP session."""
+        handle = self._handles.pop(bot_id, None)
+        if handle is None:
+            return
+        handle.state = STATE_STOPPED
+        tasks = [t for t in [handle.task, handle.poll_task, *handle.aux_tasks] if t and not t.done()]
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await handle.bot.session.close()
+        except Exception:
+            pass
+
+    async def stop_all(self):
+        for bot_id in list(self._handles):
+            await self.stop(bot_id)
+
+    def get(self, bot_id: int) -> BotHandle | None:
+        return self._handles.get(bot_id)
+
+    def status(self, bot_id: int) -> dict | None:
+        handle = self._handles.get(bot_id)
+        return handle.status() if handle else None
+
+    def statuses(self) -> list[dict]:
+        return [h.status() for h in self._handles.values()]
+
+    # --- internals ---
+    def _backoff_delay(self, failures: int) -> float:
+        return min(self.backoff_max, self.backoff_base * (2 ** max(0, failures - 1)))
+
+    async def _health_loop(self, handle: BotHandle) -> str:
+        """Returns a reason string when polling should be restarted."""
+        while True:
+            await asyncio.sleep(self.health_interval)
+            if handle.poll_task is None or handle.poll_task.done():
+                return "polling exited"
+            now = time.time()
+            if now - handle.last_ok_at < self.stall_timeout:
+                continue
+            # Давно не было апдейтов — проверяем, жив ли токен/сеть
+            try:
+                await asyncio.wait_for(handle.bot.get_me(), timeout=max(5.0, self.health_interval))
+                handle.last_ok_at = time.time()
+            except Exception as e:
+                if _is_unauthorized(e):
+                    raise
+                return f"health check failed: {type(e).__name__}: {e}"
+
+    async def _run(self, handle: BotHandle):
+        while True:
+            handle.state = STATE_RUNNING
+            handle.next_retry_at = None
+            handle.last_ok_at = time.time()
+            run_started = time.time()
+            handle.poll_task = asyncio.create_task(
+                handle.dp.start_polling(handle.bot, handle_signals=False, close_bot_session=False),
+                name=f"bot-polling-{handle.bot_id}",
+            )
+            health = asyncio.create_task(self._health_loop(handle), name=f"bot-health-{handle.bot_id}")
+            error: BaseException | None = None
+            reason = "polling exited"
+            try:
+                done, _ = await asyncio.wait({handle.poll_task, health}, return_when=asyncio.FIRST_COMPLETED)
+                if health in done:
+                    try:
+                        reason = health.result()
+                    except Exception as e:
+                        error = e
+                        reason = f"{type(e).__name__}: {e}"
+                if handle.poll_task in done and error is None:
+                    exc = handle.poll_task.exception()
+                    if exc is not None:
+                        error = exc
+                        reason = f"{type(exc).__name__}: {exc}"
+            finally:
+                for t in (handle.poll_task, health):
+                    if not t.done():
+                        t.cancel()
+                await asyncio.gather(handle.poll_task, health, return_exceptions=True)
+
+            handle.last_error = reason
+            if _is_unauthorized(error):
+                handle.state = STATE_DISABLED
+                print(f"Бот {handle.bot_id}: токен отклонён Telegram, перезапуски отключены ({reason})")
+                return
+
+            # Если бот проработал дольше stall_timeout — считаем это не "серией" падений
+            if time.time() - run_started > self.stall_timeout:
+                handle.failures = 0
+            handle.failures += 1
+            handle.restarts += 1
+            delay = self._backoff_delay(handle.failures)
+            handle.state = STATE_BACKOFF
+            handle.next_retry_at = time.time() + delay
+            print(f"Бот {handle.bot_id}: polling остановился ({reason}), перезапуск через {delay:.0f} с")
+            await asyncio.sleep(delay)
@@ -1,50 +1,56 @@
 import os
 import time
 import re
-import uuid
 import secrets
-import smtplib
-import ssl
 import asyncio
-from email.message import EmailMessage
 from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
 
 from typing import List
 
 from fastapi import Form, Request, Depends, HTTPException, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 from connection import conn, cur
-from core.utils import safe_filename, safe_return_to, set_qp, normalize_notify_chat_id
-from core.security import hash_password, verify_password
+from repo import db_load_dashboard, db_load_category_tree, db_get_node_products_page
+from core.utils import safe_return_to, set_qp, normalize_notify_chat_id
+from core.security import PasswordPoolBusy, needs_rehash, password_hasher
+from core.sessions import SESSION_COOKIE, SessionStore
+from core.mailer import email_sender, enqueue_email
+from core.images import image_pipeline
+from core.uploads import UploadRejected, remove_images, save_image, save_images
 from aiogram import Bot
-from app_bot.manager import active_bots, launch_bot, stop_bot, DEFAULT_BOT_COMMANDS
+from app_bot.manager import (
+    active_bots,
+    claim_bot,
+    stop_bot,
+    bot_status,
+    shard_status,
+    cache_status,
+    invalidate_bot_settings,
+    invalidate_cashiers,
+    DEFAULT_BOT_COMMANDS,
+)
 
 
 def register_routes(app):
     """Attach all web routes to the given FastAPI app."""
     templates = Jinja2Templates(directory="templates")
+    sessions = SessionStore(conn)
 
     # === Аутентификация ===
     def get_current_user(request: Request):
-        user = (request.cookies.get('user') or '').strip().lower()
+        # подпись токена + кэш проверенных сессий; в БД — только при промахе кэша
+        user = sessions.validate(request.cookies.get(SESSION_COOKIE))
         if not user:
             raise HTTPException(status_code=303, headers={'Location': '/login'})
-        cur.execute('SELECT 1 FROM accounts WHERE email=? AND is_verified=1', (user,))
-        if not cur.fetchone():
-            raise HTTPException(status_code=303, headers={'Location': '/login'})
         return user
 
 
-    # === Email (SMTP) ===
-    SMTP_HOST = os.getenv("SMTP_HOST", "smtp.yandex.ru")
-    SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
-    SMTP_USER = os.getenv("SMTP_USER", "")  # например: mybox@yandex.ru
-    SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")  # пароль приложения
-    SMTP_FROM = os.getenv("SMTP_FROM", SMTP_USER)
+    # === Email (письма уходят через outbox, см. core/mailer.py) ===
     APP_BASE_URL = os.getenv("APP_BASE_URL", "http://127.0.0.1:8000").rstrip("/")
-    EMAIL_ENABLED = os.getenv("EMAIL_ENABLED", "1") == "1"
+
+    PASSWORD_BUSY_MSG = "Сервер перегружен, попробуйте через минуту"
 
     _email_re = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 
@@ -61,40 +67,29 @@ def register_routes(app):
             url += "?" + urlencode(params)
         return url
 
-    def send_email(to_email: str, subject: str, text_body: str, html_body: str | None = None):
-        if not EMAIL_ENABLED:
-            return
-        if not SMTP_USER or not SMTP_PASSWORD or not SMTP_FROM:
-            raise RuntimeError("SMTP не настроен: укажи SMTP_USER / SMTP_PASSWORD / SMTP_FROM (env).")
-
-        msg = EmailMessage()
-        msg["From"] = SMTP_FROM
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.set_content(text_body)
-        if html_body:
-            msg.add_alternative(html_body, subtype="html")
-
-        ctx = ssl.create_default_context()
-        if SMTP_PORT == 465:
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ctx) as s:
-                s.login(SMTP_USER, SMTP_PASSWORD)
-                s.send_message(msg)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s:
-                s.ehlo()
-                s.starttls(context=ctx)
-                s.login(SMTP_USER, SMTP_PASSWORD)
-                s.send_message(msg)
+    # === Частичные обновления панели (static/dashboard_live.js) ===
+    # Сколько товаров узла отдаётся за раз при раскрытии категории / «Показать ещё»
+    DASHBOARD_PAGE_SIZE = max(1, int(os.getenv("DASHBOARD_PAGE_SIZE", "30")))
+
+    def _wants_fragment(request: Request) -> bool:
+        return request.headers.get("x-fragment") == "1"
 
-    async def send_email_async(to_email: str, subject: str, text_body: str, html_body: str | None = None):
-        # чтобы не блокировать event loop
-        return await asyncio.to_thread(send_email, to_email, subject, text_body, html_body)
+    def _reply(request: Request, url: str, *, replace=None, order=None, rows=None, msg=None, err=None):
+        """Redirect for a plain form post; only the changed rows / new order as JSON for fetch."""
+        if _wants_fragment(request):
+            return JSONResponse(
+                {"replace": replace or {}, "order": order or {}, "rows": rows or {}, "msg": msg, "err": err}
+            )
+        return RedirectResponse(url, status_code=303)
+
+    def _menu_row(macro: str, **kwargs) -> str:
+        """Render one summary row from templates/_menu_rows.html."""
+        return str(getattr(templates.env.get_template("_menu_rows.html").module, macro)(**kwargs))
 
     # === Маршруты ===
     @app.get("/")
     async def home(request: Request):
-        if request.cookies.get("user"):
+        if sessions.validate(request.cookies.get(SESSION_COOKIE)):
             return RedirectResponse("/dashboard", status_code=303)
         return templates.TemplateResponse("home.html", {"request": request, "is_logged_in": False})
 
@@ -140,107 +135,69 @@ def register_routes(app):
 
     @app.get("/dashboard")
     async def dashboard(request: Request, user: str = Depends(get_current_user)):
-        cur.execute(
-            """SELECT bot_id, username, about,
-                        notify_chat_id,
-                        allow_in_hall, allow_takeaway, allow_delivery,
-                        timezone, work_start, work_end, restrict_orders,
-                        auto_cancel_minutes, auto_cancel_enabled,
-                        bonuses_enabled,
-                        bonus_percent,
-                        max_bonus_pay_percent,
-                        min_order_for_bonus,
-                        bonus_expire_days,
-                        welcome_bonus,
-                        payments_enabled,
-                        payment_provider_token,
-                        min_order_total
-                FROM bots WHERE owner=?""",
-            (user,),
+        # Каркас панели (боты, категории, кассиры, фото меню) — фиксированным числом запросов;
+        # содержимое категорий страница догружает через /dashboard/category
+        data = db_load_dashboard(conn, user)
+        return templates.TemplateResponse(
+            "dashboard.html",
+            {
+                "request": request,
+                "user": user,
+                "bots": data["bots"],
+                "categories": data["categories"],
+                "menu_photos_by_bot": data["menu_photos"],
+                "cashiers": data["cashiers"],
+            },
         )
-        bots = cur.fetchall()
-
-        categories = {}
-        subcategories_root = {}     # cat_id -> list(root subcats)
-        subcategories_children = {} # parent_subcat_id -> list(child subcats)
-        products_by_subcat = {}     # subcat_id -> list(products (8 полей))
-        products_by_cat = {}         # cat_id -> list(products for category root)
-        cashiers = {}
-
-        def get_menu_photos(bot_id: int):
-            cur.execute("SELECT id, photo_path FROM menu_photos WHERE bot_id=? ORDER BY sort_order, id", (bot_id,))
-            return [{"id": r[0], "photo_path": r[1]} for r in cur.fetchall()]
-
-        for bot in bots:
-            bot_id = bot[0]
-
-            cur.execute("SELECT cashier_id FROM cashiers WHERE bot_id=? ORDER BY cashier_id", (bot_id,))
-            cashiers[bot_id] = [r[0] for r in cur.fetchall()]
-
-            cur.execute(
-                "SELECT id, bot_id, name, photo_path, enabled, sort_order FROM categories WHERE bot_id=? ORDER BY sort_order, id",
-                (bot_id,),
-            )
-            cats = cur.fetchall()
-            categories[bot_id] = cats
-
-            for cat in cats:
-                cat_id = cat[0]
-                cur.execute(
-                    """
-                    SELECT id, bot_id, cat_id, name, enabled, sort_order, photo_path, parent_subcat_id
-                    FROM subcategories
-                    WHERE bot_id=? AND cat_id=?
-                    ORDER BY parent_subcat_id, sort_order, id
-                    """,
-                    (bot_id, cat_id),
-                )
-                rows = cur.fetchall()
-
-                roots = []
-                for sub in rows:
-                    pid = sub[7]
-                    if pid is None:
-                        roots.append(sub)
-                    else:
-                        subcategories_children.setdefault(pid, []).append(sub)
-
-                subcategories_root[cat_id] = roots
 
-            cur.execute(
-                """
-                SELECT id, bot_id, cat_id, name, price, description, photo_path, enabled, subcat_id
-                FROM products
-                WHERE bot_id=?
-                ORDER BY cat_id, subcat_id, sort_order, id
-                """,
-                (bot_id,),
-            )
-            for row in cur.fetchall():
-                cat_id = row[2]
-                subcat_id = row[8]
-                p = row[:8]
-                if subcat_id in (None, 0):
-                    products_by_cat.setdefault(cat_id, []).append(p)
-                else:
-                    products_by_subcat.setdefault(subcat_id, []).append(p)
+    @app.get("/dashboard/category", response_class=HTMLResponse)
+    async def dashboard_category(request: Request, bot_id: int, cat_id: int, user: str = Depends(get_current_user)):
+        """Subtree of one category (HTML fragment), loaded when it is expanded."""
+        cur.execute(
+            """SELECT c.id, c.bot_id, c.name, c.photo_path, c.enabled, c.sort_order
+               FROM categories c JOIN bots b ON b.bot_id = c.bot_id
+               WHERE c.id=? AND c.bot_id=? AND b.owner=?""",
+            (cat_id, bot_id, user),
+        )
+        cat = cur.fetchone()
+        if not cat:
+            return HTMLResponse('<div class="menu-body"><div class="menu-empty">Категория не найдена.</div></div>', status_code=404)
 
+        tree = db_load_category_tree(conn, bot_id, cat_id, DASHBOARD_PAGE_SIZE)
         return templates.TemplateResponse(
-            "dashboard.html",
+            "_category_body.html",
             {
                 "request": request,
-                "user": user,
-                "bots": bots,
-                "categories": categories,
-                "subcategories_root": subcategories_root,
-                "subcategories_children": subcategories_children,
-                "products_by_subcat": products_by_subcat,
-                "products_by_cat": products_by_cat,
-                "get_menu_photos": get_menu_photos,
-                "cashiers": cashiers,
+                "bot_id": bot_id,
+                "cat": cat,
+                "subcategories_root": tree["subcategories_root"],
+                "subcategories_children": tree["subcategories_children"],
+                "products": tree["products"],
+                "totals": tree["totals"],
             },
         )
 
+    @app.get("/dashboard/products", response_class=HTMLResponse)
+    async def dashboard_products(
+        bot_id: int,
+        cat_id: int,
+        subcat_id: str = "",
+        offset: int = 0,
+        user: str = Depends(get_current_user),
+    ):
+        """Next page of a node's products: rows plus a new «Показать ещё» if more remain."""
+        if not _subcat_owner_ok(bot_id, user):
+            return HTMLResponse("", status_code=404)
+        sc = int(subcat_id) if subcat_id.strip().isdigit() and int(subcat_id) != 0 else None
+        offset = max(0, offset)
+
+        rows, total = db_get_node_products_page(conn, bot_id, cat_id, sc, offset, DASHBOARD_PAGE_SIZE)
+        parts = [_menu_row("prod_item", prod=row, bot_id=bot_id, cat_id=cat_id, subcat_id=sc) for row in rows]
+        loaded = offset + len(rows)
+        if rows and loaded < total:
+            parts.append(_menu_row("more_button", bot_id=bot_id, cat_id=cat_id, subcat_id=sc, offset=loaded, remaining=total - loaded))
+        return HTMLResponse("".join(parts))
+
     @app.post("/add_subcategory")
 
     async def add_subcategory(
@@ -379,27 +336,13 @@ def register_routes(app):
 
         # фото (опционально)
 
-        photo_path = None
-
-        if photo and getattr(photo, "filename", None):
-
-            photo_bytes = await photo.read()
-
-            if photo_bytes:
-
-                ext = os.path.splitext(photo.filename)[1].lower()
-
-                if ext not in (".jpg", ".jpeg", ".png", ".webp", ".gif"):
-
-                    ext = ".jpg"
-
-                os.makedirs("static/subcategories", exist_ok=True)
+        try:
 
-                photo_path = f"static/subcategories/{bot_id}_{int(cat_id)}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
+            photo_path = await save_image(conn, photo)
 
-                with open(photo_path, "wb") as f:
+        except UploadRejected as e:
 
-                    f.write(photo_bytes)
+            return RedirectResponse(set_qp(safe_return_to(return_to, f"/dashboard#cat-{cat_id}"), "err", str(e)), status_code=303)
 
 
         cur.execute(
@@ -490,32 +433,13 @@ def register_routes(app):
 
         # photo handling
         photo_path = old_photo
-        if photo and getattr(photo, "filename", None) and photo.filename:
-            photo_bytes = await photo.read()
-            if photo_bytes:
-                os.makedirs("static/subcategories", exist_ok=True)
-
-                safe_name = safe_filename(photo.filename, default="subcat.jpg")
-                _, ext = os.path.splitext(safe_name)
-                ext = (ext or ".jpg").lower()
-                if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-                    ext = ".jpg"
-
-                photo_path = f"static/subcategories/{bot_id}_{real_cat_id}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
-                with open(photo_path, "wb") as f:
-                    f.write(photo_bytes)
-
-                if old_photo and os.path.exists(old_photo):
-                    try:
-                        os.remove(old_photo)
-                    except Exception:
-                        pass
-        elif delete_photo == "on" and old_photo:
-            try:
-                if os.path.exists(old_photo):
-                    os.remove(old_photo)
-            except Exception:
-                pass
+        try:
+            new_photo = await save_image(conn, photo)
+        except UploadRejected as e:
+            return RedirectResponse(set_qp(safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"), "err", str(e)), status_code=303)
+        if new_photo:
+            photo_path = new_photo
+        elif delete_photo == "on":
             photo_path = None
 
         en = 1 if int(enabled) == 1 else 0
@@ -524,6 +448,9 @@ def register_routes(app):
             (nm, en, photo_path, subcat_id, bot_id),
         )
         conn.commit()
+        # ссылка строки на старое фото снята (файл удалится, если больше никем не используется)
+        if new_photo or delete_photo == "on":
+            await remove_images(conn, old_photo)
 
         target = set_qp(safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"), "msg", "Подкатегория обновлена")
         return RedirectResponse(target, status_code=303)
@@ -560,17 +487,14 @@ def register_routes(app):
         cur.execute("DELETE FROM subcategories WHERE id=? AND bot_id=?", (subcat_id, bot_id))
         conn.commit()
 
-        if photo_path and os.path.exists(photo_path):
-            try:
-                os.remove(photo_path)
-            except:
-                pass
+        await remove_images(conn, photo_path)
 
         _subcat_renumber(bot_id, real_cat_id, parent_id)
         return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"), status_code=303)
 
     @app.post("/move_subcategory")
     async def move_subcategory(
+        request: Request,
         bot_id: int = Form(...),
         cat_id: int = Form(...),
         subcat_id: int = Form(...),
@@ -579,7 +503,7 @@ def register_routes(app):
         user: str = Depends(get_current_user),
     ):
         if not _subcat_owner_ok(bot_id, user):
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нет доступа"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нет доступа"), err="Нет доступа")
 
         cur.execute(
             "SELECT cat_id, parent_subcat_id FROM subcategories WHERE id=? AND bot_id=?",
@@ -587,7 +511,7 @@ def register_routes(app):
         )
         row = cur.fetchone()
         if not row:
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Подкатегория не найдена"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Подкатегория не найдена"), err="Подкатегория не найдена")
 
         real_cat_id = int(row[0])
         parent_id = row[1]
@@ -597,15 +521,17 @@ def register_routes(app):
                 "SELECT id FROM subcategories WHERE bot_id=? AND cat_id=? AND parent_subcat_id IS NULL ORDER BY sort_order, id",
                 (bot_id, real_cat_id),
             )
+            list_id = f"subs-c-{real_cat_id}"
         else:
             cur.execute(
                 "SELECT id FROM subcategories WHERE bot_id=? AND cat_id=? AND parent_subcat_id=? ORDER BY sort_order, id",
                 (bot_id, real_cat_id, int(parent_id)),
             )
+            list_id = f"subs-s-{int(parent_id)}"
 
         ids = [r[0] for r in cur.fetchall()]
         if subcat_id not in ids:
-            return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"), status_code=303)
+            return _reply(request, safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"))
 
         i = ids.index(subcat_id)
         if direction == "up" and i > 0:
@@ -613,13 +539,17 @@ def register_routes(app):
         elif direction == "down" and i < len(ids) - 1:
             ids[i + 1], ids[i] = ids[i], ids[i + 1]
         else:
-            return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"), status_code=303)
+            return _reply(request, safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"))
 
         for idx, sid in enumerate(ids, start=1):
             cur.execute("UPDATE subcategories SET sort_order=? WHERE bot_id=? AND id=?", (idx, bot_id, sid))
 
         conn.commit()
-        return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"), status_code=303)
+        return _reply(
+            request,
+            safe_return_to(return_to, f"/dashboard#cat-{real_cat_id}"),
+            order={list_id: [f"subcat-{sid}" for sid in ids]},
+        )
 
     @app.get("/register")
     async def register_get(request: Request):
@@ -648,6 +578,7 @@ def register_routes(app):
                 WHERE bot_id = ?""",
                 (enabled, bonus_percent, max_bonus_pay_percent, min_order_for_bonus, bonus_expire_days, welcome_bonus, bot_id))
             conn.commit()
+            invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Настройки бонусной системы сохранены!", status_code=303)
 
     @app.post("/save_min_order")
@@ -669,6 +600,7 @@ def register_routes(app):
                 val = 1_000_000
             cur.execute("UPDATE bots SET min_order_total=? WHERE bot_id=?", (val, bot_id))
             conn.commit()
+            invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Минимальная сумма заказа сохранена!", status_code=303)
 
 
@@ -692,7 +624,24 @@ def register_routes(app):
 
         cur.execute("UPDATE bots SET payments_enabled=?, payment_provider_token=? WHERE bot_id=?", (enabled, token, bot_id))
         conn.commit()
+        invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Настройки оплаты сохранены!", status_code=303)
+
+    @app.post("/save_navigation_settings")
+    async def save_navigation_settings(
+        bot_id: int = Form(),
+        inline_nav: str = Form("off"),
+        user: str = Depends(get_current_user),
+    ):
+        cur.execute("SELECT 1 FROM bots WHERE bot_id=? AND owner=?", (bot_id, user))
+        if not cur.fetchone():
+            return RedirectResponse("/dashboard", status_code=303)
+
+        enabled = 1 if inline_nav == "on" else 0
+        cur.execute("UPDATE bots SET inline_nav=? WHERE bot_id=?", (enabled, bot_id))
+        conn.commit()
+        invalidate_bot_settings(bot_id)
+        return RedirectResponse("/dashboard?msg=Настройки навигации сохранены!", status_code=303)
     # === КАССИРЫ (админка) ===
     @app.post("/add_cashier")
     async def add_cashier(
@@ -712,6 +661,7 @@ def register_routes(app):
 
         cur.execute("INSERT INTO cashiers (bot_id, cashier_id) VALUES (?, ?) ON CONFLICT (bot_id, cashier_id) DO NOTHING", (bot_id, cid))
         conn.commit()
+        invalidate_cashiers(bot_id)
         return RedirectResponse(f"/dashboard?msg=Кассир добавлен&bot={bot_id}", status_code=303)
 
 
@@ -727,6 +677,7 @@ def register_routes(app):
 
         cur.execute("DELETE FROM cashiers WHERE bot_id=? AND cashier_id=?", (bot_id, cashier_id))
         conn.commit()
+        invalidate_cashiers(bot_id)
         return RedirectResponse(f"/dashboard?msg=Кассир удалён&bot={bot_id}", status_code=303)
 
     @app.post("/upload_category_photo")
@@ -742,35 +693,26 @@ def register_routes(app):
         if not cur.fetchone():
             return RedirectResponse("/dashboard", status_code=303)
 
-        photo_path = None
-        if photo and photo.filename:
-            photo_bytes = await photo.read()
-            os.makedirs("static/categories", exist_ok=True)
-
-            # расширение берём из исходного файла (или .jpg если пусто)
-            _, ext = os.path.splitext(photo.filename)
-            ext = ext.lower() if ext else ".jpg"
-            if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-                ext = ".jpg"
-
-            photo_path = f"static/categories/cat_{cat_id}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
-
-            with open(photo_path, "wb") as f:
-                f.write(photo_bytes)
+        # расширение определяется по содержимому файла
+        try:
+            photo_path = await save_image(conn, photo)
+        except UploadRejected as e:
+            return RedirectResponse(set_qp("/dashboard", "err", str(e)), status_code=303)
 
-        # Удаляем старое фото, если было
         cur.execute("SELECT photo_path FROM categories WHERE id=?", (cat_id,))
         old = cur.fetchone()
-        if old and old[0] and os.path.exists(old[0]):
-            try: os.remove(old[0])
-            except: pass
 
         cur.execute("UPDATE categories SET photo_path = ? WHERE id = ?", (photo_path, cat_id))
         conn.commit()
 
+        # Освобождаем старое фото, если было
+        if old:
+            await remove_images(conn, old[0])
+
         return RedirectResponse("/dashboard?msg=Фото категории загружено!", status_code=303)
     @app.post("/move_category")
     async def move_category(
+        request: Request,
         bot_id: int = Form(),
         cat_id: int = Form(),
         direction: str = Form(),
@@ -780,13 +722,13 @@ def register_routes(app):
         # Проверяем владельца
         cur.execute("SELECT 1 FROM bots WHERE bot_id=? AND owner=?", (bot_id, user))
         if not cur.fetchone():
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Нет доступа"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Нет доступа"), err="Нет доступа")
 
         # Берём текущий порядок
         cur.execute("SELECT id FROM categories WHERE bot_id=? ORDER BY sort_order, id", (bot_id,))
         ids = [r[0] for r in cur.fetchall()]
         if cat_id not in ids:
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Категория не найдена"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Категория не найдена"), err="Категория не найдена")
 
         i = ids.index(cat_id)
 
@@ -795,7 +737,7 @@ def register_routes(app):
         elif direction == "down" and i < len(ids) - 1:
             ids[i + 1], ids[i] = ids[i], ids[i + 1]
         else:
-            return RedirectResponse(safe_return_to(return_to, "/dashboard"), status_code=303)
+            return _reply(request, safe_return_to(return_to, "/dashboard"))
 
 
 
@@ -807,10 +749,11 @@ def register_routes(app):
             )
         conn.commit()
 
-        return RedirectResponse(safe_return_to(return_to, "/dashboard"), status_code=303)
+        return _reply(request, safe_return_to(return_to, "/dashboard"), order={f"cats-{bot_id}": [f"cat-{cid}" for cid in ids]})
 
     @app.post("/move_product")
     async def move_product(
+        request: Request,
         bot_id: int = Form(),
         cat_id: int = Form(),
         subcat_id: str | None = Form(None),
@@ -822,7 +765,7 @@ def register_routes(app):
         # Проверяем владельца
         cur.execute("SELECT 1 FROM bots WHERE bot_id=? AND owner=?", (bot_id, user))
         if not cur.fetchone():
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Нет доступа"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Нет доступа"), err="Нет доступа")
 
         # Берём текущий порядок товаров внутри категории/подкатегории
 
@@ -846,7 +789,7 @@ def register_routes(app):
 
         ids = [r[0] for r in cur.fetchall()]
         if prod_id not in ids:
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Товар не найден"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Товар не найден"), err="Товар не найден")
 
         i = ids.index(prod_id)
 
@@ -855,7 +798,7 @@ def register_routes(app):
         elif direction == "down" and i < len(ids) - 1:
             ids[i + 1], ids[i] = ids[i], ids[i + 1]
         else:
-            return RedirectResponse(safe_return_to(return_to, "/dashboard"), status_code=303)
+            return _reply(request, safe_return_to(return_to, "/dashboard"))
 
         # Перенумеровываем sort_order подряд (с 1)
         for idx, pid in enumerate(ids, start=1):
@@ -865,7 +808,22 @@ def register_routes(app):
             )
         conn.commit()
 
-        return RedirectResponse(safe_return_to(return_to, "/dashboard"), status_code=303)
+        list_id = f"prods-c-{cat_id}" if sc is None else f"prods-s-{sc}"
+        rows = None
+        if _wants_fragment(request):
+            # Сосед мог быть ещё не загружен («Показать ещё») — отдаём обе строки пары целиком
+            first = i - 1 if direction == "up" else i
+            page, _ = db_get_node_products_page(conn, bot_id, cat_id, sc, first, 2)
+            rows = {
+                f"prod-{r[0]}": _menu_row("prod_item", prod=r, bot_id=bot_id, cat_id=cat_id, subcat_id=sc)
+                for r in page
+            }
+        return _reply(
+            request,
+            safe_return_to(return_to, "/dashboard"),
+            order={list_id: [f"prod-{pid}" for pid in ids]},
+            rows=rows,
+        )
 
     @app.post("/delete_category")
     async def delete_category(cat_id: int = Form(), bot_id: int = Form(), return_to: str | None = Form(None), user: str = Depends(get_current_user)):
@@ -886,30 +844,48 @@ def register_routes(app):
         if cnt > 0:
             return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нельзя удалить категорию: сначала удалите товары из неё"), status_code=303)
 
-        # 3) можно удалять
+        # 3) можно удалять; подкатегории удалятся каскадом — их фото тоже освобождаем
+        cur.execute(
+            "SELECT photo_path FROM categories WHERE id = ? UNION ALL SELECT photo_path FROM subcategories WHERE cat_id = ?",
+            (cat_id, cat_id),
+        )
+        photos = [r[0] for r in cur.fetchall() if r[0]]
         cur.execute("DELETE FROM categories WHERE id = ? AND bot_id = ?", (cat_id, bot_id))
         conn.commit()
+        await remove_images(conn, *photos)
         return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Категория удалена"), status_code=303)
     @app.post("/toggle_category")
     async def toggle_category(
+        request: Request,
         bot_id: int = Form(...),
         cat_id: int = Form(...),
         return_to: str | None = Form(None),
         user: str = Depends(get_current_user),
     ):
         if not _subcat_owner_ok(bot_id, user):
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нет доступа"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нет доступа"), err="Нет доступа")
 
-        cur.execute("SELECT enabled FROM categories WHERE bot_id=? AND id=?", (bot_id, cat_id))
+        # Для строки дашборда — превью (как в _DASHBOARD_QUERIES), а не Telegram-вариант
+        cur.execute(
+            """SELECT c.id, c.bot_id, c.name, COALESCE(v.thumb_path, c.photo_path), c.enabled, c.sort_order
+               FROM categories c LEFT JOIN image_variants v ON v.path = c.photo_path
+               WHERE c.bot_id=? AND c.id=?""",
+            (bot_id, cat_id),
+        )
         row = cur.fetchone()
         if not row:
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Категория не найдена"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Категория не найдена"), err="Категория не найдена")
 
-        enabled = int(row[0]) if row[0] is not None else 1
+        enabled = int(row[4]) if row[4] is not None else 1
         new_val = 0 if enabled == 1 else 1
         cur.execute("UPDATE categories SET enabled=? WHERE bot_id=? AND id=?", (new_val, bot_id, cat_id))
         conn.commit()
-        return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{cat_id}"), status_code=303)
+
+        replace = None
+        if _wants_fragment(request):
+            cat = row[:4] + (new_val,) + row[5:]
+            replace = {f"row-cat-{cat_id}": _menu_row("cat_row", cat=cat, bot_id=bot_id)}
+        return _reply(request, safe_return_to(return_to, f"/dashboard#cat-{cat_id}"), replace=replace)
 
 
     @app.get("/edit_category")
@@ -979,36 +955,15 @@ def register_routes(app):
         photo_path = old_photo
 
         # Новое фото
-        if photo and getattr(photo, "filename", None):
-            photo_bytes = await photo.read()
-            if photo_bytes:
-                os.makedirs("static/categories", exist_ok=True)
-
-                safe_name = safe_filename(photo.filename, default="category.jpg")
-                _, ext = os.path.splitext(safe_name)
-                ext = (ext or ".jpg").lower()
-                if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-                    ext = ".jpg"
-
-                photo_path = f"static/categories/cat_{bot_id}_{cat_id}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
-                with open(photo_path, "wb") as f:
-                    f.write(photo_bytes)
-
-                # удаляем старое фото (если было)
-                if old_photo:
-                    try:
-                        if os.path.exists(old_photo):
-                            os.remove(old_photo)
-                    except Exception:
-                        pass
+        try:
+            new_photo = await save_image(conn, photo)
+        except UploadRejected as e:
+            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", str(e)), status_code=303)
+        if new_photo:
+            photo_path = new_photo
 
         # Удалить текущее фото
-        elif delete_photo == "on" and old_photo:
-            try:
-                if os.path.exists(old_photo):
-                    os.remove(old_photo)
-            except Exception:
-                pass
+        elif delete_photo == "on":
             photo_path = None
 
         cur.execute(
@@ -1017,11 +972,15 @@ def register_routes(app):
         )
 
         conn.commit()
+        # освобождаем старое фото (если было)
+        if new_photo or delete_photo == "on":
+            await remove_images(conn, old_photo)
         return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{cat_id}"), status_code=303)
 
 
     @app.post("/toggle_subcategory")
     async def toggle_subcategory(
+        request: Request,
         bot_id: int = Form(...),
         cat_id: int = Form(...),
         subcat_id: int = Form(...),
@@ -1029,18 +988,35 @@ def register_routes(app):
         user: str = Depends(get_current_user),
     ):
         if not _subcat_owner_ok(bot_id, user):
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нет доступа"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Нет доступа"), err="Нет доступа")
 
-        cur.execute("SELECT enabled FROM subcategories WHERE bot_id=? AND cat_id=? AND id=?", (bot_id, cat_id, subcat_id))
+        cur.execute(
+            """SELECT s.id, s.bot_id, s.cat_id, s.name, s.enabled, s.sort_order,
+                      COALESCE(v.thumb_path, s.photo_path), s.parent_subcat_id
+               FROM subcategories s LEFT JOIN image_variants v ON v.path = s.photo_path
+               WHERE s.bot_id=? AND s.cat_id=? AND s.id=?""",
+            (bot_id, cat_id, subcat_id),
+        )
         row = cur.fetchone()
         if not row:
-            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Подкатегория не найдена"), status_code=303)
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Подкатегория не найдена"), err="Подкатегория не найдена")
 
-        enabled = int(row[0]) if row[0] is not None else 1
+        enabled = int(row[4]) if row[4] is not None else 1
         new_val = 0 if enabled == 1 else 1
         cur.execute("UPDATE subcategories SET enabled=? WHERE bot_id=? AND id=?", (new_val, bot_id, subcat_id))
         conn.commit()
-        return RedirectResponse(safe_return_to(return_to, f"/dashboard#cat-{cat_id}"), status_code=303)
+
+        replace = None
+        if _wants_fragment(request):
+            children = 0
+            if row[7] is None:
+                cur.execute("SELECT COUNT(*) FROM subcategories WHERE bot_id=? AND parent_subcat_id=?", (bot_id, subcat_id))
+                children = int(cur.fetchone()[0] or 0)
+            sub = row[:4] + (new_val,) + row[5:]
+            replace = {
+                f"row-subcat-{subcat_id}": _menu_row("subcat_row", sub=sub, bot_id=bot_id, cat_id=cat_id, children_count=children)
+            }
+        return _reply(request, safe_return_to(return_to, f"/dashboard#cat-{cat_id}"), replace=replace)
 
     @app.post("/upload_menu_photo")
     async def upload_menu_photo(
@@ -1052,20 +1028,16 @@ def register_routes(app):
         row = cur.fetchone()
         if row:
             old_path = row[1]
-            photo_path = None
-            if photo and photo.filename:
-                photo_bytes = await photo.read()
-                os.makedirs("static/menu", exist_ok=True)
-                photo_path = f"static/menu/{bot_id}*{int(time.time())}.jpg"
-                with open(photo_path, "wb") as f:
-                    f.write(photo_bytes)
-    
+            try:
+                photo_path = await save_image(conn, photo)
+            except UploadRejected as e:
+                return RedirectResponse(set_qp("/dashboard", "err", str(e)), status_code=303)
+
             cur.execute("UPDATE bots SET menu_photo_path = ? WHERE bot_id = ?", (photo_path, bot_id))
             conn.commit()
-    
-            if old_path and os.path.exists(old_path):
-                try: os.remove(old_path)
-                except: pass
+            invalidate_bot_settings(bot_id)
+
+            await remove_images(conn, old_path)
         return RedirectResponse("/dashboard?msg=Фото меню загружено!", status_code=303)
     @app.post("/save_auto_cancel")
     async def save_auto_cancel(
@@ -1084,6 +1056,7 @@ def register_routes(app):
                     auto_cancel_enabled = ?
                     WHERE bot_id = ?""", (minutes, enabled, bot_id))
                 conn.commit()
+                invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Автоотмена сохранена!", status_code=303)
     @app.post("/save_work_time")
     async def save_work_time(
@@ -1104,19 +1077,40 @@ def register_routes(app):
                 WHERE bot_id = ?""",
                 (timezone, work_start or None, work_end or None, 1 if restrict_orders == "on" else 0, bot_id))
             conn.commit()
+            invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Время работы сохранено!", status_code=303)
     @app.post("/toggle_product")
     async def toggle_product(
+        request: Request,
         prod_id: int = Form(),
         enabled: str = Form("off"),
         return_to: str | None = Form(None),
         user: str = Depends(get_current_user)
     ):
-        cur.execute("SELECT 1 FROM products p JOIN bots b ON p.bot_id = b.bot_id WHERE p.id = ? AND b.owner = ?", (prod_id, user))
-        if cur.fetchone():
-            cur.execute("UPDATE products SET enabled = ? WHERE id = ?", (1 if enabled == "on" else 0, prod_id))
-            conn.commit()
-        return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Товар обновлён!"), status_code=303)
+        cur.execute(
+            """SELECT p.id, p.bot_id, p.cat_id, p.name, p.price, p.description,
+                      COALESCE(v.thumb_path, p.photo_path), p.enabled, p.subcat_id
+               FROM products p JOIN bots b ON p.bot_id = b.bot_id
+               LEFT JOIN image_variants v ON v.path = p.photo_path
+               WHERE p.id = ? AND b.owner = ?""",
+            (prod_id, user),
+        )
+        row = cur.fetchone()
+        if not row:
+            return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "err", "Товар не найден"), err="Товар не найден")
+
+        new_val = 1 if enabled == "on" else 0
+        cur.execute("UPDATE products SET enabled = ? WHERE id = ?", (new_val, prod_id))
+        conn.commit()
+
+        replace = None
+        if _wants_fragment(request):
+            prod = row[:7] + (new_val,)
+            subcat_id = row[8] if row[8] not in (None, 0) else None
+            replace = {
+                f"row-prod-{prod_id}": _menu_row("prod_row", prod=prod, bot_id=row[1], cat_id=row[2], subcat_id=subcat_id)
+            }
+        return _reply(request, set_qp(safe_return_to(return_to, "/dashboard"), "msg", "Товар обновлён!"), replace=replace, msg="Товар обновлён!")
     @app.post("/toggle_order_type")
     async def toggle_order_type(
         bot_id: int = Form(),
@@ -1138,6 +1132,7 @@ def register_routes(app):
             1 if delivery == "on" else 0,
             bot_id))
         conn.commit()
+        invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Настройки сохранены!", status_code=303)
     @app.post("/register")
     async def register_post(
@@ -1166,18 +1161,23 @@ def register_routes(app):
         if row and int(row[0] or 0) == 1:
             return RedirectResponse(f"/login?err={quote('Аккаунт с таким email уже существует. Войдите или восстановите пароль.')}", status_code=303)
 
+        try:
+            password_hash = await password_hasher.hash(password)
+        except PasswordPoolBusy:
+            return RedirectResponse(f"/register?err={quote(PASSWORD_BUSY_MSG)}", status_code=303)
+
         if row:
             # аккаунт есть, но не подтверждён — обновим пароль/токен и отправим письмо ещё раз
             cur.execute(
                 "UPDATE accounts SET password_hash=?, verify_token=?, verify_expires_at=? WHERE email=?",
-                (hash_password(password), verify_token, verify_expires, email_norm),
+                (password_hash, verify_token, verify_expires, email_norm),
             )
             conn.commit()
         else:
             cur.execute(
                 "INSERT INTO accounts (email, password_hash, is_verified, verify_token, verify_expires_at, created_at) "
                 "VALUES (?, ?, 0, ?, ?, ?)",
-                (email_norm, hash_password(password), verify_token, verify_expires, now_ts),
+                (email_norm, password_hash, verify_token, verify_expires, now_ts),
             )
             conn.commit()
 
@@ -1196,20 +1196,9 @@ def register_routes(app):
             f"<p style='color:#64748b'>Если кнопка не работает, откройте ссылку: <br><a href='{verify_url}'>{verify_url}</a></p>"
             "<p style='color:#64748b'>Ссылка действует 24 часа.</p>"
         )
-        try:
-            await send_email_async(email_norm, subj, text_body, html_body)
-        except Exception as e:
-            # если письмо не ушло — лучше не оставлять "висящий" аккаунт при первой регистрации
-            # (если аккаунт уже был — не удаляем)
-            cur.execute("SELECT is_verified FROM accounts WHERE email=?", (email_norm,))
-            r2 = cur.fetchone()
-            if r2 and int(r2[0] or 0) == 0 and not row:
-                cur.execute("DELETE FROM accounts WHERE email=? AND is_verified=0", (email_norm,))
-                conn.commit()
-            return RedirectResponse(
-                f"/register?err={quote('Не удалось отправить письмо. Проверь SMTP настройки (SMTP_USER/SMTP_PASSWORD).')}",
-                status_code=303,
-            )
+        # письмо отправит фоновый EmailSender (с повторами); повторная регистрация
+        # или /resend_verification поставят новое, если это не дойдёт
+        enqueue_email(conn, email_norm, subj, text_body, html_body)
 
         return RedirectResponse(f"/login?msg={quote('Мы отправили письмо с подтверждением. Проверьте почту!')}&email={quote(email_norm)}", status_code=303)
 
@@ -1235,23 +1224,38 @@ def register_routes(app):
             cur.execute("UPDATE accounts SET verify_token=?, verify_expires_at=? WHERE email=?", (verify_token, verify_expires, email_norm))
             conn.commit()
             verify_url = build_abs_url("/verify", token=verify_token)
-            try:
-                await send_email_async(
-                    email_norm,
-                    "Подтверждение почты — BonusDostavkaBot",
-                    "Подтвердите почту:\n" + verify_url,
-                )
-            except Exception:
-                pass
+            enqueue_email(conn, email_norm, "Подтверждение почты — BonusDostavkaBot", "Подтвердите почту:\n" + verify_url)
             return RedirectResponse(
                 f"/login?err={quote('Email не подтверждён. Мы отправили письмо ещё раз. Проверьте почту.')}&email={quote(email_norm)}",
                 status_code=303,
             )
 
-        if verify_password(password, stored_hash):
+        try:
+            ok = await password_hasher.verify(password, stored_hash)
+        except PasswordPoolBusy:
+            return RedirectResponse(f"/login?err={quote(PASSWORD_BUSY_MSG)}&email={quote(email_norm)}", status_code=303)
+
+        if ok:
+            if needs_rehash(stored_hash):
+                # хэш со старыми параметрами (или legacy sha256) — пересчитываем, пока пароль известен
+                try:
+                    cur.execute(
+                        "UPDATE accounts SET password_hash=? WHERE email=? AND password_hash=?",
+                        (await password_hasher.hash(password), email_norm, stored_hash),
+                    )
+                    conn.commit()
+                except Exception as e:
+                    print("Ошибка перехэширования пароля:", e)
             resp = RedirectResponse("/dashboard", status_code=303)
             secure_cookie = APP_BASE_URL.startswith("https://")
-            resp.set_cookie("user", email_norm, httponly=True, max_age=604800, samesite="lax", secure=secure_cookie)
+            resp.set_cookie(
+                SESSION_COOKIE,
+                sessions.create(email_norm),
+                httponly=True,
+                max_age=sessions.ttl,
+                samesite="lax",
+                secure=secure_cookie,
+            )
             return resp
 
         return RedirectResponse(f"/login?err={quote('Неверный email или пароль')}&email={quote(email_norm)}", status_code=303)
@@ -1301,14 +1305,7 @@ def register_routes(app):
         conn.commit()
 
         verify_url = build_abs_url("/verify", token=verify_token)
-        try:
-            await send_email_async(
-                email_norm,
-                "Подтверждение почты — BonusDostavkaBot",
-                "Подтвердите почту:\n" + verify_url,
-            )
-        except Exception:
-            return RedirectResponse(f"/login?err={quote('Не удалось отправить письмо. Проверь SMTP настройки.')}&email={quote(email_norm)}", status_code=303)
+        enqueue_email(conn, email_norm, "Подтверждение почты — BonusDostavkaBot", "Подтвердите почту:\n" + verify_url)
 
         return RedirectResponse(f"/login?msg={quote('Письмо с подтверждением отправлено ещё раз.')}&email={quote(email_norm)}", status_code=303)
 
@@ -1354,10 +1351,7 @@ def register_routes(app):
             "<p style='color:#64748b'>Ссылка действует 1 час.</p>"
         )
 
-        try:
-            await send_email_async(email_norm, subj, text_body, html_body)
-        except Exception:
-            pass
+        enqueue_email(conn, email_norm, subj, text_body, html_body)
 
         return ok_redirect
 
@@ -1385,11 +1379,18 @@ def register_routes(app):
         if expires_at is not None and int(expires_at) < now_ts:
             return RedirectResponse(f"/login?err={quote('Ссылка восстановления истекла. Запросите новую.')}&email={quote(email)}", status_code=303)
 
+        try:
+            password_hash = await password_hasher.hash(password)
+        except PasswordPoolBusy:
+            return RedirectResponse(f"/reset?token={quote(token)}&err={quote(PASSWORD_BUSY_MSG)}", status_code=303)
+
         cur.execute(
             "UPDATE accounts SET password_hash=?, reset_token=NULL, reset_expires_at=NULL WHERE email=?",
-            (hash_password(password), email),
+            (password_hash, email),
         )
         conn.commit()
+        # старые сессии (в том числе чужие, если пароль утёк) больше не действуют
+        sessions.revoke_all(email)
 
         return RedirectResponse(f"/login?msg={quote('Пароль обновлён. Теперь можно войти.')}&email={quote(email)}", status_code=303)
     # Добавить категорию
@@ -1411,17 +1412,10 @@ def register_routes(app):
             return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", "Введите название"), status_code=303)
 
         # фото (опционально)
-        photo_path = None
-        if photo and getattr(photo, "filename", None):
-            photo_bytes = await photo.read()
-            if photo_bytes:
-                ext = os.path.splitext(photo.filename)[1].lower()
-                if ext not in (".jpg", ".jpeg", ".png", ".webp", ".gif"):
-                    ext = ".jpg"
-                os.makedirs("static/categories", exist_ok=True)
-                photo_path = f"static/categories/cat_{bot_id}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
-                with open(photo_path, "wb") as f:
-                    f.write(photo_bytes)
+        try:
+            photo_path = await save_image(conn, photo)
+        except UploadRejected as e:
+            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", str(e)), status_code=303)
 
         cur.execute("SELECT COALESCE(MAX(sort_order), 0) FROM categories WHERE bot_id=?", (bot_id,))
         next_sort = int(cur.fetchone()[0] or 0) + 1
@@ -1463,7 +1457,8 @@ def register_routes(app):
             conn.commit()
 
             await bot.session.close()
-            await launch_bot(me.id, token, me.username)
+            # при BOT_SHARDING бота запустит воркер, который захватит его лок
+            await claim_bot(me.id, token, me.username)
             return RedirectResponse("/dashboard", status_code=303)
 
         except Exception as e:
@@ -1563,21 +1558,10 @@ def register_routes(app):
                 )
 
 
-        photo_path = None
-        if photo and photo.filename:
-            photo_bytes = await photo.read()
-            os.makedirs("static/products", exist_ok=True)
-
-            safe_name = safe_filename(photo.filename, default="product.jpg")
-            _, ext = os.path.splitext(safe_name)
-            ext = (ext or ".jpg").lower()
-            if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-                ext = ".jpg"
-
-            photo_path = f"static/products/{bot_id}_{cat_id}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
-
-            with open(photo_path, "wb") as f:
-                f.write(photo_bytes)
+        try:
+            photo_path = await save_image(conn, photo)
+        except UploadRejected as e:
+            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", str(e)), status_code=303)
 
         # sort_order: добавляем товар в конец списка внутри группы (категория + подкатегория/без неё)
         if subcat_int is None:
@@ -1618,13 +1602,9 @@ def register_routes(app):
         row = cur.fetchone()
         if row:
             photo_path, bot_id_from_db = row
-            if photo_path:
-                try:
-                    os.remove(photo_path)
-                except:
-                    pass
             cur.execute("DELETE FROM products WHERE id = ?", (prod_id,))
             conn.commit()
+            await remove_images(conn, photo_path)
         return RedirectResponse(safe_return_to(return_to, "/dashboard"), status_code=303)
 
     @app.post("/toggle_bonuses")
@@ -1638,6 +1618,7 @@ def register_routes(app):
             enabled = 1 if bonuses_enabled == "on" else 0
             cur.execute("UPDATE bots SET bonuses_enabled = ? WHERE bot_id = ?", (enabled, bot_id))
             conn.commit()
+            invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard?msg=Бонусная система обновлена!", status_code=303)
     @app.post("/upload_menu_photos")
     async def upload_menu_photos(
@@ -1646,18 +1627,26 @@ def register_routes(app):
         user: str = Depends(get_current_user)
     ):
         cur.execute("SELECT 1 FROM bots WHERE bot_id=? AND owner=?", (bot_id, user))
-        if cur.fetchone() and photos:
-            os.makedirs("static/menu", exist_ok=True)
-            for photo in photos:
-                if photo.filename:
-                    photo_bytes = await photo.read()
-                    # Добавляем уникальное имя, чтобы не перезаписывать
-                    safe_name = safe_filename(photo.filename, default="menu.jpg")
-                    photo_path = f"static/menu/{bot_id}_{int(time.time())}_{uuid.uuid4().hex}_{safe_name}"
-                    with open(photo_path, "wb") as f:
-                        f.write(photo_bytes)
-                    cur.execute("INSERT INTO menu_photos (bot_id, photo_path) VALUES (?, ?)", (bot_id, photo_path))
-            conn.commit()
+        if not (cur.fetchone() and photos):
+            return RedirectResponse("/dashboard?msg=Фото меню загружены!", status_code=303)
+
+        # файлы обрабатываются параллельно; одинаковые фото хранятся один раз
+        results = await save_images(conn, photos)
+        saved = [r for r in results if isinstance(r, str)]
+        errors = [r for r in results if isinstance(r, Exception)]
+        for photo_path in saved:
+            cur.execute("INSERT INTO menu_photos (bot_id, photo_path) VALUES (?, ?)", (bot_id, photo_path))
+        conn.commit()
+
+        if errors:
+            for e in errors:
+                if not isinstance(e, UploadRejected):
+                    print("Ошибка сохранения фото меню:", e)
+            reason = str(errors[0]) if isinstance(errors[0], UploadRejected) else "ошибка записи"
+            return RedirectResponse(
+                set_qp("/dashboard", "err", f"Загружено: {len(saved)}, не загружено: {len(errors)} ({reason})"),
+                status_code=303,
+            )
         return RedirectResponse("/dashboard?msg=Фото меню загружены!", status_code=303)
     @app.post("/delete_menu_photo")
     async def delete_menu_photo(
@@ -1668,16 +1657,15 @@ def register_routes(app):
         cur.execute("SELECT photo_path FROM menu_photos WHERE id=? AND bot_id IN (SELECT bot_id FROM bots WHERE owner=?)", (photo_id, user))
         row = cur.fetchone()
         if row:
-            if os.path.exists(row[0]):
-                try: os.remove(row[0])
-                except: pass
             cur.execute("DELETE FROM menu_photos WHERE id=?", (photo_id,))
             conn.commit()
+            await remove_images(conn, row[0])
         return RedirectResponse("/dashboard", status_code=303)
     @app.post("/update_about")
     async def update_about(bot_id: int = Form(), about: str = Form(), user: str = Depends(get_current_user)):
         cur.execute("UPDATE bots SET about=? WHERE bot_id=? AND owner=?", (about, bot_id, user))
         conn.commit()
+        invalidate_bot_settings(bot_id)
         return RedirectResponse("/dashboard", status_code=303)
     from aiogram.types import InputFile
     from io import BytesIO
@@ -1695,15 +1683,16 @@ def register_routes(app):
         if not row:
             return HTMLResponse("Доступ запрещён", status_code=403)
         token, username = row
-        # Запускаем бот если нужно
-        if bot_id not in active_bots:
-            await launch_bot(bot_id, token, username)
-            await asyncio.sleep(2)
-        bot = active_bots[bot_id]["bot"]
+        # Для отправки polling не нужен: если бот опрашивается другим воркером (или не запущен),
+        # шлём через временный экземпляр, не запуская второй getUpdates
+        own_session = bot_id not in active_bots
+        bot = Bot(token=token) if own_session else active_bots[bot_id]["bot"]
         # Клиенты
         cur.execute("SELECT user_id FROM clients WHERE bot_id = ?", (bot_id,))
         user_ids = [r[0] for r in cur.fetchall()]
         if not user_ids:
+            if own_session:
+                await bot.session.close()
             return RedirectResponse(f"/dashboard?msg=Нет клиентов для рассылки&bot={bot_id}", status_code=303)
         sent = 0
         photo_file = None
@@ -1726,6 +1715,8 @@ def register_routes(app):
                 await asyncio.sleep(0.04)
             except Exception as e:
                 pass # пропускаем заблокировавших бота
+        if own_session:
+            await bot.session.close()
         result = f"Рассылка завершена! Отправлено: {sent} из {len(user_ids)}"
         if photo_file:
             result += " (с фото)"
@@ -1748,16 +1739,6 @@ def register_routes(app):
             return RedirectResponse(f"/dashboard?err={quote('Бот не найден')}", status_code=303)
         username = row[0]
 
-        def _safe_unlink(p: str | None):
-            """Удаляем только файлы из static/, чтобы случайно не снести что-то лишнее."""
-            if not p:
-                return
-            try:
-                if isinstance(p, str) and p.startswith("static/") and os.path.exists(p):
-                    os.remove(p)
-            except Exception:
-                pass
-
         try:
             # Собираем пути файлов, чтобы после удаления почистить диск
             cur.execute("SELECT photo_path FROM categories WHERE bot_id=?", (bot_id,))
@@ -1766,6 +1747,11 @@ def register_routes(app):
             prod_photos = [r[0] for r in cur.fetchall() if r and r[0]]
             cur.execute("SELECT photo_path FROM menu_photos WHERE bot_id=?", (bot_id,))
             menu_photos = [r[0] for r in cur.fetchall() if r and r[0]]
+            cur.execute(
+                "SELECT photo_path FROM subcategories WHERE bot_id=? UNION ALL SELECT menu_photo_path FROM bots WHERE bot_id=?",
+                (bot_id, bot_id),
+            )
+            other_photos = [r[0] for r in cur.fetchall() if r and r[0]]
 
             # ВАЖНО: порядок удаления из-за FOREIGN KEY
             cur.execute(
@@ -1783,17 +1769,12 @@ def register_routes(app):
             cur.execute("DELETE FROM bots WHERE bot_id=? AND owner=?", (bot_id, user))
             conn.commit()
 
-            # Останавливаем бота в памяти
-            if bot_id in active_bots:
-                try:
-                    await active_bots[bot_id]["bot"].session.close()
-                except Exception:
-                    pass
-                del active_bots[bot_id]
+            # Останавливаем бота: отменяем polling и фоновые задачи, закрываем сессию;
+            # его состояния пользователей уже удалены каскадом — не записываем их обратно
+            await stop_bot(bot_id, deleted=True)
 
-            # Чистим файлы с диска
-            for p in (cat_photos + prod_photos + menu_photos):
-                _safe_unlink(p)
+            # Снимаем ссылки на фото: файлы, которыми больше никто не пользуется, удаляются с диска
+            await remove_images(conn, *cat_photos, *prod_photos, *menu_photos, *other_photos)
 
         except sqlite3.IntegrityError as e:
             try:
@@ -1865,7 +1846,7 @@ def register_routes(app):
         if not row or row[4] != user:
             return RedirectResponse("/dashboard", status_code=303)
 
-        old_photo_path, bot_id, cat_id = row[0], int(row[1]), int(row[2])
+        old_photo_path, bot_id = row[0], int(row[1])
 
         clean_name = (name or "").strip()
         if not clean_name:
@@ -1873,32 +1854,13 @@ def register_routes(app):
 
         # фото
         photo_path = old_photo_path
-        if photo and getattr(photo, "filename", None) and photo.filename:
-            photo_bytes = await photo.read()
-            if photo_bytes:
-                os.makedirs("static/products", exist_ok=True)
-
-                safe_name = safe_filename(photo.filename, default="product.jpg")
-                _, ext = os.path.splitext(safe_name)
-                ext = (ext or ".jpg").lower()
-                if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-                    ext = ".jpg"
-
-                photo_path = f"static/products/{bot_id}_{cat_id}_{int(time.time())}_{uuid.uuid4().hex}{ext}"
-                with open(photo_path, "wb") as f:
-                    f.write(photo_bytes)
-
-                if old_photo_path and os.path.exists(old_photo_path):
-                    try:
-                        os.remove(old_photo_path)
-                    except Exception:
-                        pass
-        elif delete_photo == "on" and old_photo_path:
-            try:
-                if os.path.exists(old_photo_path):
-                    os.remove(old_photo_path)
-            except Exception:
-                pass
+        try:
+            new_photo = await save_image(conn, photo)
+        except UploadRejected as e:
+            return RedirectResponse(set_qp(safe_return_to(return_to, "/dashboard"), "err", str(e)), status_code=303)
+        if new_photo:
+            photo_path = new_photo
+        elif delete_photo == "on":
             photo_path = None
 
         cur.execute(
@@ -1906,15 +1868,36 @@ def register_routes(app):
             (clean_name, int(price), (description or "").strip(), photo_path, prod_id, bot_id),
         )
         conn.commit()
+        if new_photo or delete_photo == "on":
+            await remove_images(conn, old_photo_path)
         target = safe_return_to(return_to, "/dashboard")
         target = set_qp(target, "msg", "Товар успешно обновлён!")
         return RedirectResponse(target, status_code=303)
 
 
+    @app.get("/bot_status")
+    async def bot_status_view(user: str = Depends(get_current_user)):
+        """Состояние polling ботов владельца (running / backoff / disabled)."""
+        cur.execute("SELECT bot_id, username FROM bots WHERE owner=?", (user,))
+        items = []
+        for bot_id, username in cur.fetchall():
+            st = bot_status(bot_id) or {"bot_id": bot_id, "username": username, "state": "not_running"}
+            items.append(st)
+        return JSONResponse({
+            "bots": items,
+            "worker": shard_status(),
+            "caches": {**cache_status(), "sessions": sessions.stats()},
+            "passwords": password_hasher.stats(),
+            "email": await email_sender.stats(),
+            "images": image_pipeline.stats(),
+        })
+
     @app.get("/logout")
-    async def logout():
+    async def logout(request: Request):
+        sessions.revoke(request.cookies.get(SESSION_COOKIE))
         resp = RedirectResponse("/")
-        resp.delete_cookie("user")
+        resp.delete_cookie(SESSION_COOKIE)
+        resp.delete_cookie("user")  # cookie прошлой версии (голый email)
         return resp
     @app.post("/save_notify_chat")
     async def save_notify_chat(
@@ -1928,5 +1911,6 @@ def register_routes(app):
             normalized = normalize_notify_chat_id(notify_chat_id)
             cur.execute("UPDATE bots SET notify_chat_id=? WHERE bot_id=?", (normalized, bot_id))
             conn.commit()
+            invalidate_bot_settings(bot_id)
 
         return RedirectResponse("/dashboard?msg=Чат для заказов сохранён!", status_code=303)
\ No newline at end of file
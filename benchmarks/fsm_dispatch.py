@@ -0,0 +1,186 @@
+"""Microbenchmark: per-message dispatch cost, linear lambda filters vs StateRouter.
+
+Rebuilds the handler table of app_bot/manager.py (same order, same conditions) twice:
+as a list of `lambda m: user_state.get(...)...` filters scanned in order (how aiogram
+resolved them before) and as a StateRouter. Checks that both pick the same handler for
+every sample message, then times resolution only (no aiogram, no I/O).
+
+    python benchmarks/fsm_dispatch.py [iterations]
+"""
+
+import os
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app_bot.fsm_router import StateRouter, parse_command  # noqa: E402
+
+MENU_NAV_PREV = "◀️"
+MENU_NAV_NEXT = "▶️"
+SYSTEM_BTNS = {"Назад", "Заказать", "⬅️", "➡️", "Назад в корзину", "Предыдущий", "Следующий", "+1", "-1", "Удалить", "На главную"}
+ORDERS_BTNS = ["⬅️", "➡️", "Предыдущий", "Следующий", "На главную", "Отменить заказ", "Оплатить"]
+
+user_state: dict = {}
+
+
+def _st(m):
+    return user_state.get(m.from_user.id, {})
+
+
+def _cmd(name):
+    return lambda m: parse_command(m) == name
+
+
+def _orders_where(m):
+    t = (m.text or "").strip()
+    return t in ORDERS_BTNS or re.fullmatch(r"\d+/\d+", t)
+
+
+# (name, linear filter, router kwargs) in manager.py registration order
+TABLE = [
+    ("successful_payment", lambda m: getattr(m, "successful_payment", None) is not None,
+     dict(where=lambda m: getattr(m, "successful_payment", None) is not None)),
+    ("cmd_menu", _cmd("menu"), dict(command="menu")),
+    ("cmd_cart", _cmd("cart"), dict(command="cart")),
+    ("cmd_status", _cmd("status"), dict(command="status")),
+    ("address_confirm", lambda m: _st(m).get("awaiting_address_confirm"), dict(flag="awaiting_address_confirm")),
+    ("address_input", lambda m: _st(m).get("awaiting_address_input"), dict(flag="awaiting_address_input")),
+    ("cat_products_cart", lambda m: _st(m).get("type") == "category_products" and m.text == "Корзина",
+     dict(state="category_products", text="Корзина")),
+    ("cat_products_page", lambda m: _st(m).get("type") == "category_products" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT],
+     dict(state="category_products", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)),
+    ("cat_products_back", lambda m: _st(m).get("type") == "category_products" and m.text == "Назад",
+     dict(state="category_products", text="Назад")),
+    ("main_menu", lambda m: m.text == "На главную", dict(text="На главную")),
+    ("product_pick", lambda m: _st(m).get("type") == "product_pick", dict(state="product_pick")),
+    ("cat_products_add", lambda m: _st(m).get("type") == "category_products", dict(state="category_products")),
+    ("cmd_start", _cmd("start"), dict(command="start")),
+    ("cmd_menu_dup", _cmd("menu"), dict(command="menu")),
+    ("cmd_cart_dup", _cmd("cart"), dict(command="cart")),
+    ("cmd_status_dup", _cmd("status"), dict(command="status")),
+    ("cashier", lambda m: m.text == "Кассир", dict(text="Кассир")),
+    ("cashier_accrual", lambda m: _st(m).get("type") == "cashier_accrual", dict(state="cashier_accrual")),
+    ("cashier_op_select", lambda m: _st(m).get("type") == "cashier_op_select", dict(state="cashier_op_select")),
+    ("cashier_wo_purchase", lambda m: _st(m).get("type") == "cashier_writeoff_purchase", dict(state="cashier_writeoff_purchase")),
+    ("cashier_wo_amount", lambda m: _st(m).get("type") == "cashier_writeoff_amount", dict(state="cashier_writeoff_amount")),
+    ("orders_list", lambda m: m.text == "Статус заказа", dict(text="Статус заказа")),
+    ("orders_nav", lambda m: _st(m).get("type") == "orders" and _orders_where(m), dict(state="orders", where=_orders_where)),
+    ("cancel_reason", lambda m: _st(m).get("awaiting_cancel_reason") is not None, dict(flag="awaiting_cancel_reason", flag_not_none=True)),
+    ("cancel_confirm", lambda m: _st(m).get("awaiting_cancel_confirm") is not None, dict(flag="awaiting_cancel_confirm", flag_not_none=True)),
+    ("cart", lambda m: m.text == "Корзина", dict(text="Корзина")),
+    ("cart_open_item", lambda m: _st(m).get("type") == "cart_view" and _st(m).get("cart_item_index") is None and (m.text or "").strip() not in SYSTEM_BTNS,
+     dict(state="cart_view", where=lambda m: user_state[m.from_user.id].get("cart_item_index") is None and (m.text or "").strip() not in SYSTEM_BTNS)),
+    ("cart_item_nav", lambda m: _st(m).get("type") == "cart_view" and _st(m).get("cart_item_index") is not None,
+     dict(state="cart_view", where=lambda m: user_state[m.from_user.id].get("cart_item_index") is not None)),
+    ("cart_page", lambda m: _st(m).get("type") == "cart_view" and m.text in ["⬅️", "➡️"], dict(state="cart_view", text=("⬅️", "➡️"))),
+    ("cart_back", lambda m: _st(m).get("type") == "cart_view" and m.text == "Назад", dict(state="cart_view", text="Назад")),
+    ("cart_empty_back", lambda m: _st(m).get("type") == "cart_empty" and (m.text or "").strip() == "Назад",
+     dict(state="cart_empty", text="Назад", strip=True)),
+    ("cart_order", lambda m: _st(m).get("type") == "cart_view" and m.text == "Заказать", dict(state="cart_view", text="Заказать")),
+    ("delivery_type", lambda m: _st(m).get("type") == "delivery_type", dict(state="delivery_type")),
+    ("phone_confirm", lambda m: _st(m).get("type") == "phone_confirm", dict(state="phone_confirm")),
+    ("phone_request", lambda m: _st(m).get("type") == "phone_request", dict(state="phone_request")),
+    ("phone_manual", lambda m: _st(m).get("type") == "phone_manual", dict(state="phone_manual")),
+    ("comment", lambda m: _st(m).get("awaiting_comment"), dict(flag="awaiting_comment")),
+    ("bonus_choice", lambda m: _st(m).get("awaiting_bonus_choice"), dict(flag="awaiting_bonus_choice")),
+    ("bonus_amount", lambda m: _st(m).get("awaiting_bonus_amount"), dict(flag="awaiting_bonus_amount")),
+    ("virtual_card", lambda m: m.text == "Виртуальная карта", dict(text="Виртуальная карта")),
+    ("balance", lambda m: m.text == "Мой баланс", dict(text="Мой баланс")),
+    ("about", lambda m: m.text == "О нас", dict(text="О нас")),
+    ("categories_page", lambda m: _st(m).get("type") == "categories" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT],
+     dict(state="categories", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)),
+    ("subcategories_page", lambda m: _st(m).get("type") == "subcategories" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT],
+     dict(state="subcategories", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)),
+    ("subsub_page", lambda m: _st(m).get("type") == "subsubcategories" and (m.text or "").strip() in [MENU_NAV_PREV, MENU_NAV_NEXT],
+     dict(state="subsubcategories", text=(MENU_NAV_PREV, MENU_NAV_NEXT), strip=True)),
+    ("subsub_back", lambda m: _st(m).get("type") == "subsubcategories" and (m.text or "").strip() == "Назад",
+     dict(state="subsubcategories", text="Назад", strip=True)),
+    ("categories_back", lambda m: _st(m).get("type") == "categories" and (m.text or "").strip() == "Назад",
+     dict(state="categories", text="Назад", strip=True)),
+    ("subcategories_back", lambda m: _st(m).get("type") == "subcategories" and (m.text or "").strip() == "Назад",
+     dict(state="subcategories", text="Назад", strip=True)),
+    ("full_menu", lambda m: m.text == "Меню", dict(text="Меню")),
+    ("category_choice", lambda m: _st(m).get("type") == "categories" and (m.text or "") in _st(m).get("cats", {}),
+     dict(state="categories", where=lambda m: (m.text or "") in user_state[m.from_user.id].get("cats", {}))),
+    ("subcategory_choice", lambda m: _st(m).get("type") == "subcategories" and (m.text or "") in _st(m).get("subs", {}),
+     dict(state="subcategories", where=lambda m: (m.text or "") in user_state[m.from_user.id].get("subs", {}))),
+    ("subsub_choice", lambda m: _st(m).get("type") == "subsubcategories" and (m.text or "") in _st(m).get("subs", {}),
+     dict(state="subsubcategories", where=lambda m: (m.text or "") in user_state[m.from_user.id].get("subs", {}))),
+    ("buy_product", lambda m: m.text == "Купить" and _st(m).get("type") == "product", dict(state="product", text="Купить")),
+    ("product_nav", lambda m: m.text in ["Предыдущий", "Следующий", "Назад", "На главную"] and _st(m).get("type") == "product",
+     dict(state="product", text=("Предыдущий", "Следующий", "Назад", "На главную"))),
+    ("back_no_state", lambda m: m.text == "Назад" and user_state.get(m.from_user.id) is None, dict(text="Назад", no_state=True)),
+]
+
+# (state or None, text) — типичный поток клиента, часть сообщений — поздние в таблице
+SAMPLES = [
+    (None, "/start"), (None, "Меню"), (None, "О нас"), (None, "Назад"), (None, "Мой баланс"),
+    ({"type": "categories", "cats": {"Пицца": 1, "Напитки": 2}}, "Пицца"),
+    ({"type": "categories", "cats": {"Пицца": 1}}, MENU_NAV_NEXT),
+    ({"type": "subcategories", "subs": {"Острые": 1}}, "Острые"),
+    ({"type": "subsubcategories", "subs": {"Большие": 1}}, "Назад"),
+    ({"type": "category_products", "prods": []}, "Маргарита"),
+    ({"type": "product_pick"}, "+1"),
+    ({"type": "cart_view", "cart_items": [], "cart_item_index": None}, "Заказать"),
+    ({"type": "cart_view", "cart_items": [], "cart_item_index": 0}, "+1"),
+    ({"type": "delivery_type"}, "Доставка"),
+    ({"type": "phone_confirm"}, "Да"),
+    ({"awaiting_comment": True}, "Без лука"),
+    ({"awaiting_bonus_amount": True}, "100"),
+    ({"type": "orders", "orders_list": [], "index": 0}, "2/5"),
+    ({"type": "product", "cat_id": 1, "index": 0}, "Купить"),
+    ({"type": "cashier_writeoff_amount"}, "250"),
+]
+
+
+def _message(uid, text):
+    return SimpleNamespace(text=text, caption=None, from_user=SimpleNamespace(id=uid), successful_payment=None)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    linear = [(name, flt) for name, flt, _ in TABLE]
+    router = StateRouter(user_state)
+    for name, _, kwargs in TABLE:
+        router.add(name, **kwargs)
+
+    def resolve_linear(m):
+        for name, flt in linear:
+            if flt(m):
+                return name
+        return None
+
+    def resolve_router(m):
+        entry = router.resolve(m)
+        return entry.handler if entry else None
+
+    messages = []
+    for uid, (st, text) in enumerate(SAMPLES, start=1):
+        if st is not None:
+            user_state[uid] = st
+        messages.append(_message(uid, text))
+
+    for m in messages:
+        a, b = resolve_linear(m), resolve_router(m)
+        assert a == b, f"mismatch for {m.text!r}: linear={a} router={b}"
+
+    print(f"handlers: {len(TABLE)}, sample messages: {len(messages)}, iterations: {iterations}")
+    results = {}
+    for label, fn in (("linear filters", resolve_linear), ("StateRouter", resolve_router)):
+        t0 = time.perf_counter()
+        for _ in range(iterations):
+            for m in messages:
+                fn(m)
+        elapsed = time.perf_counter() - t0
+        per_msg = elapsed / (iterations * len(messages)) * 1e6
+        results[label] = per_msg
+        print(f"{label:>15}: {per_msg:.2f} µs/message")
+    print(f"speedup: x{results['linear filters'] / results['StateRouter']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
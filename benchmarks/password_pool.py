@@ -0,0 +1,82 @@
+"""Benchmark: event-loop latency during a login storm, inline PBKDF2 vs PasswordHasher.
+
+A "bot" task stands in for polling: it wakes every TICK ms and records how late it woke
+up. Meanwhile LOGINS concurrent logins verify a password (PBKDF2_ITERATIONS as configured):
+
+- inline:  verify_password() called straight from the coroutine (how routes did it);
+- threads: PasswordHasher(workers=0), the default thread pool;
+- pool:    PasswordHasher(workers=N), a process pool of N workers.
+
+Prints the bot's p50 / p99 / max lag and the login wall time for each mode.
+
+    python benchmarks/password_pool.py [logins] [workers]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from core.security import PasswordHasher, hash_password, verify_password  # noqa: E402
+
+TICK = 0.005
+
+
+async def bot_ticker(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - t0 - TICK)
+
+
+async def run(mode: str, logins: int, workers: int, stored: str):
+    hasher = None
+    if mode == "threads":
+        hasher = PasswordHasher(workers=0, max_pending=logins)
+    elif mode == "pool":
+        hasher = PasswordHasher(workers=workers, max_pending=logins)
+        await hasher.verify("warmup", stored)  # поднимаем процессы до замера
+
+    async def login():
+        if hasher is None:
+            assert verify_password("secret-password", stored)
+            await asyncio.sleep(0)
+        else:
+            assert await hasher.verify("secret-password", stored)
+
+    lags: list = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(bot_ticker(lags, stop))
+    await asyncio.sleep(TICK * 4)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    wall = time.perf_counter() - t0
+
+    stop.set()
+    await ticker
+    if hasher is not None:
+        hasher.shutdown()
+
+    lags_ms = sorted(lag * 1000 for lag in lags)
+    p99 = lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))]
+    print(
+        f"{mode:>8}: bot lag p50 {statistics.median(lags_ms):7.2f} ms, p99 {p99:7.2f} ms, "
+        f"max {lags_ms[-1]:7.2f} ms | {logins} logins in {wall:.2f} s"
+    )
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else min(2, os.cpu_count() or 1)
+    stored = hash_password("secret-password")
+    print(f"logins: {logins}, pool workers: {workers}, cpus: {os.cpu_count()}")
+    for mode in ("inline", "threads", "pool"):
+        asyncio.run(run(mode, logins, workers, stored))
+
+
+if __name__ == "__main__":
+    main()
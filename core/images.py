@@ -0,0 +1,302 @@
+"""Photo processing and storage: every uploaded image becomes two optimized variants.
+
+core/uploads.save_image() streams the upload to a temp file (outside static/) and hands it to
+`image_pipeline`, which renders in a process pool (Pillow decoding and resampling is CPU
+work that would otherwise stall the event loop and bot polling):
+
+- safe decode: only JPEG / PNG / WebP / GIF are opened, images above IMAGE_MAX_PIXELS are
+  refused before decoding (decompression bombs), truncated or corrupt files fail cleanly;
+  JPEGs are decoded with draft() straight at the reduced size;
+- EXIF orientation is applied and then all metadata (EXIF with GPS, comments) is dropped,
+  since the variants are served publicly from static/; transparency is flattened on white;
+- "<base>.jpg" (or .webp with IMAGE_TG_FORMAT=webp): longest side IMAGE_TG_SIDE, the photo
+  the bot sends and the edit pages show; its path is what photo_path columns store;
+- "<base>_thumb.webp": longest side IMAGE_THUMB_SIDE, what the dashboard lists show
+  (repo queries swap photo_path for it via the image_variants table).
+
+The original is not kept. Paths, dimensions and sizes go to image_variants.
+
+Storage is content-addressed: <base> is media_base(sha256 of the uploaded bytes), i.e.
+MEDIA_DIR/ab/cd/<sha256>, two levels of 256 shards, so no directory grows without bound.
+The same image uploaded again is found by its path and costs neither processing nor disk.
+image_variants.refcount counts the rows (products, categories, subcategories, menu_photos,
+bots.menu_photo_path) pointing at a photo: save_image() takes a reference, and every
+replace / delete releases one (core/uploads.remove_images); files are unlinked only when
+the count drops to zero.
+
+Like password_hasher, at most IMAGE_WORKERS jobs run at a time and past IMAGE_MAX_PENDING
+waiting jobs new ones fail fast (ImagePipelineBusy); stats() is in GET /bot_status.
+
+Photos uploaded before the content-addressed store are moved into it (converted,
+deduplicated, old files removed) and all refcounts recomputed with:
+
+    python -m core.images backfill [--dry-run]
+"""
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", "32"))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(40_000_000)))
+IMAGE_TG_SIDE = int(os.getenv("IMAGE_TG_SIDE", "1280"))
+IMAGE_TG_FORMAT = os.getenv("IMAGE_TG_FORMAT", "jpeg").lower()
+IMAGE_TG_QUALITY = int(os.getenv("IMAGE_TG_QUALITY", "85"))
+IMAGE_THUMB_SIDE = int(os.getenv("IMAGE_THUMB_SIDE", "320"))
+IMAGE_THUMB_QUALITY = int(os.getenv("IMAGE_THUMB_QUALITY", "80"))
+MEDIA_DIR = os.getenv("MEDIA_DIR", "static/media").rstrip("/")
+
+_FORMATS = ["JPEG", "PNG", "WEBP", "GIF"]
+
+
+class BadImage(ValueError):
+    """The file is not an image we accept; str(e) is a message for the user."""
+
+
+class ImagePipelineBusy(Exception):
+    """Too many image jobs are already waiting."""
+
+
+def thumb_path_for(path: str) -> str:
+    return f"{os.path.splitext(path)[0]}_thumb.webp"
+
+
+def media_base(sha256: str) -> str:
+    """MEDIA_DIR/ab/cd/<sha256> — the variants' path without extension."""
+    return f"{MEDIA_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def media_path(sha256: str) -> str:
+    """Path of the Telegram variant of the image with this content hash."""
+    return media_base(sha256) + (".jpg" if IMAGE_TG_FORMAT == "jpeg" else ".webp")
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _save_atomic(im, path: str, fmt: str, **params) -> int:
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        im.save(tmp_path, fmt, **params)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return os.path.getsize(path)
+
+
+def _encode(im, path: str, fmt: str, quality: int) -> int:
+    if fmt == "jpeg":
+        return _save_atomic(im, path, "JPEG", quality=quality, optimize=True, progressive=True)
+    return _save_atomic(im, path, "WEBP", quality=quality, method=4)
+
+
+def render_variants(src: str, base: str, tg_side: int = IMAGE_TG_SIDE, thumb_side: int = IMAGE_THUMB_SIDE) -> dict:
+    """Decode `src` and write the Telegram and thumbnail variants next to `base`.
+
+    Runs in a pool worker; raises BadImage for anything that is not a sane image.
+    """
+    import warnings
+
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            with Image.open(src, formats=_FORMATS) as im:
+                if im.width * im.height > IMAGE_MAX_PIXELS:
+                    raise BadImage("Слишком большое разрешение изображения")
+                im.draft("RGB", (tg_side, tg_side))  # JPEG: декодируем сразу в уменьшенном виде
+                im.seek(0)  # GIF / анимированный WebP — первый кадр
+                im.load()
+                im = ImageOps.exif_transpose(im)
+                if im.mode in ("RGBA", "LA", "P"):
+                    im = im.convert("RGBA")
+                    flat = Image.new("RGB", im.size, (255, 255, 255))
+                    flat.paste(im, mask=im.getchannel("A"))
+                    im = flat
+                elif im.mode != "RGB":
+                    im = im.convert("RGB")
+    except BadImage:
+        raise
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise BadImage("Слишком большое разрешение изображения")
+    except Exception:
+        raise BadImage("Не удалось прочитать изображение")
+
+    im.thumbnail((tg_side, tg_side), Image.LANCZOS)
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    path = base + (".jpg" if IMAGE_TG_FORMAT == "jpeg" else ".webp")
+    size = _encode(im, path, IMAGE_TG_FORMAT, IMAGE_TG_QUALITY)
+
+    thumb = im.copy()
+    thumb.thumbnail((thumb_side, thumb_side), Image.LANCZOS)
+    thumb_path = thumb_path_for(path)
+    thumb_size = _encode(thumb, thumb_path, "webp", IMAGE_THUMB_QUALITY)
+
+    return {
+        "path": path,
+        "width": im.width,
+        "height": im.height,
+        "bytes": size,
+        "thumb_path": thumb_path,
+        "thumb_width": thumb.width,
+        "thumb_height": thumb.height,
+        "thumb_bytes": thumb_size,
+        "source_bytes": os.path.getsize(src),
+    }
+
+
+class ImagePipeline:
+    def __init__(self, workers: int = IMAGE_WORKERS, max_pending: int = IMAGE_MAX_PENDING):
+        self.workers = max(0, workers)
+        self.max_pending = max_pending
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self.waiting = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.bad = 0
+        self.run_total = 0.0
+        self.run_max = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _pool(self):
+        if self.workers == 0:
+            return None  # пул потоков по умолчанию
+        if self._executor is None:
+            # spawn: дочерним процессам не нужны открытые соединения и потоки родителя
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def process(self, src: str, base: str) -> dict:
+        """Render the variants of `src` as <base>.jpg / <base>_thumb.webp -> variant record."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(1, self.workers))
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            raise ImagePipelineBusy()
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            started = time.perf_counter()
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self._pool(), render_variants, src, base)
+            except BadImage:
+                self.bad += 1
+                raise
+            except BrokenProcessPool:
+                # рабочий процесс упал (например, OOM) — следующий запрос поднимет пул заново
+                self.shutdown()
+                raise
+            took = time.perf_counter() - started
+            self.jobs += 1
+            self.run_total += took
+            self.run_max = max(self.run_max, took)
+            self.bytes_in += result["source_bytes"]
+            self.bytes_out += result["bytes"] + result["thumb_bytes"]
+            return result
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        jobs = self.jobs or 1
+        return {
+            "workers": self.workers,
+            "jobs": self.jobs,
+            "bad": self.bad,
+            "rejected": self.rejected,
+            "waiting": self.waiting,
+            "run_avg_ms": round(self.run_total / jobs * 1000, 2),
+            "run_max_ms": round(self.run_max * 1000, 2),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+image_pipeline = ImagePipeline()
+
+
+# === Перевод старых фото ===
+def backfill(conn, dry_run: bool = False) -> dict:
+    """Move every referenced photo outside MEDIA_DIR into the content-addressed store."""
+    from repo import (
+        db_acquire_image,
+        db_delete_image_variants,
+        db_get_unmigrated_photo_paths,
+        db_recount_image_refs,
+        db_replace_photo_path,
+        db_save_image_variants,
+    )
+
+    counts = {"converted": 0, "deduplicated": 0, "missing": 0, "bad": 0, "bytes_before": 0, "bytes_after": 0}
+    for old in db_get_unmigrated_photo_paths(conn, MEDIA_DIR + "/"):
+        if not os.path.exists(old):
+            counts["missing"] += 1
+            continue
+        size = os.path.getsize(old)
+        counts["bytes_before"] += size
+        if dry_run:
+            counts["converted"] += 1
+            continue
+        sha = file_sha256(old)
+        new = media_path(sha)
+        if db_acquire_image(conn, new):
+            counts["deduplicated"] += 1
+        else:
+            try:
+                variants = render_variants(old, media_base(sha))
+            except BadImage as e:
+                counts["bad"] += 1
+                print(f"Фото {old} пропущено:", e)
+                continue
+            variants["sha256"] = sha
+            db_save_image_variants(conn, variants)
+            counts["converted"] += 1
+            counts["bytes_after"] += variants["bytes"] + variants["thumb_bytes"]
+        db_replace_photo_path(conn, old, new)
+        # старый файл и (для фото из первой версии конвейера) его миниатюра
+        for path in [old] + db_delete_image_variants(conn, [old]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    if not dry_run:
+        counts["refcounts_fixed"] = db_recount_image_refs(conn)
+    return counts
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("usage: python -m core.images backfill [--dry-run]")
+        sys.exit(2)
+    from connection import conn
+
+    print(backfill(conn, dry_run="--dry-run" in sys.argv))
@@ -0,0 +1,167 @@
+"""Cross-process cache invalidation bus over Postgres LISTEN/NOTIFY.
+
+Bots keep in-memory caches (settings, catalog index and keyboards, cashier sets). With web
+and bot workers in separate processes a dashboard write has to reach all of them, so writes
+are published as typed events on one NOTIFY channel:
+
+    {"b": bot_id, "e": entity, "v": version, "o": origin}
+
+- entity: "settings", "catalog", "cashiers" (ENTITIES lists the known ones). Telegram file_ids
+  (nav_photo_ids) need no event: photo paths are content-addressed, so a path never gets
+  new bytes and its file_id never goes stale;
+- version: the new bots.*_version when the writer knows it, otherwise null (= "just drop");
+- publish() delivers to local handlers right away and sends NOTIFY with this process's
+  origin; the listener skips its own events. DB triggers may NOTIFY too (no origin) —
+  bump_catalog_version does, so every catalog write is announced, whoever made it;
+- the listener (run on its own autocommit connection) coalesces events for
+  INVALIDATION_COALESCE seconds: a bulk edit of 500 products is one "catalog" delivery per
+  bot, with the highest version seen;
+- on (re)connect every handler gets bot_id=None ("drop everything"): notifications sent
+  while nobody was listening are lost. Reconnects back off up to 30 s.
+
+Handlers are plain callables handler(bot_id | None, version | None), subscribed per entity.
+"""
+
+import asyncio
+import json
+import os
+import uuid
+
+import psycopg
+
+from repo import db_notify
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+INVALIDATION_COALESCE = float(os.getenv("INVALIDATION_COALESCE", "0.2"))
+
+ENTITIES = ("settings", "catalog", "cashiers")
+
+
+def encode_event(bot_id: int, entity: str, version: int | None = None, origin: str | None = None) -> str:
+    return json.dumps({"b": int(bot_id), "e": entity, "v": version, "o": origin}, separators=(",", ":"))
+
+
+def decode_event(payload: str):
+    """-> (bot_id, entity, version, origin) or None for garbage."""
+    try:
+        data = json.loads(payload)
+        version = data.get("v")
+        return int(data["b"]), str(data["e"]), (int(version) if version is not None else None), data.get("o")
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def _newer(a: int | None, b: int | None) -> int | None:
+    # None — «версия неизвестна», она важнее любой конкретной: просто сбросить
+    if a is None or b is None:
+        return None
+    return max(a, b)
+
+
+class InvalidationBus:
+    def __init__(self, conn, dsn: str, coalesce: float = INVALIDATION_COALESCE):
+        self.conn = conn
+        self.dsn = dsn
+        self.coalesce = coalesce
+        self.origin = uuid.uuid4().hex[:12]
+        self._handlers: dict[str, list] = {}
+        self._pending: dict[tuple[int, str], int | None] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._task: asyncio.Task | None = None
+        self.published = 0
+        self.received = 0
+        self.delivered = 0
+        self.reconnects = 0
+
+    # --- подписка / публикация ---
+    def subscribe(self, entity: str, handler):
+        self._handlers.setdefault(entity, []).append(handler)
+
+    def publish(self, bot_id: int, entity: str, version: int | None = None):
+        """Invalidate locally now and tell the other processes."""
+        self.published += 1
+        self._deliver(bot_id, entity, version)
+        try:
+            db_notify(self.conn, INVALIDATION_CHANNEL, encode_event(bot_id, entity, version, self.origin))
+        except Exception as e:
+            print("Не удалось отправить NOTIFY инвалидации:", e)
+
+    def _deliver(self, bot_id: int | None, entity: str, version: int | None):
+        for handler in self._handlers.get(entity, ()):
+            try:
+                handler(bot_id, version)
+            except Exception as e:
+                print(f"Ошибка обработчика инвалидации {entity}:", e)
+        self.delivered += 1
+
+    def _deliver_all(self):
+        for entity in list(self._handlers):
+            self._deliver(None, entity, None)
+
+    # --- склейка событий ---
+    def _enqueue(self, bot_id: int, entity: str, version: int | None):
+        key = (bot_id, entity)
+        self._pending[key] = _newer(self._pending[key], version) if key in self._pending else version
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.coalesce, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for (bot_id, entity), version in pending.items():
+            self._deliver(bot_id, entity, version)
+
+    # --- слушатель ---
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush()
+
+    async def _listen(self):
+        delay = 1.0
+        while True:
+            try:
+                aconn = await psycopg.AsyncConnection.connect(self.dsn, autocommit=True)
+                async with aconn:
+                    await aconn.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                    delay = 1.0
+                    # пока не слушали, уведомления терялись — сбрасываем всё
+                    self._deliver_all()
+                    async for note in aconn.notifies():
+                        event = decode_event(note.payload)
+                        if event is None:
+                            continue
+                        bot_id, entity, version, origin = event
+                        if origin == self.origin:
+                            continue
+                        self.received += 1
+                        self._enqueue(bot_id, entity, version)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Ошибка слушателя инвалидации кэшей:", e)
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    def stats(self) -> dict:
+        return {
+            "origin": self.origin,
+            "listening": self._task is not None and not self._task.done(),
+            "published": self.published,
+            "received": self.received,
+            "delivered": self.delivered,
+            "pending": len(self._pending),
+            "reconnects": self.reconnects,
+        }
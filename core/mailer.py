@@ -0,0 +1,330 @@
+"""Email outbox with a background sender.
+
+Request handlers never talk to SMTP: enqueue_email() inserts a row into email_outbox and
+wakes the sender. EmailSender (started with the app) delivers the outbox:
+
+- it claims up to EMAIL_BATCH due rows with FOR UPDATE SKIP LOCKED, so several web
+  workers can run senders against one table; a claim is a lease (status 'sending',
+  next_attempt_at = now + EMAIL_LEASE), and rows of a crashed sender become due again;
+- messages go over up to SMTP_CONNECTIONS pooled, already authenticated SMTP connections
+  (idle ones are closed after SMTP_IDLE_TIMEOUT s; a connection the server dropped is
+  reopened and the message is retried once right away);
+- a failed message is retried with exponential backoff (30 s, 60 s, ... up to 1 h) until
+  EMAIL_MAX_ATTEMPTS; permanent refusals (5xx for sender/recipient/data) fail at once;
+- delivery status: each row ends as 'sent' or 'failed' with last_error; stats() adds the
+  counters and the outbox counts by status (GET /bot_status -> "email").
+
+Connection security is SMTP_SECURITY = ssl | starttls | none (default: ssl on port 465,
+starttls otherwise); login happens only when SMTP_USER is set. To try it against a local
+debugging server:
+
+    python -m aiosmtpd -n -l localhost:1025
+    SMTP_HOST=localhost SMTP_PORT=1025 SMTP_SECURITY=none SMTP_FROM=noreply@localhost ...
+"""
+
+import asyncio
+import os
+import smtplib
+import ssl
+import threading
+import time
+from email.message import EmailMessage
+
+import psycopg
+
+from connection import DATABASE_URL
+from repo import db_enqueue_email
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.yandex.ru")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_USER = os.getenv("SMTP_USER", "")  # например: mybox@yandex.ru
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")  # пароль приложения
+SMTP_FROM = os.getenv("SMTP_FROM", SMTP_USER)
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "ssl" if SMTP_PORT == 465 else "starttls").lower()
+SMTP_CONNECTIONS = max(1, int(os.getenv("SMTP_CONNECTIONS", "2")))
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+EMAIL_ENABLED = os.getenv("EMAIL_ENABLED", "1") == "1"
+
+EMAIL_BATCH = int(os.getenv("EMAIL_BATCH", "20"))
+EMAIL_POLL_INTERVAL = float(os.getenv("EMAIL_POLL_INTERVAL", "5"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "6"))
+EMAIL_LEASE = int(os.getenv("EMAIL_LEASE", "300"))
+
+
+def enqueue_email(conn, to_email: str, subject: str, text_body: str, html_body: str | None = None) -> int | None:
+    """Put a message into the outbox (commits) and wake the local sender. -> outbox id."""
+    if not EMAIL_ENABLED:
+        return None
+    email_id = db_enqueue_email(conn, to_email, subject, text_body, html_body, int(time.time()))
+    email_sender.wake()
+    return email_id
+
+
+def retry_delay(attempts: int) -> int:
+    return min(30 * 2 ** max(0, attempts - 1), 3600)
+
+
+def _is_permanent(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        # 4xx (грейлистинг 450/451, переполненный ящик) — временный отказ, ждём повтора
+        codes = [code for code, _ in e.recipients.values()]
+        return bool(codes) and all(isinstance(code, int) and code >= 500 for code in codes)
+    code = getattr(e, "smtp_code", None)
+    return isinstance(e, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) and isinstance(code, int) and code >= 500
+
+
+def build_message(to_email: str, subject: str, text_body: str, html_body: str | None) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = SMTP_FROM
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    msg.set_content(text_body)
+    if html_body:
+        msg.add_alternative(html_body, subtype="html")
+    return msg
+
+
+class SmtpPool:
+    """Authenticated SMTP connections reused across messages (used from worker threads)."""
+
+    def __init__(self, size: int = SMTP_CONNECTIONS, idle_timeout: float = SMTP_IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle: list[tuple[smtplib.SMTP, float]] = []
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        if SMTP_SECURITY == "ssl":
+            smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT, context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == "starttls":
+                smtp.ehlo()
+                smtp.starttls(context=ssl.create_default_context())
+        smtp.ehlo()
+        if SMTP_USER:
+            smtp.login(SMTP_USER, SMTP_PASSWORD)
+        self.opened += 1
+        return smtp
+
+    def acquire(self) -> tuple[smtplib.SMTP, bool]:
+        """-> (connection, reused)."""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                smtp, since = self._idle.pop()
+                if now - since < self.idle_timeout:
+                    self.reused += 1
+                    return smtp, True
+                self._close(smtp)
+        return self._connect(), False
+
+    def release(self, smtp: smtplib.SMTP):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time.monotonic()))
+                return
+        self._close(smtp)
+
+    def discard(self, smtp: smtplib.SMTP):
+        self._close(smtp)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            self._close(smtp)
+
+    @staticmethod
+    def _close(smtp: smtplib.SMTP):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def send(self, msg: EmailMessage):
+        # сервер мог закрыть простаивавшее соединение — тогда одна повторная попытка на новом
+        for attempt in (0, 1):
+            smtp, reused = self.acquire()
+            try:
+                smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self.discard(smtp)
+                if attempt or not reused:
+                    raise
+                continue
+            except Exception:
+                self.discard(smtp)
+                raise
+            self.release(smtp)
+            return
+
+
+class EmailSender:
+    def __init__(self, dsn: str, pool: SmtpPool | None = None, batch: int = EMAIL_BATCH, poll_interval: float = EMAIL_POLL_INTERVAL):
+        self.dsn = dsn
+        self.pool = pool or SmtpPool()
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self._conn = None
+        self._task: asyncio.Task | None = None
+        self._wake: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.last_error: str | None = None
+
+    # --- запуск / остановка ---
+    async def start(self):
+        if self._task is None and EMAIL_ENABLED:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.pool.close_all)
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    def wake(self):
+        if self._wake is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    # --- цикл ---
+    async def _run(self):
+        while True:
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = await asyncio.to_thread(psycopg.connect, self.dsn, autocommit=True)
+                rows = await asyncio.to_thread(self._claim)
+                if rows:
+                    await self._deliver(rows)
+                    continue  # могли остаться ещё готовые письма
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Ошибка отправителя писем:", e)
+                self.last_error = str(e)
+                if self._conn is not None:
+                    try:
+                        await asyncio.to_thread(self._conn.close)
+                    except Exception:
+                        pass
+                    self._conn = None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _deliver(self, rows: list):
+        # письма партии делим между соединениями пула, каждое шлёт свою часть подряд
+        chunks = [rows[i::self.pool.size] for i in range(self.pool.size)]
+        results = await asyncio.gather(*(asyncio.to_thread(self._send_chunk, chunk) for chunk in chunks if chunk))
+        await asyncio.to_thread(self._record, [r for chunk in results for r in chunk])
+
+    def _send_chunk(self, rows: list) -> list:
+        out = []
+        for email_id, to_email, subject, text_body, html_body, attempts in rows:
+            try:
+                self.pool.send(build_message(to_email, subject, text_body, html_body))
+                out.append((email_id, attempts, None, False))
+            except Exception as e:
+                out.append((email_id, attempts, f"{type(e).__name__}: {e}"[:500], _is_permanent(e)))
+        return out
+
+    # --- БД (отдельное соединение, autocommit) ---
+    def _claim(self) -> list:
+        now = int(time.time())
+        c = self._conn.cursor()
+        c.execute(
+            """
+            UPDATE email_outbox o SET status='sending', next_attempt_at=%s
+            FROM (
+                SELECT id FROM email_outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) due
+            WHERE o.id = due.id
+            RETURNING o.id, o.to_email, o.subject, o.text_body, o.html_body, o.attempts
+            """,
+            (now + EMAIL_LEASE, now, self.batch),
+        )
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    def _record(self, results: list):
+        now = int(time.time())
+        c = self._conn.cursor()
+        sent_ids = [email_id for email_id, _, error, _ in results if error is None]
+        if sent_ids:
+            c.execute(
+                "UPDATE email_outbox SET status='sent', sent_at=%s, attempts=attempts+1, last_error=NULL WHERE id = ANY(%s)",
+                (now, sent_ids),
+            )
+            self.sent += len(sent_ids)
+        for email_id, attempts, error, permanent in results:
+            if error is None:
+                continue
+            attempts += 1
+            self.last_error = error
+            if permanent or attempts >= EMAIL_MAX_ATTEMPTS:
+                c.execute(
+                    "UPDATE email_outbox SET status='failed', attempts=%s, last_error=%s WHERE id=%s",
+                    (attempts, error, email_id),
+                )
+                self.failed += 1
+                print(f"Письмо {email_id} не доставлено:", error)
+            else:
+                c.execute(
+                    "UPDATE email_outbox SET status='pending', attempts=%s, last_error=%s, next_attempt_at=%s WHERE id=%s",
+                    (attempts, error, now + retry_delay(attempts), email_id),
+                )
+                self.retried += 1
+        c.close()
+
+    def outbox_counts(self) -> dict:
+        if self._conn is None or self._conn.closed:
+            return {}
+        c = self._conn.cursor()
+        c.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status")
+        counts = {status: int(n) for status, n in c.fetchall()}
+        c.close()
+        return counts
+
+    async def stats(self) -> dict:
+        try:
+            outbox = await asyncio.to_thread(self.outbox_counts)
+        except Exception:
+            outbox = {}
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "last_error": self.last_error,
+            "smtp_opened": self.pool.opened,
+            "smtp_reused": self.pool.reused,
+            "outbox": outbox,
+        }
+
+
+email_sender = EmailSender(DATABASE_URL)
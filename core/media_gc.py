@@ -0,0 +1,152 @@
+"""Garbage collector for orphaned photo files.
+
+Photos are released through core/uploads.remove_images, but a crashed request, a failed
+unlink or an upload whose row was never written still leaves files nobody points at.
+collect_garbage() finds them:
+
+- the set of live paths comes from one query (db_get_live_media_paths): every photo
+  column (products, categories, subcategories, menu_photos, bots.menu_photo_path) plus the
+  variant and thumbnail of each stored photo that is referenced or was created, acquired or
+  released within the grace period;
+- the managed directories (MEDIA_GC_DIRS: the content-addressed store, the older flat
+  upload directories and UPLOAD_TMP_DIR) are streamed with os.scandir, never listed whole;
+- a file that is not live and whose mtime is older than MEDIA_GC_GRACE seconds is removed;
+  the grace period covers uploads between writing the file and committing the row, and
+  leftover ".part" files of interrupted writes are collected the same way;
+- before unlinking, image_variants rows of unreferenced photos past the grace period are
+  dropped and refcounts are recomputed, so deduplication never hands out a deleted file.
+  Both skip rows touched within the grace period: a reference is taken (or released) in a
+  different transaction than the row holding it, and recounting in between would lose it;
+- a file of the content-addressed store is unlinked under the same per-hash lock as
+  core/uploads.remove_images, and only while no row exists for its hash, so a concurrent
+  upload of the same image keeps its fresh files.
+
+The report gives files scanned / kept / removed, reclaimed bytes and errors. With dry_run
+nothing is changed and the report says what would be removed. Run it from cron:
+
+    python -m core.media_gc [--dry-run] [--grace SECONDS]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+from core.images import MEDIA_DIR
+from core.uploads import UPLOAD_TMP_DIR
+from repo import db_delete_stale_image_variants, db_get_live_media_paths, db_lock_image, db_recount_image_refs
+
+MEDIA_GC_GRACE = int(os.getenv("MEDIA_GC_GRACE", str(24 * 3600)))
+MEDIA_GC_DIRS = [
+    d.strip()
+    for d in os.getenv(
+        "MEDIA_GC_DIRS",
+        f"{MEDIA_DIR},static/products,static/categories,static/subcategories,static/menu,{UPLOAD_TMP_DIR}",
+    ).split(",")
+    if d.strip()
+]
+
+_STORE_NAME = re.compile(r"^([0-9a-f]{64})(?:_thumb)?\.(?:jpg|webp)$")
+
+
+def iter_files(root: str):
+    """(path, size, mtime) of every regular file under `root`, depth-first, as it is read."""
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, st.st_size, st.st_mtime
+
+
+def _store_sha(path: str) -> str | None:
+    """Content hash of a file of the content-addressed store, else None."""
+    if not os.path.normpath(path).startswith(os.path.normpath(MEDIA_DIR) + os.sep):
+        return None
+    m = _STORE_NAME.match(os.path.basename(path))
+    return m.group(1) if m else None
+
+
+def collect_garbage(conn, grace: int = MEDIA_GC_GRACE, dry_run: bool = False, roots=None) -> dict:
+    started = time.monotonic()
+    cutoff = int(time.time()) - grace
+    report = {
+        "dry_run": dry_run,
+        "grace_s": grace,
+        "stale_rows": 0,
+        "refcounts_fixed": 0,
+        "scanned": 0,
+        "kept": 0,
+        "removed": 0,
+        "reclaimed_bytes": 0,
+        "errors": 0,
+    }
+
+    if not dry_run:
+        report["stale_rows"] = db_delete_stale_image_variants(conn, cutoff)
+        report["refcounts_fixed"] = db_recount_image_refs(conn, cutoff)
+    live = {os.path.normpath(p) for p in db_get_live_media_paths(conn, cutoff)}
+
+    for root in roots or MEDIA_GC_DIRS:
+        for path, size, mtime in iter_files(root):
+            report["scanned"] += 1
+            if os.path.normpath(path) in live or mtime >= cutoff:
+                report["kept"] += 1
+                continue
+            if not dry_run:
+                sha = _store_sha(path)
+                try:
+                    if sha and db_lock_image(conn, sha):
+                        report["kept"] += 1  # это фото только что загрузили заново
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    report["errors"] += 1
+                    print(f"Ошибка удаления {path}:", e)
+                    continue
+                finally:
+                    if sha:
+                        conn.commit()
+            report["removed"] += 1
+            report["reclaimed_bytes"] += size
+
+    report["took_s"] = round(time.monotonic() - started, 2)
+    return report
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m core.media_gc", description="Remove orphaned photo files.")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    parser.add_argument("--grace", type=int, default=MEDIA_GC_GRACE, metavar="SECONDS",
+                        help=f"keep files and rows touched within this period (default {MEDIA_GC_GRACE})")
+    args = parser.parse_args(argv)
+    dry_run = args.dry_run
+
+    from connection import conn
+
+    report = collect_garbage(conn, grace=args.grace, dry_run=dry_run)
+    verb = "можно освободить" if dry_run else "освобождено"
+    print(
+        f"Файлов просмотрено: {report['scanned']}, оставлено: {report['kept']}, "
+        f"{'к удалению' if dry_run else 'удалено'}: {report['removed']}, "
+        f"{verb}: {report['reclaimed_bytes'] / (1024 * 1024):.1f} МБ, ошибок: {report['errors']}"
+    )
+    print(report)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
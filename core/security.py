@@ -1,11 +1,34 @@
-import os
-import re
+"""Password hashing (PBKDF2-SHA256).
+
+hash_password / verify_password are plain synchronous functions: 200k iterations take tens
+of milliseconds of CPU. Async routes must not call them directly, since that stalls the
+event loop and with it bot polling. They go through `password_hasher` instead:
+
+- jobs run in a process pool of PASSWORD_WORKERS processes (0 = threads: hashlib releases
+  the GIL, but the work still competes with the loop for the interpreter's CPU share);
+- at most PASSWORD_WORKERS jobs run at a time, the rest wait on a semaphore, so queue time is
+  measured; past PASSWORD_MAX_PENDING waiting jobs new ones fail fast with PasswordPoolBusy;
+- stats(): jobs, rejects, current queue, average / max queue and run times.
+
+needs_rehash() tells login to re-hash a password stored with other parameters (legacy
+sha256, or a different PBKDF2_ITERATIONS).
+"""
+
+import asyncio
 import hashlib
 import hmac
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 # === Пароли (PBKDF2) ===
 _PBKDF2_ITERATIONS = int(os.getenv("PBKDF2_ITERATIONS", "200000"))
 
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(2, os.cpu_count() or 1))))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "64"))
+
 
 def hash_password(p: str) -> str:
     salt = os.urandom(16)
@@ -29,3 +52,99 @@ def verify_password(p: str, stored: str) -> bool:
         return hmac.compare_digest(dk.hex(), hash_hex)
     except Exception:
         return False
+
+
+def needs_rehash(stored: str) -> bool:
+    """True when the stored hash was made with other parameters than hash_password uses now."""
+    try:
+        algo, it_s, _, _ = (stored or "").split("$", 3)
+        return algo != "pbkdf2_sha256" or int(it_s) != _PBKDF2_ITERATIONS
+    except ValueError:
+        return True
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password jobs are already waiting."""
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING):
+        self.workers = max(0, workers)
+        self.max_pending = max_pending
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self.waiting = 0
+        self.running = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def _pool(self):
+        if self.workers == 0:
+            return None  # loop.run_in_executor(None, ...) — пул потоков по умолчанию
+        if self._executor is None:
+            # spawn: дочерним процессам не нужны открытые соединения и потоки родителя
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(1, self.workers))
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            started = time.perf_counter()
+            wait = started - queued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.running += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+            finally:
+                self.running -= 1
+                took = time.perf_counter() - started
+                self.jobs += 1
+                self.run_total += took
+                self.run_max = max(self.run_max, took)
+        finally:
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, stored: str) -> bool:
+        return await self._run(verify_password, password, stored)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        jobs = self.jobs or 1
+        return {
+            "workers": self.workers,
+            "iterations": _PBKDF2_ITERATIONS,
+            "jobs": self.jobs,
+            "rejected": self.rejected,
+            "waiting": self.waiting,
+            "running": self.running,
+            "wait_avg_ms": round(self.wait_total / jobs * 1000, 2),
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+            "run_avg_ms": round(self.run_total / jobs * 1000, 2),
+            "run_max_ms": round(self.run_max * 1000, 2),
+        }
+
+
+password_hasher = PasswordHasher()
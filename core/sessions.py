@@ -0,0 +1,139 @@
+"""Signed, expiring dashboard sessions.
+
+The `session` cookie holds "<sid>.<expires_at>.<signature>" (HMAC-SHA256 over sid and
+expiry, urlsafe base64). Sessions are rows in the sessions table, so they can be revoked
+centrally: logout revokes one, a password reset revokes all of the account's sessions.
+
+On the hot path (get_current_user) a request costs a signature check plus a dict hit:
+validated sessions are cached in-process for SESSION_CACHE_TTL seconds. A revocation made
+by another process is therefore seen here after at most that long; one made by this
+process is seen at once.
+
+The signing key is SESSION_SECRET, or (if unset) a random key kept in app_secrets, shared
+by every process using the same database.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+from repo import (
+    db_create_session,
+    db_delete_expired_sessions,
+    db_get_or_create_secret,
+    db_get_session,
+    db_revoke_session,
+    db_revoke_sessions_for,
+)
+
+SESSION_COOKIE = "session"
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "30"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+
+# Раз в столько созданных сессий чистим истёкшие строки
+_CLEANUP_EVERY = 200
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class SessionStore:
+    def __init__(self, conn, secret: str | None = None, ttl: int = SESSION_TTL, cache_ttl: float = SESSION_CACHE_TTL):
+        self.conn = conn
+        secret = secret or os.getenv("SESSION_SECRET") or db_get_or_create_secret(conn, "session_secret", secrets.token_hex(32))
+        self._key = secret.encode("utf-8")
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self._cache: dict[str, tuple[str, int, float]] = {}  # sid -> (email, expires_at, checked_at)
+        self._created = 0
+        self.hits = 0
+        self.misses = 0
+
+    # --- токен ---
+    def _sign(self, sid: str, expires_at: int) -> str:
+        return _b64(hmac.new(self._key, f"{sid}.{expires_at}".encode("ascii"), hashlib.sha256).digest())
+
+    def _parse(self, token: str | None):
+        """-> (sid, expires_at) for a well-signed, unexpired token, else None."""
+        try:
+            sid, exp_s, sig = (token or "").split(".")
+            expires_at = int(exp_s)
+            # Куки приходят от клиента: не-ASCII символы — это подделка, а не 500
+            sid.encode("ascii")
+            sig_b = sig.encode("ascii")
+        except (ValueError, UnicodeEncodeError):
+            return None
+        if expires_at < time.time():
+            return None
+        if not hmac.compare_digest(sig_b, self._sign(sid, expires_at).encode("ascii")):
+            return None
+        return sid, expires_at
+
+    # --- жизненный цикл ---
+    def create(self, email: str) -> str:
+        sid = secrets.token_urlsafe(18)
+        now = int(time.time())
+        expires_at = now + self.ttl
+        db_create_session(self.conn, sid, email, now, expires_at)
+        self._created += 1
+        if self._created % _CLEANUP_EVERY == 0:
+            try:
+                db_delete_expired_sessions(self.conn, now)
+            except Exception as e:
+                print("Ошибка очистки истёкших сессий:", e)
+        return f"{sid}.{expires_at}.{self._sign(sid, expires_at)}"
+
+    def validate(self, token: str | None) -> str | None:
+        """Email of the session's (verified) account, or None."""
+        parsed = self._parse(token)
+        if parsed is None:
+            return None
+        sid, _ = parsed
+
+        now = time.monotonic()
+        cached = self._cache.get(sid)
+        if cached is not None and now - cached[2] < self.cache_ttl:
+            self.hits += 1
+            return cached[0]
+
+        self.misses += 1
+        row = db_get_session(self.conn, sid)
+        if row is None:
+            self._cache.pop(sid, None)
+            return None
+        email, expires_at = row
+        if expires_at < time.time():
+            self._cache.pop(sid, None)
+            return None
+        if len(self._cache) >= SESSION_CACHE_SIZE:
+            self._prune(now)
+        self._cache[sid] = (email, expires_at, now)
+        return email
+
+    def revoke(self, token: str | None):
+        parsed = self._parse(token)
+        if parsed is None:
+            return
+        sid, _ = parsed
+        self._cache.pop(sid, None)
+        db_revoke_session(self.conn, sid, int(time.time()))
+
+    def revoke_all(self, email: str):
+        for sid in [sid for sid, (e, _, _) in self._cache.items() if e == email]:
+            del self._cache[sid]
+        db_revoke_sessions_for(self.conn, email, int(time.time()))
+
+    def _prune(self, now: float):
+        stale = [sid for sid, (_, _, checked) in self._cache.items() if now - checked >= self.cache_ttl]
+        for sid in stale:
+            del self._cache[sid]
+        if len(self._cache) >= SESSION_CACHE_SIZE:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses}
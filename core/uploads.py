@@ -0,0 +1,206 @@
+"""Photo uploads written off the event loop.
+
+Handlers used to `await photo.read()` the whole file and then `open(...).write()` it inside
+the coroutine. save_upload() streams the UploadFile instead:
+
+- the copy runs in a worker thread, UPLOAD_CHUNK bytes at a time, into a temp file
+  ("<name>.part") in the target directory, so memory stays at one chunk per upload and the
+  loop (with the bots' polling on it) is never blocked on disk;
+- limits are enforced while streaming: the type is sniffed from the first bytes (JPEG,
+  PNG, WebP, GIF; the extension comes from the content, not the filename), and the copy
+  stops as soon as UPLOAD_MAX_BYTES is exceeded; a rejected upload leaves nothing behind;
+- the finished file is fsync'ed and renamed into place with os.replace, so a reader never
+  sees a half-written photo under its final name; its sha256 is computed on the way.
+
+Photos go through save_image() / save_images(): the original is streamed into
+UPLOAD_TMP_DIR (not served); if the content-addressed store already has an image with
+that hash, a reference is taken on it and nothing else is done; otherwise the image
+pipeline (core/images.py) renders the Telegram variant and the dashboard thumbnail into
+MEDIA_DIR. The temp original is deleted either way; the variant's path is what the handler
+stores. remove_images() releases references and unlinks photos nobody uses any more.
+
+Releasing and re-uploading the same image can race: the release deletes the row, a new
+upload finds no row and renders into the same files. So the files of a released photo are
+unlinked under a per-hash advisory lock, and only if no row exists for the hash. Recording
+an upload takes the same lock. An upload whose fresh files vanished just before it recorded
+them renders them again.
+
+save_images() handles several files concurrently (at most UPLOAD_CONCURRENCY copies at a
+time; rendering is bounded by the pipeline). Note that Starlette has already spooled the
+multipart body (to disk above 1 MB) before the handler runs; the hard cap on the request
+body belongs to the front proxy (client_max_body_size), UPLOAD_MAX_BYTES is the per-photo
+limit.
+"""
+
+import asyncio
+import hashlib
+import os
+import uuid
+
+from core.images import BadImage, ImagePipelineBusy, image_pipeline, media_base, media_path
+from repo import db_acquire_image, db_lock_image, db_release_images, db_save_image_variants
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK = int(os.getenv("UPLOAD_CHUNK", str(256 * 1024)))
+UPLOAD_CONCURRENCY = max(1, int(os.getenv("UPLOAD_CONCURRENCY", "4")))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "uploads_tmp")
+
+_upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+
+class UploadRejected(ValueError):
+    """The upload breaks a limit; str(e) is a message for the user."""
+
+
+def sniff_image(head: bytes) -> str | None:
+    """Extension for the image type recognised by its first bytes, else None."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    return None
+
+
+def _copy_to_file(src, directory: str, stem: str, max_bytes: int) -> tuple[str, str] | None:
+    src.seek(0)
+    head = src.read(UPLOAD_CHUNK)
+    if not head:
+        return None
+    ext = sniff_image(head)
+    if ext is None:
+        raise UploadRejected("Можно загружать только изображения JPEG, PNG, WebP или GIF")
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{stem}{ext}")
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as dst:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(f"Файл больше {max_bytes // (1024 * 1024)} МБ")
+                digest.update(chunk)
+                dst.write(chunk)
+                chunk = src.read(UPLOAD_CHUNK)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path, digest.hexdigest()
+
+
+async def save_upload(upload, directory: str, stem: str, max_bytes: int = UPLOAD_MAX_BYTES) -> tuple[str, str] | None:
+    """Stream an UploadFile to <directory>/<stem><ext>. -> (path, sha256), or None if no file was sent.
+
+    Raises UploadRejected when the file is not a supported image or is too large.
+    """
+    if upload is None or not getattr(upload, "filename", None):
+        return None
+    async with _upload_slots:
+        return await asyncio.to_thread(_copy_to_file, upload.file, directory, stem, max_bytes)
+
+
+async def save_image(conn, upload) -> str | None:
+    """Stream, process and store a photo, holding one reference on it.
+
+    -> path of its Telegram variant, or None if no file was sent. Raises UploadRejected
+    for a file that is not a usable image, too large, or when the pipeline is overloaded.
+    """
+    saved = await save_upload(upload, UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    if saved is None:
+        return None
+    src, sha = saved
+    try:
+        path = media_path(sha)
+        if db_acquire_image(conn, path):
+            return path  # такое фото уже хранится
+        variants = await _render(src, sha)
+        variants["sha256"] = sha
+        db_save_image_variants(conn, variants)
+        if not (os.path.exists(variants["path"]) and os.path.exists(variants["thumb_path"])):
+            # освобождение этого же фото успело удалить только что записанные файлы;
+            # строка уже есть, так что новые никто не удалит
+            try:
+                await _render(src, sha)
+            except BaseException:
+                await remove_images(conn, variants["path"])
+                raise
+        return variants["path"]
+    finally:
+        await remove_files(src)
+
+
+async def _render(src: str, sha: str) -> dict:
+    try:
+        return await image_pipeline.process(src, media_base(sha))
+    except BadImage as e:
+        raise UploadRejected(str(e))
+    except ImagePipelineBusy:
+        raise UploadRejected("Сервер перегружен, попробуйте через минуту")
+
+
+async def save_images(conn, uploads) -> list:
+    """Save several photos concurrently.
+
+    -> one item per upload, in order: a path, None (empty), or the UploadRejected/OSError.
+    """
+    return await asyncio.gather(*(save_image(conn, upload) for upload in uploads), return_exceptions=True)
+
+
+def _remove_quietly(paths):
+    for path in paths:
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+async def remove_files(*paths: str | None):
+    """Delete replaced photos in a worker thread; missing files are ignored."""
+    if any(paths):
+        await asyncio.to_thread(_remove_quietly, paths)
+
+
+def unlink_unused_image(conn, sha: str, files) -> bool:
+    """Unlink a released photo's files unless an upload has stored the image again.
+
+    Runs without awaiting: the lock lives in the shared connection's transaction until the
+    commit, so no other coroutine may use the connection in between.
+    """
+    try:
+        if db_lock_image(conn, sha):
+            return False
+        _remove_quietly(files)
+        return True
+    finally:
+        conn.commit()
+
+
+async def remove_images(conn, *paths: str | None):
+    """Release one reference per path (after the referencing rows are gone or changed).
+
+    Photos whose refcount drops to zero are unlinked with their thumbnails; paths the store
+    does not know (uploads older than it) are unlinked directly. Only files under static/
+    are ever removed.
+    """
+    unknown = []
+    for path, thumb, sha in db_release_images(conn, paths):
+        files = [f for f in (path, thumb) if f and f.startswith("static/")]
+        if sha:
+            unlink_unused_image(conn, sha, files)
+        else:
+            unknown.extend(files)
+    await remove_files(*unknown)
@@ -5,7 +5,10 @@ from connection import conn, cur
 from schema import init_db
 
 from app_web.routes import register_routes
-from app_bot.manager import start_all_bots
+from app_bot.manager import start_bots, shutdown_bots
+from core.security import password_hasher
+from core.mailer import email_sender
+from core.images import image_pipeline
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -19,4 +22,13 @@ register_routes(app)
 # autostart bots
 @app.on_event("startup")
 async def on_startup():
-    await start_all_bots()
+    await start_bots()
+    await email_sender.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await email_sender.stop()
+    await shutdown_bots()
+    password_hasher.shutdown()
+    image_pipeline.shutdown()
@@ -1,3 +1,8 @@
+import contextlib
+import time
+
+import psycopg
+
 from connection import CompatCursor
 
 
@@ -122,3 +127,496 @@ def title_for_subcategory(conn, bot_id: int, subcat_id: int, sub_name: str) -> s
         return f"{sub_name} ({childcnt})"
     prodcnt = db_count_enabled_products_in_subcat(conn, bot_id, subcat_id)
     return f"{sub_name} ({prodcnt})"
+
+
+def db_get_catalog_version(conn, bot_id: int) -> int:
+    """bots.catalog_version is bumped by triggers on categories/subcategories/products/menu_photos."""
+    return db_get_bot_versions(conn, bot_id)[0]
+
+
+def db_get_bot_versions(conn, bot_id: int) -> tuple[int, int]:
+    """(catalog_version, settings_version); settings_version is bumped by a trigger on any bots change."""
+    cur = _cursor(conn)
+    cur.execute("SELECT catalog_version, settings_version FROM bots WHERE bot_id=?", (bot_id,))
+    row = cur.fetchone()
+    return (int(row[0] or 0), int(row[1] or 0)) if row else (0, 0)
+
+
+def db_get_node_products(conn, bot_id: int, cat_id: int | None = None, subcat_id: int | None = None):
+    """(id, name) of enabled products of a leaf: a subcategory, or a category without subcategories."""
+    cur = _cursor(conn)
+    if subcat_id is not None:
+        cur.execute(
+            "SELECT id, name FROM products WHERE bot_id=? AND subcat_id=? AND enabled=1 ORDER BY sort_order, id",
+            (bot_id, subcat_id),
+        )
+    else:
+        cur.execute(
+            "SELECT id, name FROM products WHERE bot_id=? AND cat_id=? AND (subcat_id IS NULL OR subcat_id=0) AND enabled=1 ORDER BY sort_order, id",
+            (bot_id, cat_id),
+        )
+    return cur.fetchall()
+
+
+BOT_SETTINGS_COLUMNS = (
+    "about", "notify_chat_id",
+    "allow_in_hall", "allow_takeaway", "allow_delivery",
+    "timezone", "work_start", "work_end", "restrict_orders",
+    "auto_cancel_minutes", "auto_cancel_enabled",
+    "bonuses_enabled", "bonus_percent", "max_bonus_pay_percent", "min_order_for_bonus",
+    "bonus_expire_days", "welcome_bonus",
+    "payments_enabled", "payment_provider_token", "min_order_total",
+    "inline_nav", "settings_version",
+)
+
+
+def db_get_bot_settings(conn, bot_id: int):
+    """One row of BOT_SETTINGS_COLUMNS for the bot (None if the bot is gone)."""
+    cur = _cursor(conn)
+    cur.execute(f"SELECT {', '.join(BOT_SETTINGS_COLUMNS)} FROM bots WHERE bot_id=?", (bot_id,))
+    return cur.fetchone()
+
+
+def db_notify(conn, channel: str, payload: str):
+    """pg_notify on the shared connection (delivered to listeners on commit)."""
+    cur = _cursor(conn)
+    cur.execute("SELECT pg_notify(?, ?)", (channel, payload))
+    conn.commit()
+
+
+def db_get_cashier_ids(conn, bot_id: int) -> list[int]:
+    cur = _cursor(conn)
+    cur.execute("SELECT cashier_id FROM cashiers WHERE bot_id=?", (bot_id,))
+    return [int(r[0]) for r in cur.fetchall()]
+
+
+DASHBOARD_BOT_COLUMNS = (
+    "bot_id", "username", "about",
+    "notify_chat_id",
+    "allow_in_hall", "allow_takeaway", "allow_delivery",
+    "timezone", "work_start", "work_end", "restrict_orders",
+    "auto_cancel_minutes", "auto_cancel_enabled",
+    "bonuses_enabled",
+    "bonus_percent",
+    "max_bonus_pay_percent",
+    "min_order_for_bonus",
+    "bonus_expire_days",
+    "welcome_bonus",
+    "payments_enabled",
+    "payment_provider_token",
+    "min_order_total",
+    "inline_nav",
+)
+
+_OWNER_BOTS = "bot_id IN (SELECT bot_id FROM bots WHERE owner=?)"
+
+_DASHBOARD_QUERIES = (
+    ("bots", f"SELECT {', '.join(DASHBOARD_BOT_COLUMNS)} FROM bots WHERE owner=? ORDER BY bot_id"),
+    ("cashiers", f"SELECT bot_id, cashier_id FROM cashiers WHERE {_OWNER_BOTS} ORDER BY bot_id, cashier_id"),
+    (
+        "categories",
+        "SELECT c.id, c.bot_id, c.name, COALESCE(v.thumb_path, c.photo_path) AS photo_path, c.enabled, c.sort_order "
+        f"FROM categories c LEFT JOIN image_variants v ON v.path = c.photo_path WHERE c.{_OWNER_BOTS} "
+        "ORDER BY c.bot_id, c.sort_order, c.id",
+    ),
+    (
+        "menu_photos",
+        "SELECT m.id, m.bot_id, COALESCE(v.thumb_path, m.photo_path) AS photo_path "
+        f"FROM menu_photos m LEFT JOIN image_variants v ON v.path = m.photo_path WHERE m.{_OWNER_BOTS} "
+        "ORDER BY m.bot_id, m.sort_order, m.id",
+    ),
+)
+
+
+def db_load_dashboard(conn, owner: str) -> dict:
+    """The dashboard skeleton for an owner, in a fixed number of queries.
+
+    The set-based queries go in one round trip when libpq supports pipeline mode, then
+    rows are grouped in a single pass. Category contents are not loaded here: the page
+    fetches them per category on expand (db_load_category_tree). Photos come as their
+    dashboard thumbnails where image_variants has one.
+    """
+    cursors = []
+    pipeline = conn.pipeline() if psycopg.Pipeline.is_supported() else contextlib.nullcontext()
+    with pipeline:
+        for _name, query in _DASHBOARD_QUERIES:
+            cur = _cursor(conn)
+            cur.execute(query, (owner,))
+            cursors.append(cur)
+    rows = {name: cur.fetchall() for (name, _query), cur in zip(_DASHBOARD_QUERIES, cursors)}
+
+    bots = rows["bots"]
+    data = {
+        "bots": bots,
+        "cashiers": {bot[0]: [] for bot in bots},
+        "categories": {bot[0]: [] for bot in bots},
+        "menu_photos": {bot[0]: [] for bot in bots},
+    }
+
+    for bot_id, cashier_id in rows["cashiers"]:
+        data["cashiers"][bot_id].append(cashier_id)
+
+    for cat in rows["categories"]:
+        data["categories"][cat[1]].append(cat)
+
+    for photo_id, bot_id, photo_path in rows["menu_photos"]:
+        data["menu_photos"][bot_id].append({"id": photo_id, "photo_path": photo_path})
+
+    return data
+
+
+# Товары в списках панели: описание не читаем (NULL на его месте сохраняет 8 полей строки),
+# фото — миниатюра (запрос соединяет products p с image_variants v)
+_PRODUCT_LIST_COLUMNS = (
+    "p.id, p.bot_id, p.cat_id, p.name, p.price, NULL AS description, COALESCE(v.thumb_path, p.photo_path) AS photo_path, p.enabled"
+)
+
+
+def db_load_category_tree(conn, bot_id: int, cat_id: int, limit: int) -> dict:
+    """One category's subtree for the dashboard: all subcategories, and the first `limit`
+    products of every node with the node's total (two queries whatever the size)."""
+    cur = _cursor(conn)
+    cur.execute(
+        """
+        SELECT s.id, s.bot_id, s.cat_id, s.name, s.enabled, s.sort_order,
+               COALESCE(v.thumb_path, s.photo_path) AS photo_path, s.parent_subcat_id
+        FROM subcategories s
+        LEFT JOIN image_variants v ON v.path = s.photo_path
+        WHERE s.bot_id=? AND s.cat_id=?
+        ORDER BY s.parent_subcat_id, s.sort_order, s.id
+        """,
+        (bot_id, cat_id),
+    )
+    roots, children = [], {}
+    for sub in cur.fetchall():
+        if sub[7] is None:
+            roots.append(sub)
+        else:
+            children.setdefault(sub[7], []).append(sub)
+
+    cur.execute(
+        f"""
+        SELECT {_PRODUCT_LIST_COLUMNS}, p.node, p.total FROM (
+            SELECT p.*, COALESCE(p.subcat_id, 0) AS node,
+                   ROW_NUMBER() OVER (PARTITION BY COALESCE(p.subcat_id, 0) ORDER BY p.sort_order, p.id) AS rn,
+                   COUNT(*) OVER (PARTITION BY COALESCE(p.subcat_id, 0)) AS total
+            FROM products p
+            WHERE p.bot_id=? AND p.cat_id=?
+        ) p
+        LEFT JOIN image_variants v ON v.path = p.photo_path
+        WHERE p.rn <= ?
+        ORDER BY p.node, p.sort_order, p.id
+        """,
+        (bot_id, cat_id, limit),
+    )
+    products, totals = {}, {}
+    for row in cur.fetchall():
+        node = int(row[8])
+        products.setdefault(node, []).append(row[:8])
+        totals[node] = int(row[9])
+
+    return {
+        "subcategories_root": roots,
+        "subcategories_children": children,
+        "products": products,  # node (subcat_id, 0 = прямо в категории) -> первые товары
+        "totals": totals,      # node -> всего товаров
+    }
+
+
+def db_get_node_products_page(conn, bot_id: int, cat_id: int, subcat_id: int | None, offset: int, limit: int):
+    """A page of one node's products for the dashboard -> (rows, total)."""
+    cur = _cursor(conn)
+    where_sub = "(p.subcat_id IS NULL OR p.subcat_id=0)" if subcat_id is None else "p.subcat_id=?"
+    params = [bot_id, cat_id]
+    if subcat_id is not None:
+        params.append(subcat_id)
+    cur.execute(
+        f"""
+        SELECT {_PRODUCT_LIST_COLUMNS}, COUNT(*) OVER () AS total
+        FROM products p
+        LEFT JOIN image_variants v ON v.path = p.photo_path
+        WHERE p.bot_id=? AND p.cat_id=? AND {where_sub}
+        ORDER BY p.sort_order, p.id
+        LIMIT ? OFFSET ?
+        """,
+        tuple(params) + (limit, offset),
+    )
+    rows = cur.fetchall()
+    if rows:
+        return [r[:8] for r in rows], int(rows[0][8])
+    if offset == 0:
+        return [], 0
+    cur.execute(f"SELECT COUNT(*) FROM products p WHERE p.bot_id=? AND p.cat_id=? AND {where_sub}", tuple(params))
+    return [], int(cur.fetchone()[0] or 0)
+
+
+def db_get_or_create_secret(conn, name: str, candidate: str) -> str:
+    """Shared secret by name: the first process stores `candidate`, everyone reads the stored one."""
+    cur = _cursor(conn)
+    cur.execute("INSERT INTO app_secrets (name, value) VALUES (?, ?) ON CONFLICT (name) DO NOTHING", (name, candidate))
+    cur.execute("SELECT value FROM app_secrets WHERE name=?", (name,))
+    value = cur.fetchone()[0]
+    conn.commit()
+    return value
+
+
+def db_create_session(conn, sid: str, email: str, created_at: int, expires_at: int):
+    cur = _cursor(conn)
+    cur.execute(
+        "INSERT INTO sessions (sid, email, created_at, expires_at) VALUES (?, ?, ?, ?)",
+        (sid, email, created_at, expires_at),
+    )
+    conn.commit()
+
+
+def db_get_session(conn, sid: str):
+    """(email, expires_at) of a live session of a verified account, or None."""
+    cur = _cursor(conn)
+    cur.execute(
+        """
+        SELECT s.email, s.expires_at
+        FROM sessions s JOIN accounts a ON a.email = s.email
+        WHERE s.sid=? AND s.revoked_at IS NULL AND a.is_verified=1
+        """,
+        (sid,),
+    )
+    row = cur.fetchone()
+    return (row[0], int(row[1])) if row else None
+
+
+def db_revoke_session(conn, sid: str, now: int):
+    cur = _cursor(conn)
+    cur.execute("UPDATE sessions SET revoked_at=? WHERE sid=? AND revoked_at IS NULL", (now, sid))
+    conn.commit()
+
+
+def db_revoke_sessions_for(conn, email: str, now: int):
+    cur = _cursor(conn)
+    cur.execute("UPDATE sessions SET revoked_at=? WHERE email=? AND revoked_at IS NULL", (now, email))
+    conn.commit()
+
+
+def db_delete_expired_sessions(conn, now: int):
+    cur = _cursor(conn)
+    cur.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+    conn.commit()
+
+
+def db_enqueue_email(conn, to_email: str, subject: str, text_body: str, html_body: str | None, now: int) -> int:
+    cur = _cursor(conn)
+    cur.execute(
+        """
+        INSERT INTO email_outbox (to_email, subject, text_body, html_body, status, attempts, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)
+        RETURNING id
+        """,
+        (to_email, subject, text_body, html_body, now, now),
+    )
+    email_id = int(cur.fetchone()[0])
+    conn.commit()
+    return email_id
+
+
+# (таблица, колонка) — все места, где хранится путь к фото
+PHOTO_COLUMNS = (
+    ("products", "photo_path"),
+    ("categories", "photo_path"),
+    ("subcategories", "photo_path"),
+    ("menu_photos", "photo_path"),
+    ("bots", "menu_photo_path"),
+)
+
+
+def _photo_refs_sql(distinct: bool = False) -> str:
+    """Every referenced photo path, one row per reference (or per path with distinct=True)."""
+    return (" UNION " if distinct else " UNION ALL ").join(
+        f"SELECT {column} AS path FROM {table} WHERE {column} IS NOT NULL AND {column} <> ''"
+        for table, column in PHOTO_COLUMNS
+    )
+
+
+# Ключ advisory-лока фото: hashtextextended('image:<sha256>', 0) -> bigint
+_IMAGE_LOCK_KEY_SQL = "hashtextextended('image:' || ?::text, 0)"
+
+
+def db_save_image_variants(conn, v: dict, refs: int = 1):
+    """Record a processed photo holding `refs` references (adds them if it is already known)."""
+    cur = _cursor(conn)
+    now = int(time.time())
+    if v.get("sha256"):
+        # тот же лок, что в db_lock_image: запись не перемешается с удалением файлов этого фото
+        cur.execute(f"SELECT pg_advisory_xact_lock({_IMAGE_LOCK_KEY_SQL})", (v["sha256"],))
+    cur.execute(
+        """
+        INSERT INTO image_variants
+            (path, sha256, refcount, width, height, bytes, thumb_path, thumb_width, thumb_height, thumb_bytes, source_bytes,
+             created_at, last_acquired_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (path) DO UPDATE SET
+            refcount = image_variants.refcount + EXCLUDED.refcount,
+            last_acquired_at = EXCLUDED.last_acquired_at
+        """,
+        (
+            v["path"], v.get("sha256"), refs, v["width"], v["height"], v["bytes"],
+            v["thumb_path"], v["thumb_width"], v["thumb_height"], v["thumb_bytes"],
+            v["source_bytes"], now, now,
+        ),
+    )
+    conn.commit()
+
+
+def db_acquire_image(conn, path: str) -> bool:
+    """Take a reference on an already stored photo; False if it is not stored."""
+    cur = _cursor(conn)
+    cur.execute(
+        "UPDATE image_variants SET refcount = refcount + 1, last_acquired_at=? WHERE path=? RETURNING path",
+        (int(time.time()), path),
+    )
+    found = cur.fetchone() is not None
+    conn.commit()
+    return found
+
+
+def db_release_images(conn, paths) -> list[tuple[str, str | None, str | None]]:
+    """Drop one reference per item of `paths` (repeats count).
+
+    -> (path, thumb_path, sha256) of the photos nobody references any more: their rows are
+    gone, and the files can be unlinked once db_lock_image confirms no upload stored the image
+    again. Paths unknown to image_variants come back as (path, None, None).
+    """
+    counts = {}
+    for p in paths:
+        if p:
+            counts[p] = counts.get(p, 0) + 1
+    if not counts:
+        return []
+    cur = _cursor(conn)
+    cur.execute(
+        """
+        UPDATE image_variants v SET refcount = v.refcount - d.n, last_released_at = ?
+        FROM (SELECT unnest(?::text[]) AS path, unnest(?::int[]) AS n) d
+        WHERE v.path = d.path
+        RETURNING v.path
+        """,
+        (int(time.time()), list(counts), list(counts.values())),
+    )
+    known = {r[0] for r in cur.fetchall()}
+    cur.execute(
+        "DELETE FROM image_variants WHERE path = ANY(?) AND refcount <= 0 RETURNING path, thumb_path, sha256",
+        (list(known),),
+    )
+    released = [(r[0], r[1], r[2]) for r in cur.fetchall()]
+    conn.commit()
+    return released + [(p, None, None) for p in counts if p not in known]
+
+
+def db_lock_image(conn, sha256: str) -> bool:
+    """Lock the photo with this content hash until the caller commits -> whether it is stored.
+
+    Leaves the transaction open: the caller checks, unlinks the files if the photo is not
+    stored, and commits. db_save_image_variants takes the same lock.
+    """
+    cur = _cursor(conn)
+    cur.execute(f"SELECT pg_advisory_xact_lock({_IMAGE_LOCK_KEY_SQL})", (sha256,))
+    cur.execute("SELECT 1 FROM image_variants WHERE sha256=? LIMIT 1", (sha256,))
+    return cur.fetchone() is not None
+
+
+def db_delete_image_variants(conn, paths) -> list[str]:
+    """Forget the variants of `paths` whatever their refcount -> their thumbnail paths."""
+    paths = [p for p in paths if p]
+    if not paths:
+        return []
+    cur = _cursor(conn)
+    cur.execute("DELETE FROM image_variants WHERE path = ANY(?) RETURNING thumb_path", (paths,))
+    thumbs = [r[0] for r in cur.fetchall() if r[0]]
+    conn.commit()
+    return thumbs
+
+
+# Строку трогали (создали, взяли или отпустили ссылку) не раньше ? — её счётчик может быть «в пути»
+_IMAGE_TOUCHED_SINCE_SQL = (
+    "GREATEST(v.created_at, COALESCE(v.last_acquired_at, 0), COALESCE(v.last_released_at, 0)) >= ?"
+)
+
+
+def db_recount_image_refs(conn, cutoff: int | None = None) -> int:
+    """Recompute refcounts from the photo columns -> how many rows changed.
+
+    A reference is taken / released in a different transaction than the row that holds it,
+    so while the app runs, rows touched since `cutoff` are left alone. None recounts all
+    (offline backfill).
+    """
+    cur = _cursor(conn)
+    skip_recent = f"AND NOT ({_IMAGE_TOUCHED_SINCE_SQL})" if cutoff is not None else ""
+    cur.execute(
+        f"""
+        WITH refs AS (SELECT path, COUNT(*) AS n FROM ({_photo_refs_sql()}) r GROUP BY path)
+        UPDATE image_variants v SET refcount = COALESCE(refs.n, 0)
+        FROM image_variants v2 LEFT JOIN refs ON refs.path = v2.path
+        WHERE v2.path = v.path AND v.refcount IS DISTINCT FROM COALESCE(refs.n, 0) {skip_recent}
+        """,
+        (cutoff,) if cutoff is not None else (),
+    )
+    changed = cur.rowcount
+    conn.commit()
+    return changed
+
+
+def db_get_unmigrated_photo_paths(conn, media_prefix: str) -> list[str]:
+    """Distinct referenced photo paths outside the content-addressed store (older uploads)."""
+    cur = _cursor(conn)
+    cur.execute(f"SELECT r.path FROM ({_photo_refs_sql(distinct=True)}) r WHERE r.path NOT LIKE ? ORDER BY r.path", (media_prefix + "%",))
+    return [r[0] for r in cur.fetchall()]
+
+
+def db_replace_photo_path(conn, old: str, new: str) -> int:
+    """Point every reference to `old` at `new` -> number of references moved."""
+    cur = _cursor(conn)
+    moved = 0
+    for table, column in PHOTO_COLUMNS:
+        cur.execute(f"UPDATE {table} SET {column}=? WHERE {column}=?", (new, old))
+        moved += cur.rowcount
+    conn.commit()
+    return moved
+
+
+def db_delete_stale_image_variants(conn, cutoff: int) -> int:
+    """Forget stored photos that nothing references and that nobody touched since `cutoff`.
+
+    Runs before the media GC unlinks files, so a later upload of the same image cannot
+    take a reference on a row whose file is gone. A photo just deduplicated by an upload
+    whose row is not written yet was acquired recently and is kept.
+    """
+    cur = _cursor(conn)
+    cur.execute(
+        f"""
+        DELETE FROM image_variants v
+        WHERE NOT ({_IMAGE_TOUCHED_SINCE_SQL})
+          AND NOT EXISTS (SELECT 1 FROM ({_photo_refs_sql()}) r WHERE r.path = v.path)
+        """,
+        (cutoff,),
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    return deleted
+
+
+def db_get_live_media_paths(conn, cutoff: int) -> set[str]:
+    """Every path the media GC must keep, in one query: photo columns, plus the files
+    (variant and thumbnail) of stored photos that are referenced or touched since `cutoff`."""
+    cur = _cursor(conn)
+    cur.execute(
+        f"""
+        WITH refs AS ({_photo_refs_sql(distinct=True)}),
+        live AS (
+            SELECT v.path, v.thumb_path FROM image_variants v
+            WHERE {_IMAGE_TOUCHED_SINCE_SQL} OR v.path IN (SELECT path FROM refs)
+        )
+        SELECT path FROM refs
+        UNION SELECT path FROM live
+        UNION SELECT thumb_path FROM live
+        """,
+        (cutoff,),
+    )
+    return {r[0] for r in cur.fetchall() if r[0]}
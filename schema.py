@@ -26,6 +26,54 @@ def init_db(conn, cur):
     cur.execute("CREATE INDEX IF NOT EXISTS idx_accounts_verify_token ON accounts(verify_token)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_accounts_reset_token ON accounts(reset_token)")
 
+    # --- sessions (подписанные токены панели, см. core/sessions.py) ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            sid TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            created_at BIGINT NOT NULL,
+            expires_at BIGINT NOT NULL,
+            revoked_at BIGINT
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_email ON sessions(email)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at)")
+
+    # --- email_outbox (письма отправляет фоновый EmailSender, см. core/mailer.py) ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            text_body TEXT NOT NULL,
+            html_body TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at BIGINT NOT NULL,
+            last_error TEXT,
+            created_at BIGINT NOT NULL,
+            sent_at BIGINT
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at, id) "
+        "WHERE status IN ('pending', 'sending')"
+    )
+
+    # --- app_secrets (общие для всех процессов ключи, если не заданы в env) ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_secrets (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """
+    )
+
     # --- bots ---
     cur.execute(
         """
@@ -61,10 +109,17 @@ def init_db(conn, cur):
 
             payments_enabled INTEGER DEFAULT 0,
             payment_provider_token TEXT,
-            min_order_total INTEGER DEFAULT 0
+            min_order_total INTEGER DEFAULT 0,
+
+            catalog_version BIGINT NOT NULL DEFAULT 0,
+            inline_nav INTEGER DEFAULT 0,
+            settings_version BIGINT NOT NULL DEFAULT 0
         )
         """
     )
+    cur.execute("ALTER TABLE bots ADD COLUMN IF NOT EXISTS catalog_version BIGINT NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE bots ADD COLUMN IF NOT EXISTS inline_nav INTEGER DEFAULT 0")
+    cur.execute("ALTER TABLE bots ADD COLUMN IF NOT EXISTS settings_version BIGINT NOT NULL DEFAULT 0")
 
     # --- clients ---
     cur.execute(
@@ -249,6 +304,111 @@ def init_db(conn, cur):
         """
     )
 
+    # --- catalog version: любое изменение меню увеличивает bots.catalog_version (кэш каталога в ботах) ---
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        DECLARE
+            _bot_id BIGINT := COALESCE(NEW.bot_id, OLD.bot_id);
+            _version BIGINT;
+        BEGIN
+            UPDATE bots SET catalog_version = catalog_version + 1
+            WHERE bot_id = _bot_id
+            RETURNING catalog_version INTO _version;
+            -- событие для шины инвалидации (core/invalidation.py); доставляется при COMMIT
+            IF _version IS NOT NULL THEN
+                PERFORM pg_notify('cache_invalidation',
+                                  json_build_object('b', _bot_id, 'e', 'catalog', 'v', _version)::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for _table in ("categories", "subcategories", "products", "menu_photos"):
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_{_table}_catalog_version ON {_table}")
+        cur.execute(
+            f"""
+            CREATE TRIGGER trg_{_table}_catalog_version
+            AFTER INSERT OR UPDATE OR DELETE ON {_table}
+            FOR EACH ROW EXECUTE FUNCTION bump_catalog_version()
+            """
+        )
+
+    # --- settings version: любое изменение настроек бота (кроме самих версий) увеличивает bots.settings_version ---
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION bump_settings_version() RETURNS trigger AS $$
+        BEGIN
+            IF (to_jsonb(NEW) - 'catalog_version' - 'settings_version')
+               IS DISTINCT FROM (to_jsonb(OLD) - 'catalog_version' - 'settings_version') THEN
+                NEW.settings_version := OLD.settings_version + 1;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    cur.execute("DROP TRIGGER IF EXISTS trg_bots_settings_version ON bots")
+    cur.execute(
+        """
+        CREATE TRIGGER trg_bots_settings_version
+        BEFORE UPDATE ON bots
+        FOR EACH ROW EXECUTE FUNCTION bump_settings_version()
+        """
+    )
+
+    # --- bot workers (шардирование ботов между процессами, см. app_bot/sharding.py) ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bot_workers (
+            worker_id TEXT PRIMARY KEY,
+            hostname TEXT,
+            pid INTEGER,
+            started_at BIGINT,
+            heartbeat_at BIGINT NOT NULL
+        )
+        """
+    )
+
+    # --- user states (FSM ботов, см. app_bot/fsm_storage.py) ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_states (
+            bot_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at BIGINT NOT NULL,
+            PRIMARY KEY (bot_id, user_id),
+            FOREIGN KEY (bot_id) REFERENCES bots (bot_id) ON DELETE CASCADE
+        )
+        """
+    )
+
+    # --- image variants (обработанные фото, см. core/images.py) ---
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS image_variants (
+            path TEXT PRIMARY KEY,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            bytes BIGINT NOT NULL,
+            thumb_path TEXT NOT NULL,
+            thumb_width INTEGER NOT NULL,
+            thumb_height INTEGER NOT NULL,
+            thumb_bytes BIGINT NOT NULL,
+            source_bytes BIGINT,
+            created_at BIGINT NOT NULL
+        )
+        """
+    )
+    # content-addressed хранилище: фото лежит по sha256 исходника, refcount — сколько строк на него ссылается
+    cur.execute("ALTER TABLE image_variants ADD COLUMN IF NOT EXISTS sha256 TEXT")
+    cur.execute("ALTER TABLE image_variants ADD COLUMN IF NOT EXISTS refcount INTEGER NOT NULL DEFAULT 0")
+    # когда ссылку последний раз брали / отпускали: сборщик мусора не пересчитывает такие строки в течение grace
+    cur.execute("ALTER TABLE image_variants ADD COLUMN IF NOT EXISTS last_acquired_at BIGINT")
+    cur.execute("ALTER TABLE image_variants ADD COLUMN IF NOT EXISTS last_released_at BIGINT")
+
     # --- indices ---
     for _sql in [
         "CREATE INDEX IF NOT EXISTS idx_subcategories_bot_cat_sort ON subcategories(bot_id, cat_id, sort_order, id)",
@@ -268,12 +428,15 @@ def init_db(conn, cur):
         "CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id)",
 
         "CREATE INDEX IF NOT EXISTS idx_menu_photos_bot_sort ON menu_photos (bot_id, sort_order, id)",
+        "CREATE INDEX IF NOT EXISTS idx_image_variants_sha256 ON image_variants (sha256)",
 
         "CREATE INDEX IF NOT EXISTS idx_cashiers_cashier_bot ON cashiers (cashier_id, bot_id)",
 
         "CREATE INDEX IF NOT EXISTS idx_products_cat_enabled_id ON products (cat_id, enabled, id)",
         "CREATE INDEX IF NOT EXISTS idx_products_cat_id ON products (cat_id, id)",
         "CREATE INDEX IF NOT EXISTS idx_cart_user_id ON cart (user_id)",
+
+        "CREATE INDEX IF NOT EXISTS idx_user_states_bot_updated ON user_states (bot_id, updated_at)",
     ]:
         cur.execute(_sql)
 
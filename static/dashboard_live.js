@@ -0,0 +1,196 @@
+/* Live updates for the dashboard menu tree.
+   - Forms marked data-live (toggle / move of categories, subcategories, products) are sent
+     with fetch and the X-Fragment header instead of a full post + redirect + re-render.
+   - The server answers with JSON: {replace: {id: html}, order: {list_id: [item ids]}, rows: {id: html},
+     msg, err} — re-rendered rows replace elements by id, moved items are re-appended in the new
+     order. A partially loaded list keeps exactly as many items as it had: an item moved past the
+     loaded part is dropped (the next «Показать ещё» page starts with it), and one moved into it
+     is built from `rows`.
+   - Without JS (or on an unexpected answer) the forms work as before.
+   - Category contents are not in the page: a .menu-body--lazy placeholder is replaced with
+     GET data-src (/dashboard/category) when the category is opened; «Показать ещё» appends
+     the next page of products (/dashboard/products). Open categories are remembered for the
+     tab, so after a redirect back (#prod-… / #subcat-… anchors) they are loaded again.
+*/
+(function(){
+  function applyPatch(data){
+    const replace = data.replace || {};
+    Object.keys(replace).forEach((id) => {
+      const el = document.getElementById(id);
+      if(!el) return;
+      const tpl = document.createElement("template");
+      tpl.innerHTML = String(replace[id]).trim();
+      const node = tpl.content.firstElementChild;
+      if(node) el.replaceWith(node);
+    });
+
+    const order = data.order || {};
+    const rows = data.rows || {};
+    Object.keys(order).forEach((listId) => {
+      const list = document.getElementById(listId);
+      if(!list) return;
+      // недогруженный список — всегда префикс порядка той же длины (offset у «Показать ещё» не меняется)
+      const partial = list.classList.contains("menu-list--partial");
+      const ids = partial ? order[listId].slice(0, list.children.length) : order[listId];
+      ids.forEach((id) => {
+        let item = document.getElementById(id);
+        if(!item && partial && rows[id]){
+          const tpl = document.createElement("template");
+          tpl.innerHTML = String(rows[id]).trim();
+          item = tpl.content.firstElementChild;
+          if(item) list.appendChild(item);
+        }else if(item && item.parentElement === list){
+          list.appendChild(item);
+        }
+      });
+      if(partial){
+        const keep = new Set(ids);
+        Array.from(list.children).forEach((el) => { if(!keep.has(el.id)) el.remove(); });
+      }
+    });
+  }
+
+  async function sendLive(form){
+    if(form.dataset.busy === "1") return;
+    form.dataset.busy = "1";
+    try{
+      const resp = await fetch(form.action, {
+        method: "POST",
+        body: new FormData(form),
+        headers: { "X-Fragment": "1" },
+        credentials: "same-origin",
+      });
+      const type = resp.headers.get("content-type") || "";
+      if(!resp.ok || type.indexOf("application/json") === -1){
+        // например, истекла сессия (редирект на /login) — пусть страница разберётся сама
+        location.reload();
+        return;
+      }
+      const data = await resp.json();
+      applyPatch(data);
+      if(window.showToast){
+        if(data.err) window.showToast(data.err, "error", 6000);
+        else if(data.msg) window.showToast(data.msg, "success", 2500);
+      }
+    }catch(e){
+      location.reload();
+    }finally{
+      delete form.dataset.busy;
+    }
+  }
+
+  // --- ленивые категории ---
+  const OPEN_KEY = "dashboardOpenCats";
+
+  function openCats(){
+    try{ return JSON.parse(sessionStorage.getItem(OPEN_KEY) || "[]"); }catch(e){ return []; }
+  }
+
+  function rememberCat(id, open){
+    const ids = openCats().filter((x) => x !== id);
+    if(open) ids.push(id);
+    try{ sessionStorage.setItem(OPEN_KEY, JSON.stringify(ids)); }catch(e){}
+  }
+
+  let hashRevealed = false;
+
+  function revealHash(){
+    if(hashRevealed || !location.hash) return;
+    const el = document.getElementById(location.hash.slice(1));
+    if(!el) return;
+    hashRevealed = true;
+    let det = el.closest("details");
+    while(det){
+      det.open = true;
+      det = det.parentElement && det.parentElement.closest("details");
+    }
+    el.scrollIntoView({block: "start"});
+  }
+
+  async function loadFragment(url){
+    const resp = await fetch(url, {credentials: "same-origin"});
+    if(resp.redirected && resp.url.indexOf("/login") !== -1){
+      location.reload();
+      return null;
+    }
+    return await resp.text();
+  }
+
+  async function loadCategory(cat){
+    const body = cat.querySelector(":scope > .menu-body--lazy");
+    if(!body || body.dataset.loading === "1") return;
+    body.dataset.loading = "1";
+    try{
+      const html = await loadFragment(body.getAttribute("data-src"));
+      if(html === null) return;
+      const tpl = document.createElement("template");
+      tpl.innerHTML = html.trim();
+      const node = tpl.content.firstElementChild;
+      if(node) body.replaceWith(node);
+      revealHash();
+    }catch(e){
+      delete body.dataset.loading;
+    }
+  }
+
+  async function loadMore(btn){
+    if(btn.disabled) return;
+    btn.disabled = true;
+    const list = document.getElementById(btn.getAttribute("data-list"));
+    try{
+      const html = await loadFragment(btn.getAttribute("data-src"));
+      if(html === null || !list) return;
+      const tpl = document.createElement("template");
+      tpl.innerHTML = html.trim();
+      const next = tpl.content.querySelector(".js-load-more");
+      if(next) next.remove();
+      list.appendChild(tpl.content);
+      if(next){
+        btn.replaceWith(next);
+      }else{
+        list.classList.remove("menu-list--partial");
+        btn.remove();
+      }
+    }catch(e){
+      btn.disabled = false;
+    }
+  }
+
+  // toggle не всплывает — слушаем на фазе перехвата
+  document.addEventListener("toggle", (e) => {
+    const det = e.target;
+    if(!(det instanceof HTMLDetailsElement) || !det.classList.contains("menu-cat")) return;
+    rememberCat(det.id, det.open);
+    if(det.open) loadCategory(det);
+  }, true);
+
+  document.addEventListener("click", (e) => {
+    const btn = e.target.closest && e.target.closest(".js-load-more");
+    if(!btn) return;
+    e.preventDefault();
+    loadMore(btn);
+  });
+
+  function bootLazy(){
+    openCats().forEach((id) => {
+      const cat = document.getElementById(id);
+      if(cat && cat.classList.contains("menu-cat")) cat.open = true;
+    });
+    // открытые изначально (первая категория) событие toggle могут и не прислать
+    document.querySelectorAll("details.menu-cat[open]").forEach(loadCategory);
+  }
+
+  if(document.readyState === "loading"){
+    document.addEventListener("DOMContentLoaded", bootLazy);
+  }else{
+    bootLazy();
+  }
+
+  document.addEventListener("submit", (e) => {
+    const form = e.target;
+    if(!(form instanceof HTMLFormElement) || !form.hasAttribute("data-live")) return;
+    if(e.defaultPrevented || !window.fetch) return;
+    e.preventDefault();
+    sendLive(form);
+  });
+})();
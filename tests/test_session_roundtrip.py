@@ -0,0 +1,73 @@
+"""encode_state / decode_state round trip for every session record (app_bot/session.py)."""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("psycopg")
+
+from app_bot.fsm_storage import (  # noqa: E402
+    MemoryStateBackend,
+    UserStateStore,
+    approx_size,
+    decode_state,
+    encode_state,
+)
+from app_bot.session import SESSION_CLASSES, CartSession, session_from  # noqa: E402
+
+
+def _sample(cls):
+    """A record with every declared field set (plus one overflow key)."""
+    record = cls()
+    for i, name in enumerate(cls.fields):
+        if name == "previous_state":
+            record[name] = session_from({"type": "categories", "page": 1, "cats": {"Пицца": {"id": 3}}})
+        elif name == "type":
+            record[name] = "custom"
+        else:
+            record[name] = [(i, f"v{i}")] if i % 2 else i
+    record["extra_flag"] = True
+    return record
+
+
+@pytest.mark.parametrize("name", sorted(SESSION_CLASSES))
+def test_encode_decode_round_trip(name):
+    record = _sample(SESSION_CLASSES[name])
+    decoded = decode_state(encode_state(record))
+    assert type(decoded) is type(record)
+    assert decoded == record
+    assert repr(decoded) == repr(record)
+    assert approx_size(decoded) > 0
+
+
+@pytest.mark.parametrize("state", [
+    {"type": "cart_view", "cart_items": [(1, 2, "Пицца", 500)], "page": 0},
+    {"type": "cart_empty", "previous_state": {"type": "categories", "page": 0}},
+])
+def test_cart_states_round_trip(state):
+    record = session_from(state)
+    assert isinstance(record, CartSession)
+    assert dict(record.items()) == dict(decode_state(encode_state(record)).items())
+
+
+def test_flush_keeps_batch_when_one_state_fails():
+    class Unserializable:
+        pass
+
+    backend = MemoryStateBackend()
+    store = UserStateStore(1, backend)
+    store[10] = {"type": "cart_view", "cart_items": [(1, 1, "Суп", 100)]}
+    store[11] = {"type": "categories", "bad": Unserializable()}
+    asyncio.run(store.flush())
+
+    assert decode_state(backend.load(1, 10))["cart_items"] == [(1, 1, "Суп", 100)]
+    assert backend.load(1, 11) is None
+    # битое состояние остаётся грязным и будет записано, когда его поправят
+    del store[11]["bad"]
+    store.mark_dirty(11)
+    asyncio.run(store.flush())
+    assert decode_state(backend.load(1, 11))["type"] == "categories"